@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+"""
+Бенчмарк разбора дат: прежний todate (dateutil.parse(dayfirst=True, yearfirst=True) для любой строки) против
+utils.dates.parse_date (разбор частых форматов регулярными выражениями и запоминание результатов).
+
+python -m benchmarks.dates --repeat=20000
+"""
+
+import timeit
+
+from dateutil.parser import parse
+from tornado.options import define, options
+
+from utils import dates
+
+SAMPLES = ["2017-10-01T12:30:00", "2017-10-01T12:30:00.123+03:00", "01.10.2017", "01.10.2017 12:30",
+           "1506800000", "1506800000000", "1 Oct 2017"]
+
+
+def legacy_todate(value):
+  try:
+    return parse(value, dayfirst=True, yearfirst=True)
+  except Exception:
+    return None
+
+
+def main():
+  define("repeat", default=20000, help="number of runs per sample", type=int)
+  options.parse_command_line()
+
+  print "%-32s %12s %12s %12s" % ("sample", "legacy, us", "cold, us", "memo, us")
+  for sample in SAMPLES:
+    legacy = timeit.timeit(lambda: legacy_todate(sample), number=options.repeat)
+
+    def cold():
+      dates._cache.clear()
+      dates.parse_date(sample)
+    cold_time = timeit.timeit(cold, number=options.repeat)
+    memo = timeit.timeit(lambda: dates.parse_date(sample), number=options.repeat)
+    print "%-32s %12.2f %12.2f %12.2f" % (sample, legacy / options.repeat * 1e6, cold_time / options.repeat * 1e6,
+                                          memo / options.repeat * 1e6)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+"""
+Нагрузочный бенчмарк по всем методам API RestApplication (ENDPOINTS; без сценария только EXCLUDED).
+Скрипт заполняет отдельную базу заданным объемом данных (пользователи, посты с тегами, комментарии), поднимает
+сервер в текущем процессе и для каждого сценария выполняет requests запросов с concurrency одновременными
+соединениями. Для каждого сценария выводятся req/s и задержки p50/p95/p99; результаты сохраняются в JSON, чтобы
+сравнивать версии (--compare=старый_результат.json). Отклоненные сервером запросы (503/429, см. utils.admission)
+считаются отдельно (rejected) и не входят ни в req/s, ни в задержки: быстрый отказ не должен улучшать результат.
+
+Работает без сети: с локальным mongod (--mongo_host/--mongo_port), либо запускает временный mongod сам
+(--mongod=путь до mongod, данные во временном каталоге, по умолчанию движок хранения ephemeralForTest в памяти).
+
+python -m benchmarks.load --users=1000 --posts=20000 --comments_per_post=5 --requests=2000 --concurrency=50 \
+  --output=bench.json
+"""
+
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import urllib
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+from tornado.testing import bind_unused_port
+
+from rest_server import RestApplication
+
+# методы API (маршрут хэндлера и тип запроса); у каждого должен быть сценарий, кроме перечисленных в EXCLUDED
+ENDPOINTS = [
+  "/user/create", "/user/follow", "/user/unfollow",
+  "/post/create_post", "/post/create_comment", "/post/forbid_user", "/post/get_post", "/post/get_comments",
+  "/posts/by_user", "/posts/posts", "/posts/tags", "/posts/tag_stats", "/posts/timeline",
+  "/bulk/users", "/bulk/posts", "/bulk/comments",
+  "/metrics", "/ready",
+  "/admin/profile", "/admin/slow_requests", "/admin/compression", "/admin/admission",
+]
+# методы без сценария и причина
+EXCLUDED = {
+  "/admin/profile": "runs the sampling profiler for a fixed time, one request at a time (409 otherwise)",
+}
+ADMIN_TOKEN = "bench"
+# ответы admission control (перегрузка, лимит запросов): запрос отклонен, а не обработан
+REJECTED_CODES = (503, 429)
+
+TAGS = [u"news", u"dev", u"ops", u"misc", u"help", u"python", u"mongo", u"tornado"]
+WORDS = [u"server", u"mail", u"post", u"comment", u"cache", u"query", u"cursor", u"event", u"loop", u"index"]
+
+
+def start_mongod(path, engine):
+  """
+  Метод запускает временный mongod на свободном порту
+
+  :return: (процесс, порт, каталог с данными)
+  """
+  dbpath = tempfile.mkdtemp(prefix="bench_mongod_")
+  sock = socket.socket()
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  args = [path, "--port", str(port), "--bind_ip", "127.0.0.1", "--dbpath", dbpath, "--nounixsocket", "--quiet"]
+  if engine:
+    args.extend(["--storageEngine", engine])
+  process = subprocess.Popen(args, stdout=open(os.devnull, "w"))
+  client = MongoClient("127.0.0.1", port, serverSelectionTimeoutMS=30000)
+  client.admin.command("ping")
+  client.close()
+  return process, port, dbpath
+
+
+def seed(db, users, posts, comments_per_post, rnd):
+  """
+  Метод заполняет базу данными для бенчмарка
+
+  :return: словарь с идентификаторами, используемыми в сценариях
+  """
+  for name in ("users", "posts", "comments", "forbidden_users", "follows", "timelines", "tag_counts",
+               "tag_counts_daily"):
+    db.drop_collection(name)
+  user_ids = db.users.insert_many([{"username": u"bench%d" % i} for i in xrange(users)]).inserted_ids
+  start = datetime.utcnow() - timedelta(days=365)
+  post_ids = []
+  batch = 10000
+  for offset in xrange(0, posts, batch):
+    post_ids.extend(db.posts.insert_many([{
+      "user_id": rnd.choice(user_ids),
+      "title": u" ".join(rnd.sample(WORDS, 3)),
+      "text": u"bench text " * 30,
+      "tags": rnd.sample(TAGS, 2),
+      "post_date": start + timedelta(seconds=i * 60)
+    } for i in xrange(offset, min(offset + batch, posts))], ordered=False).inserted_ids)
+  comments = [{
+    "user_id": rnd.choice(user_ids),
+    "post_id": post_id,
+    "text": u"bench comment",
+    "comment_date": start + timedelta(seconds=i * 60 + j)
+  } for i, post_id in enumerate(post_ids) for j in xrange(comments_per_post)]
+  for offset in xrange(0, len(comments), batch):
+    db.comments.insert_many(comments[offset:offset + batch], ordered=False)
+  return {"users": user_ids, "posts": post_ids}
+
+
+def scenarios(ids, rnd):
+  """
+  Метод описывает сценарии нагрузки: название -> функция, возвращающая (метод, путь, тело)
+  """
+  counter = [0]
+
+  def unique():
+    counter[0] += 1
+    return counter[0]
+
+  def user():
+    return str(rnd.choice(ids["users"]))
+
+  def post():
+    return str(rnd.choice(ids["posts"]))
+
+  def get(path, **params):
+    return "GET", path + ("?" + urllib.urlencode(params) if params else ""), None
+
+  def post_form(path, **params):
+    return "POST", path, urllib.urlencode(params)
+
+  def ndjson(path, make_item, count=100):
+    return "POST", path, "\n".join(json.dumps(make_item()) for _ in xrange(count))
+
+  return [
+    ("/user/create", lambda: post_form("/user/create", username="load%d%d" % (os.getpid(), unique()))),
+    ("/user/follow", lambda: post_form("/user/follow", user=user(), followee=user())),
+    ("/user/unfollow", lambda: post_form("/user/unfollow", user=user(), followee=user())),
+    ("/post/create_post", lambda: post_form("/post/create_post", user=user(), title=u"load", text=u"load text",
+                                            tags=json.dumps(rnd.sample(TAGS, 2)))),
+    ("/post/create_comment", lambda: post_form("/post/create_comment", user=user(), post_id=post(), text="load")),
+    ("/post/forbid_user", lambda: post_form("/post/forbid_user", post_id=post(), users=json.dumps([user()]))),
+    ("/post/get_post", lambda: get("/post/get_post", post_id=post())),
+    ("/post/get_comments", lambda: get("/post/get_comments", post_id=post(), limit=10)),
+    ("/posts/by_user", lambda: get("/posts/by_user", user=user(), length=10)),
+    ("/posts/posts", lambda: get("/posts/posts", length=10, skip=rnd.randint(0, 100))),
+    ("/posts/posts?tags", lambda: get("/posts/posts", tags=json.dumps(rnd.sample(TAGS, 1)), length=10)),
+    ("/posts/posts?title", lambda: get("/posts/posts", title=rnd.choice(WORDS), length=10)),
+    ("/posts/tags", lambda: get("/posts/tags", limit=50)),
+    ("/posts/tag_stats", lambda: get("/posts/tag_stats", tags=json.dumps(rnd.sample(TAGS, 2)), days=30)),
+    ("/posts/timeline", lambda: get("/posts/timeline", user=user(), length=10)),
+    ("/bulk/users", lambda: ndjson("/bulk/users", lambda: {"username": "bulk%d%d" % (os.getpid(), unique())})),
+    ("/bulk/posts", lambda: ndjson("/bulk/posts", lambda: {"user": user(), "title": "bulk"})),
+    ("/bulk/comments", lambda: ndjson("/bulk/comments", lambda: {"user": user(), "post_id": post(), "text": "bulk"})),
+    ("/metrics", lambda: get("/metrics")),
+    ("/ready", lambda: get("/ready")),
+    ("/admin/slow_requests", lambda: get("/admin/slow_requests")),
+    ("/admin/compression", lambda: get("/admin/compression")),
+    ("/admin/admission", lambda: get("/admin/admission")),
+  ]
+
+
+def check_coverage(application, table):
+  """
+  Метод проверяет, что у каждого метода API есть сценарий (кроме EXCLUDED), а каждый маршрут приложения описан
+  в ENDPOINTS
+
+  :raise AssertionError: непокрытые методы или маршруты
+  """
+  covered = set(name.split("?")[0] for name, _ in table)
+  missing = sorted(set(ENDPOINTS) - covered - set(EXCLUDED))
+  assert not missing, "endpoints without scenario: %s" % ", ".join(missing)
+  unknown = sorted(rule.matcher.regex.pattern for rule in application.wildcard_router.rules
+                   if not any(rule.matcher.regex.match(endpoint) for endpoint in ENDPOINTS))
+  assert not unknown, "routes missing from ENDPOINTS: %s" % ", ".join(unknown)
+  for endpoint, reason in sorted(EXCLUDED.items()):
+    print "not benchmarked: %s (%s)" % (endpoint, reason)
+
+
+def percentile(values, p):
+  if not values:
+    return None
+  # nearest-rank
+  return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+@gen.coroutine
+def run_scenario(base_url, make_request, count, concurrency):
+  client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+  latencies = []
+  errors = [0]
+  rejected = [0]
+  remaining = [count]
+
+  @gen.coroutine
+  def worker():
+    while remaining[0] > 0:
+      remaining[0] -= 1
+      method, path, body = make_request()
+      headers = {}
+      if path.startswith("/bulk/"):
+        headers["Content-Type"] = "application/x-ndjson"
+      elif path.startswith("/admin/"):
+        headers["X-Admin-Token"] = ADMIN_TOKEN
+      started = time.time()
+      response = yield client.fetch(base_url + path, method=method, body=body, headers=headers, raise_error=False,
+                                    request_timeout=60)
+      if response.code in REJECTED_CODES:
+        rejected[0] += 1
+        continue
+      latencies.append((time.time() - started) * 1000)
+      if response.code >= 400:
+        errors[0] += 1
+
+  started = time.time()
+  yield [worker() for _ in xrange(concurrency)]
+  elapsed = time.time() - started
+  client.close()
+  latencies.sort()
+  raise gen.Return({
+    "requests": count,
+    "errors": errors[0],
+    "rejected": rejected[0],
+    "rps": round(len(latencies) / elapsed, 1),
+    "p50_ms": round(percentile(latencies, 50) or 0, 2),
+    "p95_ms": round(percentile(latencies, 95) or 0, 2),
+    "p99_ms": round(percentile(latencies, 99) or 0, 2),
+  })
+
+
+def change(old, new):
+  return (float(new) / old - 1) * 100 if old else 0.0
+
+
+def compare(old, new):
+  print "%-24s %10s %10s %8s %10s %10s %8s %9s %9s" % (
+    "scenario", "rps old", "rps new", "diff", "p99 old", "p99 new", "diff", "rej old", "rej new")
+  for name, result in sorted(new["results"].items()):
+    prev = old["results"].get(name)
+    if not prev:
+      continue
+    print "%-24s %10.1f %10.1f %+7.1f%% %10.2f %10.2f %+7.1f%% %9d %9d" % (
+      name, prev["rps"], result["rps"], change(prev["rps"], result["rps"]),
+      prev["p99_ms"], result["p99_ms"], change(prev["p99_ms"], result["p99_ms"]),
+      prev.get("rejected", 0), result["rejected"])
+
+
+def main():
+  define("mongo_host", default="127.0.0.1", help="mongodb host")
+  define("mongo_port", default=27017, help="mongodb port", type=int)
+  define("mongo_db_name", default="bench_load", help="mongodb database name (will be dropped)")
+  define("mongod", default="", help="path to mongod binary to start a throwaway instance")
+  define("mongod_engine", default="ephemeralForTest", help="storage engine of the throwaway mongod")
+  define("users", default=1000, help="number of users to seed", type=int)
+  define("posts", default=20000, help="number of posts to seed", type=int)
+  define("comments_per_post", default=5, help="number of comments per post", type=int)
+  define("requests", default=2000, help="requests per scenario", type=int)
+  define("concurrency", default=50, help="concurrent requests", type=int)
+  define("only", default="", help="comma separated scenario names to run")
+  define("seed", default=42, help="random seed", type=int)
+  define("output", default="", help="path to save results as JSON")
+  define("compare", default="", help="path to previous results to compare with")
+  define("listing_engine", default="find", help="listing engine of the server under test")
+  define("title_search", default="regex", help="title search mode of the server under test")
+  options.parse_command_line()
+
+  mongod = None
+  mongo_port = options.mongo_port
+  if options.mongod:
+    mongod = start_mongod(options.mongod, options.mongod_engine)
+    mongo_port = mongod[1]
+  try:
+    rnd = random.Random(options.seed)
+    db = MongoClient(options.mongo_host, mongo_port)[options.mongo_db_name]
+    started = time.time()
+    ids = seed(db, options.users, options.posts, options.comments_per_post, rnd)
+    print "seeded in %.1f s" % (time.time() - started)
+
+    application = RestApplication(options.mongo_host, mongo_port, options.mongo_db_name, False,
+                                  listing_engine=options.listing_engine, title_search=options.title_search,
+                                  admin_token=ADMIN_TOKEN)
+    IOLoop.current().run_sync(application.ensure_indexes)
+    # посты заполняются напрямую в БД, счетчики тегов пересчитываются по ним
+    IOLoop.current().run_sync(application.rebuild_tag_counts)
+    IOLoop.current().run_sync(application.warm_up)
+    sock, port = bind_unused_port()
+    server = HTTPServer(application)
+    server.add_sockets([sock])
+    base_url = "http://127.0.0.1:%s" % port
+
+    selected = set(filter(None, options.only.split(",")))
+    table = scenarios(ids, rnd)
+    check_coverage(application, table)
+
+    results = {}
+    for name, make_request in table:
+      if selected and name not in selected:
+        continue
+      results[name] = IOLoop.current().run_sync(
+        lambda: run_scenario(base_url, make_request, options.requests, options.concurrency))
+      print "%-24s %8.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  errors %d  rejected %d" % (
+        name, results[name]["rps"], results[name]["p50_ms"], results[name]["p95_ms"], results[name]["p99_ms"],
+        results[name]["errors"], results[name]["rejected"])
+    server.stop()
+
+    report = {
+      "date": datetime.utcnow().isoformat(),
+      "params": dict((name, getattr(options, name)) for name in (
+        "users", "posts", "comments_per_post", "requests", "concurrency", "seed", "listing_engine", "title_search")),
+      "results": results,
+    }
+    if options.output:
+      with open(options.output, "w") as fw:
+        json.dump(report, fw, indent=2, sort_keys=True)
+    if options.compare:
+      with open(options.compare) as fr:
+        compare(json.load(fr), report)
+  finally:
+    if mongod is not None:
+      mongod[0].terminate()
+      mongod[0].wait()
+      shutil.rmtree(mongod[2], ignore_errors=True)
+
+
+if __name__ == "__main__":
+  main()
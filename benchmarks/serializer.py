@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+"""
+Микробенчмарк сериализации ответов: прежний путь write_json (json.dumps с default=custom_handler на основе
+hasattr/getattr и сравнения имен классов) против utils.serializer (таблица типов и заранее созданный кодировщик).
+
+python -m benchmarks.serializer --docs=100 --repeat=2000
+"""
+
+import json
+import re
+import timeit
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from tornado.options import define, options
+
+from utils import serializer
+
+_retype = type(re.compile(''))
+
+
+def legacy_handler(obj):
+  if hasattr(obj, 'isoformat') and callable(getattr(obj, 'isoformat')):
+    return obj.isoformat()
+  if obj.__class__.__name__ == "ObjectId":
+    return str(obj)
+  if obj.__class__ is set:
+    return list(obj)
+  if obj.__class__ is _retype:
+    return obj.pattern
+  return None
+
+
+def make_docs(count):
+  start = datetime(2017, 10, 1)
+  return [{
+    "_id": ObjectId(),
+    "username": u"user%d" % i,
+    "title": u"Заголовок поста %d" % i,
+    "text": u"Текст поста " * 20,
+    "tags": [u"news", u"dev"],
+    "post_date": start + timedelta(minutes=i)
+  } for i in range(count)]
+
+
+def main():
+  define("docs", default=100, help="documents per response", type=int)
+  define("repeat", default=2000, help="number of responses", type=int)
+  options.parse_command_line()
+
+  docs = make_docs(options.docs)
+  assert json.loads(json.dumps(docs, default=legacy_handler, sort_keys=False)) == json.loads(serializer.dumps(docs))
+  legacy = timeit.timeit(lambda: json.dumps(docs, default=legacy_handler, sort_keys=False), number=options.repeat)
+  results = [("legacy custom_handler", legacy)]
+  backends = ["json"]
+  if serializer.configure("auto") != "json":
+    backends.append(serializer.backend)
+  for name in backends:
+    serializer.configure(name)
+    results.append(("serializer (%s)" % name, timeit.timeit(lambda: serializer.dumps(docs), number=options.repeat)))
+  for name, seconds in results:
+    print "%-24s %8.2f us/response  x%.2f" % (name, seconds / options.repeat * 1e6, legacy / seconds)
+
+
+if __name__ == "__main__":
+  main()
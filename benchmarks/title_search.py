@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+"""
+Сравнение поиска по заголовкам постов: регулярное выражение (title_mode=regex) и текстовый индекс (title_mode=text).
+Скрипт заполняет отдельную базу posts_count постами и замеряет время запросов, аналогичных PostsHandler.get_posts.
+
+python -m benchmarks.title_search --mongo_db_name=bench_title --posts_count=1000000
+"""
+
+import random
+import re
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import MongoClient, DESCENDING
+from tornado.options import define, options
+
+from utils.indexes import INDEXES
+
+WORDS = [u"python", u"tornado", u"mongo", u"motor", u"index", u"search", u"server", u"mail", u"post", u"comment",
+         u"cache", u"query", u"cursor", u"event", u"loop", u"async", u"release", u"bug", u"feature", u"review"]
+TAGS = [u"news", u"dev", u"ops", u"misc", u"help"]
+
+
+def seed(db, count, batch=10000):
+  db.posts.drop()
+  for keys, kwargs in INDEXES["posts"]:
+    db.posts.create_index(keys, **kwargs)
+  start = datetime.utcnow() - timedelta(days=365)
+  rnd = random.Random(42)
+  for offset in xrange(0, count, batch):
+    db.posts.insert_many([{
+      "user_id": ObjectId(),
+      "title": u" ".join(rnd.sample(WORDS, 4)) + u" %d" % i,
+      "text": u"",
+      "tags": rnd.sample(TAGS, 2),
+      "post_date": start + timedelta(seconds=i * 30)
+    } for i in xrange(offset, min(offset + batch, count))], ordered=False)
+
+
+def measure(db, query, repeat):
+  timings = []
+  for _ in xrange(repeat):
+    started = time.time()
+    list(db.posts.find(query).sort([("post_date", DESCENDING), ("_id", DESCENDING)]).limit(10))
+    timings.append(time.time() - started)
+  timings.sort()
+  return timings[len(timings) // 2] * 1000
+
+
+def main():
+  define("mongo_host", default="127.0.0.1", help="mongodb host")
+  define("mongo_port", default=27017, help="mongodb port", type=int)
+  define("mongo_db_name", default="bench_title", help="mongodb database name")
+  define("posts_count", default=1000000, help="number of posts to seed", type=int)
+  define("repeat", default=5, help="number of runs per query", type=int)
+  define("skip_seed", default=False, help="use already seeded database", type=bool)
+  options.parse_command_line()
+
+  db = MongoClient(options.mongo_host, options.mongo_port)[options.mongo_db_name]
+  if not options.skip_seed:
+    started = time.time()
+    seed(db, options.posts_count)
+    print "seeded %d posts in %.1f s" % (options.posts_count, time.time() - started)
+
+  cases = [
+    ("one word", u"tornado", {}),
+    ("phrase", u"mongo index", {}),
+    ("rare word", u"%d" % (options.posts_count // 2), {}),
+    ("word + tag", u"cursor", {"tags": {"$in": [u"ops"]}}),
+  ]
+  print "%-12s %12s %12s" % ("case", "regex, ms", "text, ms")
+  for name, title, extra in cases:
+    regex_query = dict(extra, title=re.compile(re.escape(title), re.IGNORECASE))
+    text_query = dict(extra)
+    text_query["$text"] = {"$search": u'"%s"' % title}
+    print "%-12s %12.1f %12.1f" % (name, measure(db, regex_query, options.repeat),
+                                   measure(db, text_query, options.repeat))
+
+
+if __name__ == "__main__":
+  main()
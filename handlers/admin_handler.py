@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import hmac
+import thread
+
+from tornado import gen
+from tornado.escape import utf8
+from tornado.web import asynchronous, HTTPError
+
+from handlers.base_handler import BaseHandler
+from utils.profiler import SamplingProfiler
+
+# максимальная длительность профилирования в секундах
+MAX_PROFILE_SECONDS = 120
+
+
+class AdminHandler(BaseHandler):
+  """
+  Хэндлер отвечает за служебные методы диагностики. Доступ - только с заголовком X-Admin-Token, равным настройке
+  admin_token; если она не задана, служебные методы отключены
+  /admin
+  """
+  # профилирование длится заданное время, такие запросы в журнал медленных не попадают
+  log_slow_requests = False
+  admission_control = False
+
+  def prepare(self):
+    super(AdminHandler, self).prepare()
+    token = self.settings["admin_token"]
+    # адрес клиента не проверяется: за балансировщиком или прокси все запросы приходят с localhost;
+    # сравнение за постоянное время, чтобы токен нельзя было подобрать по времени ответа
+    if not token or not hmac.compare_digest(utf8(self.request.headers.get("X-Admin-Token", "")), utf8(token)):
+      raise HTTPError(403)
+
+  @asynchronous
+  @gen.coroutine
+  def profile(self):
+    """
+    Метод включает сэмплирующий профилировщик потока IOLoop на seconds секунд (по умолчанию 10) с интервалом
+    interval секунд (по умолчанию 0.005) и возвращает свернутые стеки (формат flamegraph.pl / speedscope)
+
+    :return: строки "функция;функция;... количество снимков"
+    """
+    seconds = min(float(self.get_argument("seconds", 10)), MAX_PROFILE_SECONDS)
+    interval = max(float(self.get_argument("interval", 0.005)), 0.001)
+    if self.application.profiler is not None:
+      raise HTTPError(409, "Profiler is already running")
+    profiler = self.application.profiler = SamplingProfiler(thread.get_ident(), interval)
+    profiler.start()
+    try:
+      yield gen.sleep(seconds)
+    finally:
+      profiler.stop()
+      self.application.profiler = None
+    self.set_header("Content-Type", "text/plain; charset=UTF-8")
+    self.set_header("X-Samples", str(profiler.samples))
+    self.finish(profiler.collapsed())
+
+  def slow_requests(self):
+    """
+    Метод возвращает последние медленные запросы (дольше настройки slow_request_threshold) с длительностью этапов
+
+    :return: список запросов, от новых к старым
+    """
+    self.write_json(list(reversed(self.application.slow_requests)))
+
+  def compression_stats(self):
+    """
+    Метод возвращает статистику сжатия ответов по способам сжатия (см. utils.compression.Compression.stats)
+
+    :return: словарь способ сжатия -> счетчики
+    """
+    if self.application.compression is None:
+      raise HTTPError(404, "Compression is disabled")
+    self.write_json(self.application.compression.stats())
+
+  def admission(self):
+    """
+    Метод возвращает состояние контроля нагрузки (см. utils.admission.Admission.stats)
+    """
+    if self.application.admission is None:
+      raise HTTPError(404, "Admission control is disabled")
+    self.write_json(self.application.admission.stats())
+
+  def get(self, _type):
+    types = {
+      "admission": self.admission,
+      "profile": self.profile,
+      "slow_requests": self.slow_requests,
+      "compression": self.compression_stats
+    }
+    if types.get(_type):
+      types.get(_type)()
+    else:
+      raise HTTPError(404)
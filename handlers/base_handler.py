@@ -3,27 +3,268 @@ __author__ = 'vatyakshin'
 
 import json
 import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from bson import ObjectId
+from bson.errors import InvalidId
+from bson.son import SON
 from tornado import gen
-from tornado.web import RequestHandler
+from tornado.web import RequestHandler, HTTPError
 
-from utils.data_utils import custom_handler, tolist
+from utils.admission import Rejected
+from utils.cache import BloomFilter
+from utils.data_utils import tolist
+from utils.deadline import Cancelled, Deadline, DeadlineDatabase, deadline_reason
+from utils.serializer import dumps
+from utils.pagination import encode_cursor, keyset_query, InvalidCursor
+from utils.timelines import fan_out_background
 
 logger = logging.getLogger(__name__)
 
+# заголовки, которые сохраняются в кэше вместе с телом ответа
+CACHED_HEADERS = ("X-Next-Cursor",)
+# cookie со временем, до которого клиент читает с primary после записи (read-your-writes)
+PRIMARY_PIN_COOKIE = "primary_until"
+# значение кэша запретов для постов, у которых запрещенных пользователей больше forbidden_cache_max_users
+FORBIDDEN_TOO_MANY = "too many"
+# значение кэша запретов для несуществующих постов
+FORBIDDEN_NO_POST = "no post"
+# поля постов, которые не возвращаются в списках постов (комментарии, встроенные в пост, см. embed_comments)
+LISTING_EXCLUDED_FIELDS = ("latest_comments", "comment_count")
+
 class BaseHandler(RequestHandler):
   """
   Класс является родительским классом для всех хэндлеров проекта.
   """
+  _cache_key = None
+  _cache_deps = ()
+  _metrics_labels = None
+  _bytes_written = 0
+  _motor = None
+  _motor_read = None
+  # ответ сохраняется в кэш и должен быть прочитан с primary (см. serve_cached)
+  _read_primary = False
+  _phases = None
+  _admission_ticket = None
+  # ограничение времени обработки запроса (utils.deadline.Deadline)
+  deadline = None
+  # записывать ли медленные запросы хэндлера в журнал медленных запросов
+  log_slow_requests = True
+  # проходят ли запросы хэндлера контроль нагрузки (служебные хэндлеры - метрики, готовность - не ограничиваются)
+  admission_control = True
+  # ограничивается ли время обработки запросов хэндлера (настройки request_timeout*)
+  use_deadline = True
+
+  def prepare(self):
+    # время получения и разбора запроса до вызова хэндлера
+    self.add_phase("parse", time.time() - self.request._start_time)
+    if self.request_metrics is not None:
+      self._metrics_labels = (self.__class__.__name__, self.path_args[0] if self.path_args else "")
+      self.request_metrics.started(self._metrics_labels[0])
+    window = self.settings["read_your_writes_window"]
+    if window and self.request.method == "POST":
+      self.set_cookie(PRIMARY_PIN_COOKIE, str(int(time.time() + window)), expires=time.time() + window)
+    # время ожидания в очереди контроля нагрузки входит во время обработки запроса
+    self.deadline = Deadline(self._deadline_time())
+    return self.admit()
+
+  def _deadline_time(self):
+    """
+    Метод вычисляет время, до которого должна завершиться обработка запроса: ограничение по пути (request_timeouts),
+    либо общее (request_timeout); клиент может задать свое в заголовке request_timeout_header (секунды, не больше
+    request_timeout_max)
+
+    :return: timestamp или None - без ограничения
+    """
+    if not self.use_deadline:
+      return None
+    timeout = self.application.request_timeouts.get(self.request.path, self.settings["request_timeout"])
+    header = self.request.headers.get(self.settings["request_timeout_header"])
+    if header:
+      try:
+        requested = float(header)
+      except ValueError:
+        raise HTTPError(400, "Invalid %s header" % self.settings["request_timeout_header"])
+      if requested > 0:
+        timeout = min(requested, self.settings["request_timeout_max"])
+    if not timeout:
+      return None
+    return self.request._start_time + timeout
+
+  def on_connection_close(self):
+    """
+    Клиент закрыл соединение: следующие запросы к MongoDB не выполняются, открытые курсоры закрываются
+    """
+    if self.deadline is not None:
+      self.deadline.cancel()
+    # запрос, ждущий в очереди контроля нагрузки, не занимает ее и не получает место
+    if self._admission_ticket is not None:
+      self._admission_ticket.cancel(Cancelled())
+    super(BaseHandler, self).on_connection_close()
+
+  def log_exception(self, typ, value, tb):
+    # прерывание по deadline - не ошибка сервера: считается отдельно и в лог ошибок не пишется
+    reason = deadline_reason(value)
+    if reason is None:
+      super(BaseHandler, self).log_exception(typ, value, tb)
+      return
+    if self._metrics_labels is not None:
+      self.request_metrics.deadline(self._metrics_labels[0], self._metrics_labels[1], reason)
+    logger.info("request %s %s stopped: %s" % (self.request.method, self.request.uri, reason))
+
+  def send_error(self, status_code=500, **kwargs):
+    if "exc_info" in kwargs and deadline_reason(kwargs["exc_info"][1]) == "mongo":
+      # MongoDB прервала операцию по maxTimeMS
+      status_code = 504
+      kwargs["reason"] = "Deadline Exceeded"
+    super(BaseHandler, self).send_error(status_code, **kwargs)
+
+  def admit(self):
+    """
+    Метод пропускает запрос через контроль нагрузки (utils.admission): проверяет частоту запросов клиента
+    (ограничение IP и, если параметр user - корректный _id, ограничение пользователя) и занимает место среди
+    одновременно обрабатываемых запросов. Отклоненный запрос сразу завершается ответом 429 или 503.
+
+    :return: None - запрос допущен, Future - запрос ждет в очереди (prepare дожидается ее)
+    """
+    admission = self.application.admission
+    if admission is None or not self.admission_control:
+      return None
+    path = self.request.path
+    # параметр user задает сам клиент: без ограничения IP он обходил бы ограничение, меняя user в каждом запросе
+    clients = [("ip", self.request.remote_ip)]
+    user = self.get_argument("user", None)
+    if user and ObjectId.is_valid(user):
+      clients.append(("user", ObjectId(user)))
+    admission.check_rate(path, clients)
+    self._admission_ticket = admission.ticket(path)
+    waiter = self._admission_ticket.acquire()
+    if waiter is not None:
+      started = time.time()
+      waiter.add_done_callback(lambda _: self.add_phase("admission wait", time.time() - started))
+    return waiter
+
+  def write_error(self, status_code, **kwargs):
+    if "exc_info" in kwargs and isinstance(kwargs["exc_info"][1], Rejected):
+      self.set_header("Retry-After", kwargs["exc_info"][1].retry_after)
+    super(BaseHandler, self).write_error(status_code, **kwargs)
+
+  def flush(self, include_footers=False, callback=None):
+    # размер ответа для метрик (ответ 304 отправляется без тела, буфер к этому моменту уже очищен)
+    self._bytes_written += sum(len(chunk) for chunk in self._write_buffer)
+    return super(BaseHandler, self).flush(include_footers, callback)
+
+  def on_finish(self):
+    if self._admission_ticket is not None:
+      self._admission_ticket.release()
+    if self._metrics_labels is not None:
+      handler, _type = self._metrics_labels
+      status = self.get_status()
+      # при 404 тип запроса может быть произвольной строкой из пути, в метки он не попадает
+      if status == 404:
+        _type = ""
+      self.request_metrics.finished(handler, _type, self.request.method, status, self.request.request_time(),
+                                    self._bytes_written)
+    threshold = self.settings["slow_request_threshold"]
+    if threshold and self.log_slow_requests and self.request.request_time() >= threshold:
+      self.log_slow_request()
+
+  @contextmanager
+  def phase(self, name):
+    """
+    Контекстный менеджер замеряет длительность этапа обработки запроса (для журнала медленных запросов).
+    Длительности этапов с одинаковым названием суммируются.
+
+    :param name: название этапа, например "mongo posts.find", "users", "serialize"
+    """
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.add_phase(name, time.time() - started)
+
+  def add_phase(self, name, duration):
+    if not self.settings["slow_request_threshold"]:
+      return
+    if self._phases is None:
+      self._phases = OrderedDict()
+    self._phases[name] = self._phases.get(name, 0) + duration
+
+  def log_slow_request(self):
+    """
+    Метод записывает в лог (и в список последних медленных запросов приложения) длительность запроса по этапам
+    """
+    total = self.request.request_time()
+    phases = [(name, round(duration * 1000, 2)) for name, duration in (self._phases or {}).items()]
+    logger.warning("slow request %s %s %s: %.1f ms (%s)" % (
+      self.request.method, self.request.uri, self.get_status(), total * 1000,
+      ", ".join("%s %.1f ms" % phase for phase in phases)))
+    self.application.slow_requests.append({
+      "method": self.request.method,
+      "uri": self.request.uri,
+      "status": self.get_status(),
+      "time": self.request._start_time,
+      "total_ms": round(total * 1000, 2),
+      "phases": phases
+    })
+
+  @property
+  def request_metrics(self):
+    """
+    Метрики HTTP-запросов (utils.metrics.RequestMetrics, None, если метрики отключены)
+
+    :return:
+    """
+    return self.application.request_metrics
+
   @property
   def motor(self):
     """
-    объект MotorClient, подключения к MongoDB
+    объект MotorClient, подключения к MongoDB. Чтения ограничены временем обработки запроса (deadline, maxTimeMS)
 
     :return:
     """
-    return self.application.motor
+    if self._motor is None:
+      self._motor = self._with_deadline(self.application.motor)
+    return self._motor
+
+  def _with_deadline(self, db):
+    if self.deadline is None:
+      return db
+    return DeadlineDatabase(db, self.deadline)
+
+  @property
+  def motor_read(self):
+    """
+    объект MotorDatabase для чтения: режим чтения (read preference) выбирается по пути запроса (настройка
+    read_routing). Запросы на запись и клиенты, недавно выполнявшие запись (настройка read_your_writes_window),
+    читают с primary
+
+    :return:
+    """
+    if self._motor_read is None:
+      pinned = self.request.method != "GET" or self._read_primary or self.is_primary_pinned()
+      self._motor_read = self._with_deadline(self.application.read_database(self.request.path, pinned))
+    return self._motor_read
+
+  def is_primary_pinned(self):
+    """
+    Метод проверяет, выполнял ли клиент запись в течение read_your_writes_window секунд
+
+    :return: True, если чтение нужно выполнять с primary
+    """
+    window = self.settings["read_your_writes_window"]
+    if not window:
+      return False
+    try:
+      until = int(self.get_cookie(PRIMARY_PIN_COOKIE, 0))
+    except ValueError:
+      return False
+    now = time.time()
+    # значение больше now + window клиент мог подставить сам, такое значение игнорируется
+    return now <= until <= now + window
 
   def get_argument_json(self, name, default=None):
     if default is None:
@@ -34,9 +275,252 @@ class BaseHandler(RequestHandler):
       return json.loads(argval)
     return argval
 
+  def get_keyset(self, query, field, direction):
+    """
+    Метод дополняет запрос условием продолжения по токену из параметра cursor (keyset-пагинация)
+
+    :param query: запрос в формате MongoDB
+    :param field: поле даты, по которому идет сортировка (None - сортировка по _id)
+    :param direction: направление сортировки
+    :return: кортеж (запрос, сортировка, был ли передан токен)
+    """
+    cursor = self.get_argument("cursor", None)
+    try:
+      query, sort = keyset_query(query, field, direction, cursor)
+    except InvalidCursor:
+      raise HTTPError(400, "Invalid cursor")
+    return query, sort, bool(cursor)
+
+  def set_next_cursor(self, docs, field, limit):
+    """
+    Метод передает в заголовке X-Next-Cursor токен для запроса следующей страницы (если она может существовать)
+
+    :param docs: документы текущей страницы
+    :param field: поле даты, по которому идет сортировка
+    :param limit: размер страницы
+    """
+    if docs and len(docs) >= limit:
+      self.set_header("X-Next-Cursor", encode_cursor(docs[-1], field))
+
   def write_json(self, results):
     self.set_header("Content-Type", "application/json; charset=UTF-8")
-    self.finish(json.dumps(results, default=custom_handler, sort_keys=False))
+    with self.phase("serialize"):
+      body = dumps(results)
+    entry = None
+    if self._cache_key is not None:
+      headers = dict((name, self._headers[name]) for name in CACHED_HEADERS if name in self._headers)
+      entry = self.response_cache.set(self._cache_key, body, headers, self._cache_deps)
+      self.set_header("Cache-Control", self._cache_control())
+    self.finish_json(body, entry)
+
+  @property
+  def compression(self):
+    """
+    Сжатие ответов (utils.compression.Compression, None, если сжатие отключено)
+
+    :return:
+    """
+    return self.application.compression
+
+  def _negotiate_encoding(self, size=None):
+    """
+    Метод выбирает способ сжатия ответа по заголовку Accept-Encoding
+
+    :param size: размер тела ответа (None - неизвестен, ответ отправляется частями)
+    :return: название способа сжатия или None
+    """
+    if self.compression is None or (size is not None and size < self.compression.min_size):
+      return None
+    self.set_header("Vary", "Accept-Encoding")
+    return self.compression.negotiate(self.request.headers.get("Accept-Encoding", ""))
+
+  def finish_json(self, body, entry=None):
+    """
+    Метод отправляет тело JSON-ответа, сжимая его, если клиент это поддерживает (настройки compression*).
+    Для ответа из кэша ответов сжатое тело сохраняется в кэше рядом с исходным и повторно не сжимается.
+
+    :param body: тело ответа
+    :param entry: CachedResponse (ответ из кэша ответов или только что сохраненный в него)
+    """
+    codec = self._negotiate_encoding(len(body))
+    if entry is not None:
+      # у сжатого варианта ответа свой Etag
+      self.set_header("Etag", entry.etag if codec is None else '%s-%s"' % (entry.etag[:-1], codec))
+      # RequestHandler.finish сравнивает If-None-Match, только если Etag не задан, поэтому проверка здесь
+      if self.check_etag_header():
+        self.set_status(304)
+        self.finish()
+        return
+    if codec is not None:
+      encoded = entry.encoded.get(codec) if entry is not None else None
+      if encoded is None:
+        with self.phase("compress"):
+          encoded = self.compression.compress(codec, body)
+        if entry is not None:
+          entry.encoded[codec] = encoded
+      else:
+        self.compression.cached(codec, len(body) - len(encoded))
+      self.set_header("Content-Encoding", codec)
+      body = encoded
+    self.finish(body)
+
+  @property
+  def response_cache(self):
+    """
+    Кэш HTTP-ответов (None, если кэширование отключено)
+
+    :return:
+    """
+    return self.application.response_cache
+
+  def _cache_control(self):
+    return "max-age=%d, must-revalidate" % self.settings["response_cache_max_age"]
+
+  def serve_cached(self, *deps):
+    """
+    Метод отвечает на GET-запрос из кэша ответов (с поддержкой If-None-Match -> 304). Если ответа в кэше нет,
+    запоминает поколения зависимостей, и ответ, отправленный через write_json, будет сохранен в кэш.
+    Клиентам, недавно выполнявшим запись (см. is_primary_pinned), кэш не отдается: сохраненный ответ мог быть
+    прочитан с отстающей secondary. Их ответ читается с primary и сохраняется в кэш. Если зависимости менялись
+    за последние read_max_staleness секунд, ответ для кэша тоже читается с primary: secondary могла еще не получить
+    запись, и ее результат хранился бы в кэше до следующей записи.
+
+    :param deps: пары (тип объекта, идентификатор), от которых зависит ответ: ("post", post_id), ("user", user_id),
+                 ("tag", tag), ("posts", "*")
+    :return: True, если ответ отправлен из кэша
+    """
+    if self.response_cache is None or self.get_stream_mode():
+      return False
+    key = self.response_cache.make_key(self.request.path, self.request.query_arguments)
+    entry = None if self.is_primary_pinned() else self.response_cache.get(key)
+    if entry is not None:
+      for name, value in entry.headers.items():
+        self.set_header(name, value)
+      self.set_header("Content-Type", "application/json; charset=UTF-8")
+      self.set_header("Cache-Control", self._cache_control())
+      self.finish_json(entry.body, entry)
+      return True
+    self._cache_key = key
+    self._cache_deps = self.response_cache.snapshot(deps)
+    if self.response_cache.invalidated_within(self._cache_deps, self.settings["read_max_staleness"]):
+      self._read_primary = True
+      self._motor_read = None
+    return False
+
+  def invalidate(self, *deps):
+    """
+    Метод вытесняет из кэша ответов все ответы, зависящие от переданных объектов
+
+    :param deps: пары (тип объекта, идентификатор)
+    """
+    if self.response_cache is not None:
+      self.response_cache.invalidate(*deps)
+
+  def get_stream_mode(self):
+    """
+    Метод определяет, нужно ли отдавать список документов потоком: параметр stream (json или ndjson), либо
+    заголовок Accept: application/x-ndjson
+
+    :return: None, "json" или "ndjson"
+    """
+    stream = self.get_argument("stream", None)
+    if stream in ("json", "ndjson"):
+      return stream
+    if "application/x-ndjson" in self.request.headers.get("Accept", ""):
+      return "ndjson"
+    return None
+
+  @gen.coroutine
+  def write_json_stream(self, cursor, prepare=None, ndjson=False):
+    """
+    Метод отдает документы курсора по мере их получения из БД: документы читаются пачками, каждая пачка
+    сериализуется и сразу отправляется клиенту (chunked), поэтому весь результат в памяти не хранится.
+    При сжатии каждая пачка сжимается потоковым компрессором и отправляется сразу.
+
+    :param cursor: курсор MongoDB (Motor)
+    :param prepare: корутина, преобразующая пачку документов перед отправкой
+    :param ndjson: отдавать NDJSON (по документу на строку) вместо JSON-массива
+    """
+    if ndjson:
+      self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+    else:
+      self.set_header("Content-Type", "application/json; charset=UTF-8")
+    compressor = None
+    codec = self._negotiate_encoding()
+    if codec is not None:
+      self.set_header("Content-Encoding", codec)
+      compressor = self.compression.stream(codec)
+    pending = "" if ndjson else "["
+    batch_size = self.settings["stream_batch_size"]
+    separator = "\n" if ndjson else ", "
+    batch = []
+    first = True
+    while True:
+      with self.phase("mongo fetch"):
+        has_next = yield cursor.fetch_next
+      if has_next:
+        batch.append(cursor.next_object())
+      if batch and (len(batch) >= batch_size or not has_next):
+        if prepare is not None:
+          batch = yield prepare(batch)
+        with self.phase("serialize"):
+          chunk = separator.join(dumps(doc) for doc in batch)
+        if ndjson:
+          chunk += "\n"
+        elif not first:
+          chunk = separator + chunk
+        first = False
+        batch = []
+        chunk, pending = pending + chunk, ""
+        if compressor is not None:
+          with self.phase("compress"):
+            chunk = compressor.process(chunk)
+        self.write(chunk)
+        with self.phase("send"):
+          yield self.flush()
+      if not has_next:
+        break
+    chunk = pending if ndjson else pending + "]"
+    if compressor is not None:
+      chunk = compressor.process(chunk, flush=False) + compressor.finish()
+    self.finish(chunk)
+
+  @property
+  def listing_engine(self):
+    """
+    Способ получения списков документов: find (запрос и отдельный запрос пользователей) или aggregate (один
+    конвейер агрегации с $lookup пользователей)
+
+    :return:
+    """
+    return self.settings["listing_engine"]
+
+  def aggregate_with_usernames(self, collection, query, sort, skip=0, limit=10, exclude=(), add_fields=None):
+    """
+    Метод возвращает курсор конвейера агрегации: фильтрация, сортировка, пагинация и подстановка имени
+    пользователя вместо user_id выполняются на стороне MongoDB одним запросом
+
+    :param collection: название коллекции
+    :param query: запрос в формате MongoDB
+    :param sort: сортировка (список пар)
+    :param skip: сколько документов нужно предварительно пропустить (пагинация)
+    :param limit: сколько всего документов показывать (пагинация)
+    :param exclude: поля, которые не нужно возвращать
+    :param add_fields: вычисляемые поля (например, {"score": {"$meta": "textScore"}})
+    :return: курсор документов в том виде, в котором они возвращаются API
+    """
+    pipeline = [{"$match": query}]
+    if sort:
+      pipeline.append({"$sort": SON(sort)})
+    if skip:
+      pipeline.append({"$skip": skip})
+    pipeline.extend([
+      {"$limit": limit},
+      {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "_id", "as": "_user"}},
+      {"$addFields": dict(add_fields or {}, username={"$arrayElemAt": ["$_user.username", 0]})},
+      {"$project": dict((field, False) for field in ("_user", "user_id") + tuple(exclude))}
+    ])
+    return self.motor_read[collection].aggregate(pipeline, batchSize=min(limit, self.settings["stream_batch_size"]))
 
   @gen.coroutine
   def check_if_user_exists(self, username):
@@ -46,36 +530,197 @@ class BaseHandler(RequestHandler):
     :param username:
     :return:
     """
-    r = yield self.motor.users.find_one({"username": username})
+    with self.phase("mongo users.find_one"):
+      r = yield self.motor.users.find_one({"username": username})
     if not r:
       raise gen.Return(False)
     raise gen.Return(True)
 
+  @property
+  def user_cache(self):
+    """
+    Кэш пользователей приложения (utils.cache.LRUCache)
+
+    :return:
+    """
+    return self.application.user_cache
+
+  @property
+  def forbidden_cache(self):
+    """
+    Кэш наборов пользователей, которым запрещено комментировать пост (post_id -> set(user_id))
+
+    :return:
+    """
+    return self.application.forbidden_cache
+
+  @property
+  def comment_buffer(self):
+    """
+    Буфер отложенной записи комментариев (None, если комментарии пишутся напрямую)
+
+    :return:
+    """
+    return self.application.comment_buffer
+
+  @gen.coroutine
+  def check_forbid_status(self, user_id, post_id):
+    """
+    Функция проверяет, может ли пользователь с идентификатором user_id оставлять сообщения в посте post_id.
+    Для поста используется закэшированный набор запрещенных пользователей (см. _load_forbidden), поэтому проверка
+    обычно не обращается к MongoDB. Если запрещенных пользователей слишком много для набора, в кэше хранится фильтр
+    Блума: отсутствие пользователя в нем проверяется без запросов, иначе проверяется наличие конкретной пары.
+    Запрет, сделанный в другом рабочем процессе, становится виден не позже чем через forbidden_cache_ttl секунд.
+
+    :param user_id: идентификатор пользователя
+    :param post_id: идентификатор поста
+    :return: True, если пользователь не может оставлять комментарии, иначе False
+    :raise HTTPError: 404, если поста нет
+    """
+    user_id = ObjectId(user_id)
+    post_id = ObjectId(post_id)
+    forbidden = self.forbidden_cache.get(post_id)
+    if forbidden is None:
+      is_forbid = yield self._load_forbidden(post_id, user_id)
+      raise gen.Return(is_forbid)
+    if forbidden is FORBIDDEN_NO_POST:
+      raise HTTPError(404, "There is no post with this _id")
+    if isinstance(forbidden, set):
+      raise gen.Return(user_id in forbidden)
+    if isinstance(forbidden, BloomFilter) and user_id not in forbidden:
+      raise gen.Return(False)
+    with self.phase("mongo forbidden_users.find_one"):
+      pair, legacy = yield [
+        self.motor.forbidden_users.find_one({"post_id": post_id, "user_id": user_id}, {"_id": True}),
+        self.motor.posts.find_one({"_id": post_id, "forbidden_for": {"$in": [user_id, str(user_id)]}}, {"_id": True})
+      ]
+    raise gen.Return(pair is not None or legacy is not None)
+
+  @gen.coroutine
+  def _load_forbidden(self, post_id, user_id):
+    """
+    Метод загружает набор запрещенных пользователей поста, сохраняет его в кэш и проверяет пользователя. Запреты
+    из коллекции forbidden_users (запрос покрывается индексом (post_id, user_id)), из поля forbidden_for поста
+    (запреты, сделанные до появления forbidden_users) и пара (post_id, user_id) запрашиваются одновременно, т.е.
+    за одно ожидание ответа MongoDB. Отсутствие поста тоже кэшируется.
+    Если запрещенных пользователей больше forbidden_cache_max_users, до построения фильтра Блума в фоне
+    (_load_forbidden_bloom) в кэше хранится FORBIDDEN_TOO_MANY. Набор не сохраняется, если во время загрузки был
+    сделан новый запрет (он мог не попасть в загруженный набор).
+
+    :param post_id: идентификатор поста
+    :param user_id: идентификатор проверяемого пользователя
+    :return: True, если пользователь не может оставлять комментарии
+    :raise HTTPError: 404, если поста нет
+    """
+    generation = self.application.forbidden_generation
+    limit = self.settings["forbidden_cache_max_users"]
+    r = self.motor.forbidden_users.find({"post_id": post_id}, {"user_id": True, "_id": False}).limit(limit + 1)
+    with self.phase("mongo forbidden_users.find"):
+      docs, post, pair = yield [
+        r.to_list(limit + 1),
+        self.motor.posts.find_one({"_id": post_id}, {"forbidden_for": True, "_id": False}),
+        self.motor.forbidden_users.find_one({"post_id": post_id, "user_id": user_id}, {"_id": True})
+      ]
+    cache = generation == self.application.forbidden_generation
+    if post is None:
+      if cache:
+        self.forbidden_cache.set(post_id, FORBIDDEN_NO_POST)
+      raise HTTPError(404, "There is no post with this _id")
+    legacy = set()
+    for user in post.get("forbidden_for") or []:
+      try:
+        legacy.add(ObjectId(user))
+      except (InvalidId, TypeError):
+        pass
+    forbidden = legacy.union(doc["user_id"] for doc in docs)
+    if len(docs) <= limit and len(forbidden) <= limit:
+      if cache:
+        self.forbidden_cache.set(post_id, forbidden)
+      raise gen.Return(user_id in forbidden)
+    if cache:
+      self.forbidden_cache.set(post_id, FORBIDDEN_TOO_MANY)
+      self.application.run_background(self._load_forbidden_bloom(self.application, post_id, legacy, generation))
+    raise gen.Return(pair is not None or user_id in legacy)
+
+  @staticmethod
+  @gen.coroutine
+  def _load_forbidden_bloom(application, post_id, legacy, generation):
+    """
+    Метод строит фильтр Блума запрещенных пользователей поста (все запреты из forbidden_users и legacy) и сохраняет
+    его в кэш вместо FORBIDDEN_TOO_MANY. Выполняется в фоне, без ограничения времени запроса.
+
+    :param application: приложение
+    :param post_id: идентификатор поста
+    :param legacy: запреты из поля forbidden_for поста
+    :param generation: счетчик запретов на момент начала загрузки
+    """
+    query = {"post_id": post_id}
+    count = yield application.motor.forbidden_users.count(query)
+    # запас емкости для запретов, добавляемых forbid_user до истечения записи кэша
+    bloom = BloomFilter(count + len(legacy) + application.settings["forbidden_cache_max_users"])
+    bloom.update(legacy)
+    cursor = application.motor.forbidden_users.find(query, {"user_id": True, "_id": False}, batch_size=10000)
+    while (yield cursor.fetch_next):
+      bloom.add(cursor.next_object()["user_id"])
+    if generation == application.forbidden_generation:
+      application.forbidden_cache.set(post_id, bloom)
+
+  @gen.coroutine
+  def embed_comments(self, comments):
+    """
+    Метод обновляет посты записанных комментариев (см. RestApplication.embed_comments). Обновление выполняется
+    без ограничения времени запроса: запись уже выполнена, поэтому истекший deadline или закрытое клиентом
+    соединение не должны оставить счетчик комментариев неверным.
+
+    :param comments: документы записанных комментариев
+    """
+    with self.phase("mongo posts.bulk_write"):
+      yield self.application.embed_comments(comments)
+
+  def fan_out_posts(self, posts):
+    """
+    Метод добавляет созданные посты в ленты подписчиков их авторов (utils.timelines) в фоне: ответ клиенту
+    не ждет обновления лент
+
+    :param posts: документы созданных постов
+    """
+    if not posts:
+      return
+    self.application.run_background(fan_out_background(self.application.motor, posts, self.settings["timeline_size"],
+                                                       self.settings["timeline_fanout_batch"],
+                                                       self.settings["timeline_popular_threshold"]))
+
   @gen.coroutine
   def get_users_by_id(self, user_id):
     """
-    Функция возвращает информацию о пользователях из БД по их идентификаторам
+    Функция возвращает информацию о пользователях по их идентификаторам. Сначала пользователи ищутся в кэше
+    приложения, отсутствующие в нем запрашиваются из БД одним запросом и сохраняются в кэш
 
     :param user_id: идентификаторы пользователей
     :return: информация о пользователях в формате bson
     """
     if not user_id:
-      raise gen.Return([])
-    r = self.motor.users.find({"_id": {"$in": [ObjectId(_id) for _id in tolist(user_id)]}})
-    users = yield r.to_list(len(tolist(user_id)))
-    raise gen.Return(dict(
-      ((user["_id"], user) for user in users)
-    ))
+      raise gen.Return({})
+    ids = set(ObjectId(_id) for _id in tolist(user_id))
+    with self.phase("users"):
+      users, missed = self.user_cache.get_many(ids)
+      if missed:
+        r = self.motor_read.users.find({"_id": {"$in": missed}})
+        docs = yield r.to_list(len(missed))
+        for user in docs:
+          self.user_cache.set(user["_id"], user)
+          users[user["_id"]] = user
+    raise gen.Return(users)
 
   @gen.coroutine
   def get_user_by_id(self, user_id):
     """
-    Функция возвращает информацию о пользователе из БД по идентификатору.
+    Функция возвращает информацию о пользователе по идентификатору (с использованием кэша пользователей).
 
     :param user_id: идентификатор пользователя
     :return: информация о пользователе в формате bson
     """
     if not user_id:
       raise gen.Return(None)
-    r = yield self.motor.users.find_one({"_id": ObjectId(user_id)})
-    raise gen.Return(r)
+    users = yield self.get_users_by_id([user_id])
+    raise gen.Return(users.get(ObjectId(user_id)))
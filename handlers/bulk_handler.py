@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import json
+import logging
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from tornado import gen
+from tornado.web import HTTPError, stream_request_body
+
+from handlers.base_handler import BaseHandler
+from handlers.user_handler import username_rule
+from utils.data_utils import now_aware, tolist
+from utils.tag_stats import count_tags
+
+logger = logging.getLogger(__name__)
+
+
+class ValidationError(ValueError):
+  pass
+
+
+@stream_request_body
+class BulkHandler(BaseHandler):
+  """
+  Хэндлер отвечает за пакетное создание пользователей, постов и комментариев.
+  Тело запроса - JSON-массив объектов, либо NDJSON (Content-Type: application/x-ndjson, по объекту на строку).
+  NDJSON обрабатывается по мере получения: объекты проверяются и записываются пачками (insert_many, ordered=False),
+  поэтому тело запроса целиком в памяти не хранится.
+  Поля объектов совпадают с параметрами одиночных методов:
+    /bulk/users - username
+    /bulk/posts - user, title, text, tags
+    /bulk/comments - user, post_id, text
+  Ответ - список {"index": номер объекта, "_id": идентификатор} или {"index": номер объекта, "error": описание}
+  """
+
+  # загрузка длится, пока передается тело запроса, поэтому время обработки не ограничивается
+  use_deadline = False
+
+  def prepare(self):
+    # тело запроса читается только после того, как запрос допущен контролем нагрузки
+    admitted = super(BulkHandler, self).prepare()
+    self._type = self.path_args[0] if self.path_args else None
+    if self.request.method != "POST" or self._type not in ("users", "posts", "comments"):
+      raise HTTPError(404)
+    self.request.connection.set_max_body_size(self.settings["bulk_max_body_size"])
+    content_type = self.request.headers.get("Content-Type", "")
+    self._ndjson = "ndjson" in content_type
+    # NDJSON: неполная последняя строка; JSON-массив: полученные части тела (склеиваются один раз в post)
+    self._buffer = b""
+    self._chunks = []
+    self._size = 0
+    self._index = 0
+    self._pending = []
+    self._results = []
+    self._too_large = False
+    return admitted
+
+  def _add_line(self, line):
+    """
+    Метод разбирает одну строку NDJSON и добавляет объект в очередь записи
+
+    :param line: строка
+    """
+    line = line.strip()
+    if not line:
+      return
+    index = self._index
+    self._index += 1
+    try:
+      self._pending.append((index, json.loads(line)))
+    except ValueError:
+      self._results.append({"index": index, "error": "Invalid JSON"})
+
+  @gen.coroutine
+  def data_received(self, chunk):
+    if self._too_large:
+      return
+    if not self._ndjson:
+      self._size += len(chunk)
+      self._chunks.append(chunk)
+      if self._size > self.settings["bulk_max_array_size"]:
+        self._too_large = True
+        self._chunks = []
+      return
+    lines = (self._buffer + chunk).split(b"\n")
+    self._buffer = lines.pop()
+    for line in lines:
+      self._add_line(line)
+    # пока идет запись, чтение тела запроса приостанавливается
+    while len(self._pending) >= self.settings["bulk_chunk_size"]:
+      yield self._flush(self.settings["bulk_chunk_size"])
+
+  @gen.coroutine
+  def post(self, _type):
+    if self._too_large:
+      raise HTTPError(413, "JSON array is too large, use NDJSON")
+    if self._ndjson:
+      self._add_line(self._buffer)
+    else:
+      try:
+        items = json.loads(b"".join(self._chunks) or "[]")
+      except ValueError:
+        raise HTTPError(400, "Invalid JSON")
+      if not isinstance(items, list):
+        raise HTTPError(400, "JSON array is expected")
+      self._pending = list(enumerate(items))
+    self._buffer = b""
+    self._chunks = []
+    while self._pending:
+      yield self._flush(self.settings["bulk_chunk_size"])
+    self.write_json(sorted(self._results, key=lambda result: result["index"]))
+
+  @gen.coroutine
+  def _flush(self, size):
+    """
+    Метод проверяет и записывает в БД очередную пачку объектов
+
+    :param size: максимальный размер пачки
+    """
+    chunk, self._pending = self._pending[:size], self._pending[size:]
+    make_doc = {
+      "users": self._make_user,
+      "posts": self._make_post,
+      "comments": self._make_comment
+    }[self._type]
+    docs = []
+    for index, item in chunk:
+      try:
+        if not isinstance(item, dict):
+          raise ValidationError("Object is expected")
+        doc = yield make_doc(item)
+        docs.append((index, doc))
+      except (ValidationError, HTTPError) as e:
+        self._results.append({"index": index, "error": getattr(e, "log_message", None) or str(e)})
+      except Exception:
+        self._results.append({"index": index, "error": "Invalid object"})
+    if self._type == "users":
+      docs = yield self._filter_existing_users(docs)
+    yield self._insert(docs)
+
+  @gen.coroutine
+  def _insert(self, docs):
+    """
+    Метод записывает документы одним неупорядоченным insert_many и сохраняет результат по каждому объекту
+
+    :param docs: список пар (номер объекта, документ)
+    """
+    if not docs:
+      return
+    failed = {}
+    try:
+      with self.phase("mongo %s.insert_many" % self._type):
+        yield self.motor[self._type].insert_many([doc for _, doc in docs], ordered=False)
+    except BulkWriteError as e:
+      for error in e.details.get("writeErrors", []):
+        failed[error["index"]] = error.get("errmsg", "Write error")
+    if self._type == "posts":
+      posts = [doc for position, (_, doc) in enumerate(docs) if position not in failed]
+      with self.phase("mongo tag_counts.bulk_write"):
+        yield count_tags(self.motor, posts)
+      self.invalidate(("tags", "*"))
+      self.fan_out_posts(posts)
+    elif self._type == "comments":
+      yield self.embed_comments([doc for position, (_, doc) in enumerate(docs) if position not in failed])
+    for position, (index, doc) in enumerate(docs):
+      if position in failed:
+        self._results.append({"index": index, "error": failed[position]})
+        continue
+      self._results.append({"index": index, "_id": doc["_id"]})
+      if self._type == "users":
+        self.user_cache.set(doc["_id"], doc)
+      elif self._type == "posts":
+        self.invalidate(("posts", "*"), ("user", doc["user_id"]), *[("tag", tag) for tag in tolist(doc["tags"])])
+      else:
+        self.invalidate(("post", doc["post_id"]))
+
+  @gen.coroutine
+  def _filter_existing_users(self, docs):
+    """
+    Метод отбрасывает пользователей, имена которых уже заняты (в БД или ранее в этой же пачке)
+
+    :param docs: список пар (номер объекта, документ пользователя)
+    :return: список пар для записи
+    """
+    names = [doc["username"] for _, doc in docs]
+    r = self.motor.users.find({"username": {"$in": names}}, {"username": True, "_id": False})
+    with self.phase("mongo users.find"):
+      users = yield r.to_list(len(names))
+    existing = set(user["username"] for user in users)
+    result = []
+    for index, doc in docs:
+      if doc["username"] in existing:
+        self._results.append({"index": index, "error": "Username already used"})
+        continue
+      existing.add(doc["username"])
+      result.append((index, doc))
+    raise gen.Return(result)
+
+  @gen.coroutine
+  def _make_user(self, item):
+    username = item.get("username")
+    if not isinstance(username, basestring) or not username_rule.match(username):
+      raise ValidationError("Username must contain only latin characters and numbers")
+    raise gen.Return({"username": username})
+
+  @gen.coroutine
+  def _make_post(self, item):
+    if not item.get("user") or not item.get("title"):
+      raise ValidationError("Fields user and title are required")
+    raise gen.Return({
+      "user_id": ObjectId(item["user"]),
+      "tags": item.get("tags") or [],
+      "text": item.get("text") or u"",
+      "title": item["title"],
+      "post_date": now_aware()
+    })
+
+  @gen.coroutine
+  def _make_comment(self, item):
+    if not item.get("user") or not item.get("post_id") or not item.get("text"):
+      raise ValidationError("Fields user, post_id and text are required")
+    user_id = ObjectId(item["user"])
+    post_id = ObjectId(item["post_id"])
+    is_forbid = yield self.check_forbid_status(user_id, post_id)
+    if is_forbid:
+      raise ValidationError("Forbid to send comments in this post")
+    raise gen.Return({
+      "user_id": user_id,
+      "text": item["text"],
+      "post_id": post_id,
+      "comment_date": now_aware()
+    })
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+from handlers.base_handler import BaseHandler
+
+
+class MetricsHandler(BaseHandler):
+  """
+  Хэндлер отдает метрики приложения в текстовом формате Prometheus
+  /metrics
+  """
+  admission_control = False
+
+  def get(self):
+    self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    self.finish(self.application.metrics.render())
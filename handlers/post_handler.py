@@ -2,13 +2,18 @@
 __author__ = 'vatyakshin'
 
 import logging
+from datetime import datetime
 
 from bson import ObjectId
+from pymongo import UpdateOne
 from tornado import gen
 from tornado.web import asynchronous, HTTPError
 
 from handlers.base_handler import BaseHandler
 from utils.data_utils import now_aware, tolist, todate
+from utils.cache import BloomFilter
+from utils.pagination import encode_cursor
+from utils.tag_stats import count_tags
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +33,8 @@ class PostHandler(BaseHandler):
     2) tags - набор тегов данного поста
     3) text - текст поста
     4) title - заголовок поста
+    Счетчики постов по тегам (utils.tag_stats) увеличиваются после записи поста, в ленты подписчиков автора
+    (utils.timelines) пост добавляется в фоне.
 
     :return: _id созданного документа в БД (в случае успеха)
     """
@@ -36,29 +43,20 @@ class PostHandler(BaseHandler):
     text = self.get_argument("text", u"")
     title = self.get_argument("title")
     post_date = now_aware()
-    r = yield self.motor.posts.insert({"user_id": ObjectId(user),
-                                           "tags": tags,
-                                           "text": text,
-                                           "title": title,
-                                           "post_date": post_date,
-                                           "forbidden_for": []
-                                           })
+    post = {"user_id": ObjectId(user),
+            "tags": tags,
+            "text": text,
+            "title": title,
+            "post_date": post_date
+            }
+    with self.phase("mongo posts.insert"):
+      r = yield self.motor.posts.insert(post)
+    with self.phase("mongo tag_counts.bulk_write"):
+      yield count_tags(self.motor, [post])
+    self.fan_out_posts([post])
+    self.invalidate(("posts", "*"), ("tags", "*"), ("user", ObjectId(user)), *[("tag", tag) for tag in tolist(tags)])
     self.finish(str(r))
 
-  @gen.coroutine
-  def _check_forbid_status(self, user_id, post_id):
-    """
-    Функция проверяет, может ли пользователь с идентификатором user_id оставлять сообщения в посте post_id
-
-    :param user_id: идентификатор пользователя
-    :param post_id: идентификатор поста
-    :return: True, если пользователь не может оставлять комментарии, иначе False
-    """
-    post = yield self.motor.posts.find_one({"_id": ObjectId(post_id)})
-    if user_id in post.get("forbidden_for") or []:
-      raise gen.Return(True)
-    raise gen.Return(False)
-
   @asynchronous
   @gen.coroutine
   def create_comment(self):
@@ -67,6 +65,10 @@ class PostHandler(BaseHandler):
       1) user - _id пользователя
       2) text - текст комментария
       3) post_id - идентификатор поста, к которому пишут комментарий
+    При настройке comment_write_mode flush/enqueue комментарий записывается через буфер отложенной записи
+    (ответ отправляется после записи пачки или сразу после постановки в буфер соответственно).
+    В посте увеличивается счетчик комментариев и обновляется список последних комментариев (см.
+    RestApplication.embed_comments; в режимах flush/enqueue - при записи пачки буфером).
 
     :return: _id созданного документа
     """
@@ -74,30 +76,52 @@ class PostHandler(BaseHandler):
     text = self.get_argument("text")
     post_id = ObjectId(self.get_argument("post_id"))
     comment_date = now_aware()
-    is_forbid = yield self._check_forbid_status(user, post_id)
+    is_forbid = yield self.check_forbid_status(user, post_id)
     if is_forbid:
       raise HTTPError(503, "Forbid to send comments in this post")
-    r = yield self.motor.comments.insert({
+    comment = {
       "user_id": ObjectId(user),
       "text": text,
       "post_id": ObjectId(post_id),
       "comment_date": comment_date
-    })
+    }
+    if self.comment_buffer is not None:
+      comment["_id"] = ObjectId()
+      with self.phase("comment buffer"):
+        yield self.comment_buffer.put(comment, wait_flush=self.settings["comment_write_mode"] == "flush")
+      r = comment["_id"]
+    else:
+      with self.phase("mongo comments.insert"):
+        r = yield self.motor.comments.insert(comment)
+      yield self.embed_comments([comment])
+    self.invalidate(("post", post_id))
     self.finish(str(r))
 
   @asynchronous
   @gen.coroutine
   def forbid_user(self):
     """
-    Метод указывает в информации о посте (post_id) пользователей, переданных в параметре запроса users, которые не будут
-    иметь прав писать комментарии.
+    Метод сохраняет в коллекции forbidden_users пары (post_id, user_id) для пользователей, переданных в параметре
+    запроса users, которые не будут иметь прав писать комментарии в посте post_id.
 
     :return: количество пользователей, переданных в users
     """
-    users = self.get_argument_json("users", [])
-    post_id = self.get_argument("post_id")
-    yield self.motor.posts.update({"_id": ObjectId(post_id)}, {"$push": {"forbidden_for": {"$each": tolist(users)}}})
-    self.finish(str(len(tolist(users))))
+    users = [ObjectId(user) for user in tolist(self.get_argument_json("users", []))]
+    post_id = ObjectId(self.get_argument("post_id"))
+    if users:
+      with self.phase("mongo forbidden_users.bulk_write"):
+        yield self.motor.forbidden_users.bulk_write([
+          UpdateOne({"post_id": post_id, "user_id": user}, {"$setOnInsert": {"post_id": post_id, "user_id": user}},
+                    upsert=True)
+          for user in users
+        ], ordered=False)
+      # загрузка набора запретов, выполняющаяся сейчас в другом запросе, не сохранит устаревший набор в кэш
+      self.application.forbidden_generation += 1
+      forbidden = self.forbidden_cache.get(post_id, count=False)
+      if isinstance(forbidden, (set, BloomFilter)):
+        forbidden.update(users)
+      self.invalidate(("post", post_id))
+    self.finish(str(len(users)))
 
 
   @asynchronous
@@ -105,33 +129,77 @@ class PostHandler(BaseHandler):
   def get_post(self):
     """
     Метод по post_id (передаваемому в параметрах) получает пост из БД и меняет (при возможности) идентификатор
-    пользователя на его имя
+    пользователя на его имя. Ответы кэшируются (Etag, If-None-Match), см. BaseHandler.serve_cached
+    with_comments=N - вернуть вместе с постом N последних комментариев (поле comments, от новых к старым) из
+    списка, хранящегося в самом посте (не более настройки post_latest_comments). Более старые комментарии
+    запрашиваются через get_comments с токеном из заголовка X-Next-Cursor.
 
     :return:
     """
     post_id = self.get_argument("post_id")
-    post = yield self.motor.posts.find_one({"_id": ObjectId(post_id)})
+    with_comments = int(self.get_argument("with_comments", 0))
+    if self.serve_cached(("post", ObjectId(post_id))):
+      return
+    if with_comments > 0:
+      projection = {"latest_comments": {"$slice": -with_comments}}
+    else:
+      projection = {"latest_comments": False}
+    with self.phase("mongo posts.find_one"):
+      post = yield self.motor_read.posts.find_one({"_id": ObjectId(post_id)}, projection)
     if not post:
       raise HTTPError(404, "There is no post with this _id")
     if "user_id" in post:
       user_id = post.pop("user_id")
-      user = yield self.get_user_by_id(user_id) or {}
+      user = (yield self.get_user_by_id(user_id)) or {}
       post["username"] = user.get("username", u"")
+    if with_comments > 0:
+      comments = post.pop("latest_comments", None)
+      if comments is not None:
+        comments.reverse()
+      elif post.get("comment_count") == 0:
+        comments = []
+      else:
+        # список последних комментариев не ведется (пост создан до его появления, post_latest_comments = 0):
+        # комментарии запрашиваются из коллекции comments, счетчик - если его нет (см. --rebuild_comment_counts)
+        query = {"post_id": post["_id"]}
+        sort = [("comment_date", -1), ("_id", -1)]
+        if "comment_count" in post:
+          comments = yield self._get_comments(query, sort, limit=with_comments)
+        else:
+          comments, post["comment_count"] = yield [
+            self._get_comments(query, sort, limit=with_comments),
+            self.motor_read.comments.count(query)
+          ]
+      post["comments"] = comments
+      if comments and len(comments) < post["comment_count"]:
+        self.set_header("X-Next-Cursor", encode_cursor(comments[-1], "comment_date"))
     self.write_json(post)
 
-  @gen.coroutine
-  def _get_comments(self, query, sort, skip=0, limit=10):
+  def _find_comments(self, query, sort, skip=0, limit=10):
     """
-    Метод запрашивает данные из MongoDB.
+    Метод создает курсор запроса комментариев к MongoDB.
 
     :param query: запрос в виде словаря, который поддерживается MongoDB.
-    :param sort: информация о сортировке в формате MongoDB
+    :param sort: информация о сортировке в формате MongoDB (список пар)
     :param skip: сколько документов нужно предварительно пропустить (пагинация)
     :param limit: сколько всего документов показывать (пагинация)
-    :return: документы - результат запроса
+    :return: курсор
+    """
+    if self.listing_engine == "aggregate":
+      return self.aggregate_with_usernames("comments", query, sort, skip=skip, limit=limit, exclude=("post_id",))
+    r = self.motor_read.comments.find(query).sort(sort).limit(limit).skip(skip)
+    return r.batch_size(min(limit, self.settings["stream_batch_size"]))
+
+  @gen.coroutine
+  def _prepare_comments(self, docs):
     """
-    r = self.motor.comments.find(query).sort(sort.items()).limit(limit).skip(skip)
-    docs = yield r.to_list(limit)
+    Метод приводит комментарии к виду, в котором они возвращаются API (имя пользователя вместо user_id)
+
+    :param docs: документы из БД
+    :return: документы
+    """
+    if self.listing_engine == "aggregate":
+      raise gen.Return(docs)
     # получаем данные по пользователям, чтобы вернуть в запросе их имена
     users = yield self.get_users_by_id([doc["user_id"] for doc in docs])
     for doc in docs:
@@ -139,20 +207,52 @@ class PostHandler(BaseHandler):
       user_id = doc.pop("user_id")
       if user_id in users:
         doc["username"] = users[user_id]["username"]
-      if "comment_date" in doc:
+      # даты из БД уже datetime, преобразуются только значения других типов
+      if "comment_date" in doc and doc["comment_date"].__class__ is not datetime:
         doc["comment_date"] = todate(doc["comment_date"])
     raise gen.Return(docs)
 
+  @gen.coroutine
+  def _get_comments(self, query, sort, skip=0, limit=10):
+    """
+    Метод запрашивает данные из MongoDB.
+
+    :param query: запрос в виде словаря, который поддерживается MongoDB.
+    :param sort: информация о сортировке в формате MongoDB (список пар)
+    :param skip: сколько документов нужно предварительно пропустить (пагинация)
+    :param limit: сколько всего документов показывать (пагинация)
+    :return: документы - результат запроса
+    """
+    with self.phase("mongo comments.find"):
+      docs = yield self._find_comments(query, sort, skip=skip, limit=limit).to_list(limit)
+    docs = yield self._prepare_comments(docs)
+    raise gen.Return(docs)
+
   @asynchronous
   @gen.coroutine
   def get_comments(self):
+    """
+    Метод получает комментарии к посту post_id. Пагинация: skip/limit, либо cursor - токен из заголовка
+    X-Next-Cursor предыдущего ответа. Потоковая выдача: stream=json или stream=ndjson (либо
+    Accept: application/x-ndjson), токен следующей страницы при этом не передается
+
+    :return: список комментариев
+    """
     post_id = self.get_argument("post_id")
     sorting = int(self.get_argument("sorting", -1))
     skip = int(self.get_argument("skip", 0))
     limit = int(self.get_argument("limit", 10))
     query = {"post_id": ObjectId(post_id)}
-    sorting = {"comment_date": sorting} if sorting else {}
-    comments = yield self._get_comments(query, sorting, skip=skip, limit=limit)
+    field = "comment_date" if sorting else None
+    query, sort, has_cursor = self.get_keyset(query, field, sorting)
+    skip = 0 if has_cursor else skip
+    stream = self.get_stream_mode()
+    if stream:
+      cursor = self._find_comments(query, sort, skip=skip, limit=limit)
+      yield self.write_json_stream(cursor, self._prepare_comments, ndjson=stream == "ndjson")
+      return
+    comments = yield self._get_comments(query, sort, skip=skip, limit=limit)
+    self.set_next_cursor(comments, field, limit)
     self.write_json(comments)
 
   def post(self, _type):
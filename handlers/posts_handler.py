@@ -3,13 +3,18 @@ __author__ = 'vatyakshin'
 
 import re
 import logging
+from datetime import datetime, timedelta
 
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
 from tornado import gen
 from tornado.web import asynchronous, HTTPError
 
-from handlers.base_handler import BaseHandler
-from utils.data_utils import tolist, todate
+from handlers.base_handler import BaseHandler, LISTING_EXCLUDED_FIELDS
+from utils.data_utils import now_aware, tolist, todate
+from utils.pagination import decode_cursor, encode_cursor
+from utils.tag_stats import day_of, get_tag_counts
+from utils.timelines import popular_authors, merge_entries
 
 logger = logging.getLogger(__name__)
 
@@ -18,29 +23,92 @@ class PostsHandler(BaseHandler):
   Хэндлер отвечает за получение постов пользователей (с применением фильтров, сортировок)
   /posts
   """
-  @gen.coroutine
-  def _get_posts(self, query, sort, skip=0, limit=10):
+  def _find_posts(self, query, sort, skip=0, limit=10, projection=None):
     """
-    Метод запрашивает данные из MongoDB.
+    Метод создает курсор запроса постов к MongoDB.
 
     :param query: запрос в виде словаря, который поддерживается MongoDB.
-    :param sort: информация о сортировке в формате MongoDB
+    :param sort: информация о сортировке в формате MongoDB (список пар)
     :param skip: сколько документов нужно предварительно пропустить (пагинация)
     :param limit: сколько всего документов показывать (пагинация)
-    :return: документы - результат запроса
+    :param projection: проекция полей в формате MongoDB (в режиме aggregate - вычисляемые поля)
+    :return: курсор
+    """
+    if self.listing_engine == "aggregate":
+      return self.aggregate_with_usernames("posts", query, sort, skip=skip, limit=limit,
+                                           exclude=LISTING_EXCLUDED_FIELDS, add_fields=projection)
+    projection = dict(projection or {}, **dict((field, False) for field in LISTING_EXCLUDED_FIELDS))
+    r = self.motor_read.posts.find(query, projection).sort(sort).limit(limit).skip(skip)
+    return r.batch_size(min(limit, self.settings["stream_batch_size"]))
+
+  @gen.coroutine
+  def _prepare_posts(self, docs):
+    """
+    Метод приводит посты к виду, в котором они возвращаются API (имя пользователя вместо user_id)
+
+    :param docs: документы из БД
+    :return: документы
+    """
+    if self.listing_engine == "aggregate":
+      raise gen.Return(docs)
+    docs = yield self._add_usernames(docs)
+    raise gen.Return(docs)
+
+  @gen.coroutine
+  def _add_usernames(self, docs):
+    """
+    Метод заменяет user_id постов на имена пользователей
+
+    :param docs: документы из БД
+    :return: документы
     """
-    r = self.motor.posts.find(query).sort(sort.items()).limit(limit).skip(skip)
-    docs = yield r.to_list(limit)
     # получаем данные по пользователям, чтобы вернуть в запросе их имена
     users = yield self.get_users_by_id([doc["user_id"] for doc in docs])
     for doc in docs:
       user_id = doc.pop("user_id")
       if user_id in users:
         doc["username"] = users[user_id]["username"]
-      if "post_date" in doc:
+      # даты из БД уже datetime, преобразуются только значения других типов
+      if "post_date" in doc and doc["post_date"].__class__ is not datetime:
         doc["post_date"] = todate(doc["post_date"])
     raise gen.Return(docs)
 
+  @gen.coroutine
+  def _get_posts(self, query, sort, skip=0, limit=10, projection=None):
+    """
+    Метод запрашивает данные из MongoDB.
+
+    :param query: запрос в виде словаря, который поддерживается MongoDB.
+    :param sort: информация о сортировке в формате MongoDB (список пар)
+    :param skip: сколько документов нужно предварительно пропустить (пагинация)
+    :param limit: сколько всего документов показывать (пагинация)
+    :param projection: проекция полей в формате MongoDB (в режиме aggregate - вычисляемые поля)
+    :return: документы - результат запроса
+    """
+    with self.phase("mongo posts.find"):
+      docs = yield self._find_posts(query, sort, skip=skip, limit=limit, projection=projection).to_list(limit)
+    docs = yield self._prepare_posts(docs)
+    raise gen.Return(docs)
+
+  @gen.coroutine
+  def _write_posts(self, query, sort, skip=0, limit=10, projection=None, field=None, next_cursor=True):
+    """
+    Метод отправляет клиенту посты по запросу: целиком (с токеном следующей страницы в X-Next-Cursor), либо
+    потоком, если это запрошено (см. BaseHandler.get_stream_mode; токен следующей страницы при этом не передается)
+
+    :param field: поле даты, по которому идет сортировка (для токена следующей страницы)
+    :param next_cursor: передавать ли токен следующей страницы
+    """
+    stream = self.get_stream_mode()
+    if stream:
+      cursor = self._find_posts(query, sort, skip=skip, limit=limit, projection=projection)
+      yield self.write_json_stream(cursor, self._prepare_posts, ndjson=stream == "ndjson")
+      return
+    docs = yield self._get_posts(query, sort, skip=skip, limit=limit, projection=projection)
+    if next_cursor:
+      self.set_next_cursor(docs, field, limit)
+    self.write_json(docs)
+
   @asynchronous
   @gen.coroutine
   def get_posts_by_user(self):
@@ -49,17 +117,22 @@ class PostsHandler(BaseHandler):
       -1 по убыванию
       1 - по возрастанию
       0 (или не присылать) - без сортировки
+    Пагинация: skip/length, либо cursor - токен из заголовка X-Next-Cursor предыдущего ответа
+    Потоковая выдача: stream=json или stream=ndjson (либо Accept: application/x-ndjson)
+    Ответы кэшируются (Etag, If-None-Match), см. BaseHandler.serve_cached
 
     :return: список документов пользователя, при указании отсортированные
     """
     user = self.get_argument("user")
+    if self.serve_cached(("user", ObjectId(user))):
+      return
     sorting = int(self.get_argument("sorting", -1))
     skip = int(self.get_argument("skip", 0))
     limit = int(self.get_argument("length", 10))
-    sorting = {"post_date": sorting} if sorting else {}
+    field = "post_date" if sorting else None
     query = {"user_id": ObjectId(user)}
-    docs = yield self._get_posts(query, sorting, skip=skip, limit=limit)
-    self.write_json(docs)
+    query, sort, has_cursor = self.get_keyset(query, field, sorting)
+    yield self._write_posts(query, sort, skip=0 if has_cursor else skip, limit=limit, field=field)
 
   @asynchronous
   @gen.coroutine
@@ -67,26 +140,42 @@ class PostsHandler(BaseHandler):
     """
     Метод запрашивает данные по постам пользователей. Используются следующие фильтры:
       tags - набор тегов
+      tags_mode - any (по умолчанию) - посты с любым из тегов, all - посты со всеми тегами (первым в запросе
+        ставится тег с наименьшим количеством постов по счетчикам тегов)
       min_date - минимальная дата публикации
       max_date - максимальная дата публикации
       title - слово или словосочетание, которое надо искать в заголовках постов
+      title_mode - способ поиска по заголовку:
+        regex - поиск подстроки без учета регистра (полный просмотр постов)
+        text - поиск фразы по текстовому индексу заголовков
+        по умолчанию используется настройка приложения title_search
     Настройки сортировки по дате публикации:
       -1 по убыванию
       1 - по возрастанию
-      0 (или не присылать) - без сортировки
+      0 (или не присылать) - без сортировки (при поиске text - по релевантности, поле score)
+    Пагинация: skip/length, либо cursor - токен из заголовка X-Next-Cursor предыдущего ответа
+    Потоковая выдача: stream=json или stream=ndjson (либо Accept: application/x-ndjson)
+    Ответы кэшируются (Etag, If-None-Match), см. BaseHandler.serve_cached
 
     :return: список документов по запросу, при указании отфильтрованные
     """
     tags = self.get_argument_json("tags", [])
+    tags_mode = self.get_argument("tags_mode", "any")
     min_date = self.get_argument("min_date", None)
     max_date = self.get_argument("max_date", None)
     title_query = self.get_argument("title", "")
+    title_mode = self.get_argument("title_mode", self.settings["title_search"])
     sorting = int(self.get_argument_json("sorting", -1))
     skip = int(self.get_argument("skip", 0))
     limit = int(self.get_argument("length", 10))
+    # новые посты попадают во все выборки без фильтра по тегам, а в выборки с фильтром - только по своим тегам
+    if self.serve_cached(*([("tag", tag) for tag in tolist(tags)] or [("posts", "*")])):
+      return
 
     query = {}
-    if tags:
+    if tags and tags_mode == "all":
+      query["tags"] = {"$all": (yield self._order_tags(tolist(tags)))}
+    elif tags:
       query["tags"] = {"$in": tolist(tags)}
     query_date = {}
     if min_date:
@@ -95,17 +184,136 @@ class PostsHandler(BaseHandler):
       query_date["$lte"] = todate(max_date)
     if query_date:
       query["post_date"] = query_date
-    if title_query:
+    if title_query and title_mode == "text":
+      query["$text"] = {"$search": u'"%s"' % title_query.replace(u'"', u" ")}
+      if not sorting:
+        # сортировка по релевантности не поддерживает cursor, используется skip
+        yield self._write_posts(query, [("score", {"$meta": "textScore"})], skip=skip, limit=limit,
+                                projection={"score": {"$meta": "textScore"}}, next_cursor=False)
+        return
+    elif title_query:
       query["title"] = re.compile(u"%s" % re.escape(title_query), re.IGNORECASE)
 
-    sorting = {"post_date": sorting} if sorting else {}
-    docs = yield self._get_posts(query, sorting, skip=skip, limit=limit)
+    field = "post_date" if sorting else None
+    query, sort, has_cursor = self.get_keyset(query, field, sorting)
+    yield self._write_posts(query, sort, skip=0 if has_cursor else skip, limit=limit, field=field)
+
+  @asynchronous
+  @gen.coroutine
+  def get_timeline(self):
+    """
+    Метод возвращает ленту подписок пользователя user - посты авторов, на которых он подписан, от новых к старым
+    (см. utils.timelines): записи из его ленты и посты популярных авторов, которые в ленты не добавляются
+      length - размер страницы (по умолчанию 10)
+    Пагинация: cursor - токен из заголовка X-Next-Cursor предыдущего ответа
+
+    :return: список постов
+    """
+    user = ObjectId(self.get_argument("user"))
+    limit = int(self.get_argument("length", 10))
+    with self.phase("mongo timelines.find_one"):
+      timeline, popular = yield [self.motor_read.timelines.find_one({"_id": user}), self._popular_followees(user)]
+    query, sort, has_cursor = self.get_keyset({"user_id": {"$in": list(popular)}}, "post_date", -1)
+    entries = timeline["entries"] if timeline else []
+    if has_cursor:
+      last = decode_cursor(self.get_argument("cursor"))
+      entries = [entry for entry in entries if (entry["post_date"], entry["_id"]) < last]
+    projection = dict((field, False) for field in LISTING_EXCLUDED_FIELDS)
+    posts = []
+    if popular:
+      with self.phase("mongo posts.find"):
+        posts = yield self.motor_read.posts.find(query, projection).sort(sort).limit(limit).to_list(limit)
+    page = merge_entries(posts, entries[:limit], limit)
+    found = dict((doc["_id"], doc) for doc in posts)
+    missed = [entry["_id"] for entry in page if entry["_id"] not in found]
+    if missed:
+      with self.phase("mongo posts.find"):
+        docs = yield self.motor_read.posts.find({"_id": {"$in": missed}}, projection).to_list(len(missed))
+      found.update((doc["_id"], doc) for doc in docs)
+    if len(page) >= limit:
+      self.set_header("X-Next-Cursor", encode_cursor(page[-1], "post_date"))
+    docs = yield self._add_usernames([found[entry["_id"]] for entry in page if entry["_id"] in found])
     self.write_json(docs)
 
+  @gen.coroutine
+  def _popular_followees(self, user):
+    """
+    Метод возвращает популярных авторов, на которых подписан пользователь (их посты читаются при чтении ленты)
+
+    :param user: _id пользователя
+    :return: множество _id авторов
+    """
+    threshold = self.settings["timeline_popular_threshold"]
+    if not threshold:
+      raise gen.Return(set())
+    docs = yield self.motor_read.follows.find({"follower": user}, {"_id": False, "followee": True}).to_list(None)
+    popular = yield popular_authors(self.motor_read, [doc["followee"] for doc in docs], threshold)
+    raise gen.Return(popular)
+
+  @gen.coroutine
+  def _order_tags(self, tags):
+    """
+    Метод упорядочивает теги по возрастанию количества постов: индекс (tags, post_date, _id) при запросе $all
+    просматривается по одному тегу, и выгоднее всего начинать с самого редкого
+
+    :param tags: список тегов
+    :return: список тегов
+    """
+    if len(tags) < 2:
+      raise gen.Return(tags)
+    with self.phase("mongo tag_counts.find"):
+      counts = yield get_tag_counts(self.motor_read, [tag for tag in tags if isinstance(tag, basestring)])
+    raise gen.Return(sorted(tags, key=lambda tag: counts.get(tag, 0) if isinstance(tag, basestring) else 0))
+
+  @asynchronous
+  @gen.coroutine
+  def get_tags(self):
+    """
+    Метод возвращает самые популярные теги с количеством постов (по счетчикам utils.tag_stats)
+      limit - количество тегов (по умолчанию 50)
+
+    :return: список {"tag": тег, "count": количество постов}
+    """
+    limit = int(self.get_argument("limit", 50))
+    if self.serve_cached(("tags", "*")):
+      return
+    with self.phase("mongo tag_counts.find"):
+      docs = yield self.motor_read.tag_counts.find().sort([("count", DESCENDING)]).limit(limit).to_list(limit)
+    self.write_json([{"tag": doc["_id"], "count": doc["count"]} for doc in docs])
+
+  @asynchronous
+  @gen.coroutine
+  def get_tag_stats(self):
+    """
+    Метод возвращает количество постов по тегам: всего и по дням
+      tags - набор тегов
+      days - за сколько последних дней вернуть количество по дням (по умолчанию 30)
+
+    :return: словарь тег -> {"count": всего постов, "days": [{"day": дата, "count": постов за день}, ...]}
+    """
+    tags = tolist(self.get_argument_json("tags"))
+    days = int(self.get_argument("days", 30))
+    if not all(isinstance(tag, basestring) for tag in tags):
+      raise HTTPError(400, "Tags must be strings")
+    if self.serve_cached(("tags", "*")):
+      return
+    since = day_of(now_aware()) - timedelta(days=days - 1)
+    r = self.motor_read.tag_counts_daily.find({"tag": {"$in": tags}, "day": {"$gte": since}})
+    with self.phase("mongo tag_counts.find"):
+      counts, docs = yield [get_tag_counts(self.motor_read, tags),
+                            r.sort([("tag", ASCENDING), ("day", ASCENDING)]).to_list(None)]
+    stats = dict((tag, {"count": count, "days": []}) for tag, count in counts.items())
+    for doc in docs:
+      stats[doc["tag"]]["days"].append({"day": doc["day"], "count": doc["count"]})
+    self.write_json(stats)
+
   def get(self, _type):
     types = {
       "by_user": self.get_posts_by_user,
-      "posts": self.get_posts
+      "posts": self.get_posts,
+      "tags": self.get_tags,
+      "tag_stats": self.get_tag_stats,
+      "timeline": self.get_timeline
     }
     if types.get(_type):
       types.get(_type)()
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+from handlers.base_handler import BaseHandler
+
+
+class ReadyHandler(BaseHandler):
+  """
+  Хэндлер проверки готовности для балансировщика: 200 после прогрева приложения (RestApplication.warm_up),
+  до этого и во время остановки - 503
+  /ready
+  """
+  admission_control = False
+
+  def get(self):
+    if not self.application.ready:
+      self.set_status(503)
+    self.write_json({"ready": self.application.ready, "warmup": self.application.warmup})
@@ -1,23 +1,30 @@
 # -*- coding: utf-8 -*-
 __author__ = 'vatyakshin'
 import re
+from bson import ObjectId
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
 from tornado import gen
 from tornado.web import HTTPError, asynchronous
 
 from handlers.base_handler import BaseHandler
+from utils.data_utils import now_aware
+from utils.timelines import popular_authors, push_entries, timeline_entry
 
 username_rule = re.compile(ur"[A-Za-z0-9]+")
 
 class UserHandler(BaseHandler):
   """
-  Хэндлер отвечает за создание и редактирование (задание прав) пользователей в системе
+  Хэндлер отвечает за создание и редактирование (задание прав) пользователей в системе, а также за подписки
+  пользователей друг на друга
   /user
   """
 
   @gen.coroutine
   def _create_user(self, username):
     """
-    Функция создает пользователя, сохраняя его в базе
+    Функция создает пользователя, сохраняя его в базе. Уникальность имени обеспечивает уникальный индекс
+    users.username, поэтому одновременное создание одинаковых имен тоже отклоняется
 
     :param username: имя пользователя
     :return: _id пользователя
@@ -25,10 +32,14 @@ class UserHandler(BaseHandler):
     if not username_rule.match(username):
       raise HTTPError(400, "Username must contain only latin characters and numbers")
 
-    is_exist = yield self.check_if_user_exists(username)
-    if is_exist:
+    user = {"username": username}
+    try:
+      with self.phase("mongo users.insert"):
+        r = yield self.motor.users.insert(user)
+    except DuplicateKeyError:
       raise HTTPError(400, "Username already used")
-    r = yield self.motor.users.insert({"username": username})
+    # имя пользователя после создания не меняется, поэтому сразу кладем его в кэш
+    self.user_cache.set(r, user)
     raise gen.Return(str(r))
 
   @asynchronous
@@ -42,9 +53,90 @@ class UserHandler(BaseHandler):
     r = yield self._create_user(self.get_argument("username"))
     self.finish(r)
 
+  @gen.coroutine
+  def _get_follow_pair(self):
+    """
+    Функция возвращает подписчика (user) и автора (followee) из запроса, проверяя, что оба пользователя существуют
+
+    :return: кортеж (_id подписчика, _id автора)
+    """
+    user = ObjectId(self.get_argument("user"))
+    followee = ObjectId(self.get_argument("followee"))
+    if user == followee:
+      raise HTTPError(400, "User can't follow himself")
+    users = yield self.get_users_by_id([user, followee])
+    if len(users) < 2:
+      raise HTTPError(400, "User not found")
+    raise gen.Return((user, followee))
+
+  @asynchronous
+  @gen.coroutine
+  def follow(self):
+    """
+    Функция подписывает пользователя user на посты пользователя followee. Последние timeline_backfill постов
+    автора сразу добавляются в ленту подписчика (если автор не популярный, см. utils.timelines)
+
+    :return: true - подписка создана, false - подписка уже была
+    """
+    user, followee = yield self._get_follow_pair()
+    try:
+      with self.phase("mongo follows.update"):
+        r = yield self.motor.follows.update_one({"follower": user, "followee": followee},
+                                                {"$setOnInsert": {"follow_date": now_aware()}}, upsert=True)
+      created = r.upserted_id is not None
+    except DuplicateKeyError:
+      # одновременная подписка из другого запроса
+      created = False
+    if created:
+      with self.phase("mongo users.update"):
+        yield self.motor.users.update_one({"_id": followee}, {"$inc": {"followers_count": 1}})
+      yield self._backfill_timeline(user, followee)
+    self.write_json(created)
+
+  @gen.coroutine
+  def _backfill_timeline(self, user, followee):
+    """
+    Функция добавляет последние посты автора в ленту нового подписчика
+
+    :param user: _id подписчика
+    :param followee: _id автора
+    """
+    limit = self.settings["timeline_backfill"]
+    if not limit:
+      return
+    popular = yield popular_authors(self.motor, [followee], self.settings["timeline_popular_threshold"])
+    if popular:
+      return
+    with self.phase("mongo posts.find"):
+      posts = yield self.motor.posts.find({"user_id": followee}, {"user_id": True, "post_date": True}).sort(
+        [("post_date", DESCENDING), ("_id", DESCENDING)]).limit(limit).to_list(limit)
+    if posts:
+      with self.phase("mongo timelines.bulk_write"):
+        yield push_entries(self.motor, [user], [timeline_entry(post) for post in posts], self.settings["timeline_size"])
+
+  @asynchronous
+  @gen.coroutine
+  def unfollow(self):
+    """
+    Функция отменяет подписку пользователя user на посты пользователя followee, посты автора удаляются из ленты
+    подписчика
+
+    :return: true - подписка удалена, false - подписки не было
+    """
+    user, followee = yield self._get_follow_pair()
+    with self.phase("mongo follows.delete"):
+      r = yield self.motor.follows.delete_one({"follower": user, "followee": followee})
+    if r.deleted_count:
+      with self.phase("mongo users.update"):
+        yield [self.motor.users.update_one({"_id": followee}, {"$inc": {"followers_count": -1}}),
+               self.motor.timelines.update_one({"_id": user}, {"$pull": {"entries": {"user_id": followee}}})]
+    self.write_json(bool(r.deleted_count))
+
   def post(self, _type):
     types = {
       "create": self.create_user,
+      "follow": self.follow,
+      "unfollow": self.unfollow,
     }
     if types.get(_type):
       types.get(_type)()
@@ -6,22 +6,54 @@ __author__ = 'vatyakshin'
 # reload(sys)
 # sys.setdefaultencoding("utf-8")
 
+import atexit
+import fcntl
 import logging
+import os
+import random
+import signal
+import socket
 import sys
+import time
+from Queue import Queue
+from collections import deque
+from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 
 from motor import MotorClient
 from os import makedirs
-from os.path import exists, dirname, expandvars
+from os.path import exists, dirname, expandvars, splitext
+from tornado import gen
 from tornado.curl_httpclient import CurlAsyncHTTPClient
 from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.log import access_log
 from tornado.options import define, options
 from tornado.web import Application
 
+from handlers.admin_handler import AdminHandler
+from handlers.bulk_handler import BulkHandler
+from handlers.metrics_handler import MetricsHandler
 from handlers.post_handler import PostHandler
 from handlers.posts_handler import PostsHandler
+from handlers.ready_handler import ReadyHandler
 from handlers.user_handler import UserHandler
+from utils.admission import Admission, parse_limits, parse_rate
+from utils.cache import LRUCache
+from utils.comments import embed_comments, rebuild_comment_counts
+from utils.compression import Compression
+from utils.response_cache import ResponseCache
+from utils.indexes import ensure_indexes, audit_queries
+from utils.log_queue import QueueHandler, QueueListener, ExcludeFilter, dropped_records
+from utils.metrics import Registry, RequestMetrics, CommandTimer, LoopLagMonitor
+from utils.read_routing import read_preference, parse_read_routing
+from utils.tag_stats import rebuild_tag_counts
+from utils.supervisor import Supervisor, notify_ready
+from utils.warmup import open_connections, preload
+from utils.write_buffer import WriteBehindBuffer
+from utils import serializer
 
 logger = logging.getLogger(__name__)
 
@@ -31,22 +63,408 @@ class RestApplication(Application):
   Класс-наследник tornado Application. Настраивает хэндлеры проекта, путь до шаблонов и css, а также создает объект
   MotorClient и сохраняет его в свой атрибут
   """
-  def __init__(self, mongo_host, mongo_port, mongo_db_name, tornado_debug=None):
+  def __init__(self, mongo_host, mongo_port, mongo_db_name, tornado_debug=None, **kwargs):
     """
     Инициализация класса
+
+    :param kwargs: дополнительные настройки приложения (доступны через self.settings)
     """
     handlers = [
       (r"/user/(.*)", UserHandler),
       (r"/post/(.*)", PostHandler),
-      (r"/posts/(.*)", PostsHandler)
+      (r"/posts/(.*)", PostsHandler),
+      (r"/bulk/(.*)", BulkHandler),
+      (r"/metrics", MetricsHandler),
+      (r"/ready", ReadyHandler),
+      (r"/admin/(.*)", AdminHandler)
     ]
     settings = dict(
       title="Test Mail",
       debug=tornado_debug or True,
+      user_cache_size=10000,
+      user_cache_ttl=3600,
+      forbidden_cache_size=1000,
+      forbidden_cache_ttl=10,
+      forbidden_cache_max_users=10000,
+      title_search="regex",
+      listing_engine="find",
+      bulk_chunk_size=1000,
+      bulk_max_array_size=1024 * 1024 * 64,
+      bulk_max_body_size=1024 * 1024 * 1024 * 10,
+      response_cache=True,
+      response_cache_size=10000,
+      response_cache_ttl=60,
+      response_cache_max_age=0,
+      json_backend="auto",
+      stream_batch_size=100,
+      comment_write_mode="direct",
+      comment_buffer_batch=500,
+      comment_buffer_interval=0.05,
+      comment_buffer_size=10000,
+      metrics=True,
+      metrics_lag_interval=0.5,
+      read_preference="primary",
+      read_routing="",
+      read_max_staleness=90,
+      read_your_writes_window=0,
+      read_pool_size=100,
+      write_pool_size=100,
+      mongo_min_pool_size=0,
+      mongo_wait_queue_timeout=0,
+      mongo_connect_timeout=20000,
+      mongo_socket_timeout=0,
+      warmup_posts=1000,
+      warmup_users=1000,
+      warmup_timeout=30,
+      warmup_retry_delay=5,
+      shutdown_drain_delay=5,
+      post_latest_comments=20,
+      timeline_size=500,
+      timeline_fanout_batch=1000,
+      timeline_popular_threshold=10000,
+      timeline_backfill=20,
+      slow_request_threshold=1.0,
+      slow_request_log_size=100,
+      admin_token="",
+      access_log_json=False,
+      access_log_sample=1.0,
+      compression=True,
+      compression_codecs="br,gzip",
+      compression_min_size=1024,
+      compression_level=6,
+      compression_brotli_quality=4,
+      admission_max_in_flight=500,
+      admission_routes="",
+      admission_queue_size=1000,
+      admission_queue_timeout=1.0,
+      rate_limits="",
+      rate_limit_clients=100000,
+      request_timeout=10.0,
+      request_timeouts="",
+      request_timeout_header="X-Request-Timeout",
+      request_timeout_max=60.0,
     )
+    settings.update(kwargs)
     super(RestApplication, self).__init__(handlers, **settings)
-    motor = MotorClient(mongo_host, mongo_port, tz_aware=True)
+    # метрики: запросы по хэндлерам, команды MongoDB (command monitoring), задержка IOLoop
+    self.metrics = Registry()
+    self.request_metrics = None
+    self.loop_monitor = None
+    event_listeners = []
+    if self.settings["metrics"]:
+      self.request_metrics = RequestMetrics(self.metrics)
+      event_listeners.append(CommandTimer(self.metrics))
+      self.loop_monitor = LoopLagMonitor(self.metrics, self.settings["metrics_lag_interval"])
+      self.loop_monitor.start()
+    # запись и чтение с primary идут через self.motor, остальные чтения - через отдельный клиент со своим пулом
+    pool_options = self._pool_options()
+    motor = MotorClient(mongo_host, mongo_port, tz_aware=True, event_listeners=event_listeners,
+                        maxPoolSize=self.settings["write_pool_size"], **pool_options)
     self.motor = motor[mongo_db_name]
+    read_motor = MotorClient(mongo_host, mongo_port, tz_aware=True, event_listeners=event_listeners,
+                             maxPoolSize=self.settings["read_pool_size"], **pool_options)
+    self.read_routing = parse_read_routing(self.settings["read_routing"])
+    self._check_read_your_writes()
+    self._read_databases = {}
+    for mode in set(self.read_routing.values()) | {self.settings["read_preference"]}:
+      self._read_databases[mode] = read_motor.get_database(
+        mongo_db_name, read_preference=read_preference(mode, self.settings["read_max_staleness"]))
+    logger.info("json backend: %s" % serializer.configure(self.settings["json_backend"]))
+    # кэш пользователей: используется для подстановки имен пользователей в ответы
+    self.user_cache = LRUCache(self.settings["user_cache_size"], self.settings["user_cache_ttl"])
+    # кэш запретов на комментирование для "горячих" постов
+    self.forbidden_cache = LRUCache(self.settings["forbidden_cache_size"], self.settings["forbidden_cache_ttl"])
+    # счетчик запретов: набор, загрузка которого началась до очередного запрета, в кэш не сохраняется
+    self.forbidden_generation = 0
+    # кэш ответов GET /post/get_post, /posts/posts, /posts/by_user
+    self.response_cache = None
+    if self.settings["response_cache"]:
+      self.response_cache = ResponseCache(self.settings["response_cache_size"], self.settings["response_cache_ttl"])
+    # буфер отложенной записи комментариев (режимы flush - ответ после записи пачки, enqueue - после постановки)
+    self.comment_buffer = None
+    if self.settings["comment_write_mode"] in ("flush", "enqueue"):
+      self.comment_buffer = WriteBehindBuffer(self.motor.comments,
+                                              batch_size=self.settings["comment_buffer_batch"],
+                                              flush_interval=self.settings["comment_buffer_interval"],
+                                              max_size=self.settings["comment_buffer_size"],
+                                              on_write=self.embed_comments)
+    if self.settings["metrics"]:
+      self._add_cache_metrics()
+      dropped = self.metrics.gauge("log_records_dropped", "Log records dropped on log queue overflow")
+      self.metrics.add_collector(lambda: dropped.set(dropped_records()))
+    # сжатие ответов (Accept-Encoding)
+    self.compression = None
+    if self.settings["compression"]:
+      self.compression = Compression([name.strip() for name in self.settings["compression_codecs"].split(",")
+                                      if name.strip()],
+                                     min_size=self.settings["compression_min_size"],
+                                     level=self.settings["compression_level"],
+                                     brotli_quality=self.settings["compression_brotli_quality"])
+      if self.settings["metrics"]:
+        self._add_compression_metrics()
+    # ограничения времени обработки запросов по путям (секунды, 0 - без ограничения)
+    self.request_timeouts = parse_limits(self.settings["request_timeouts"], float)
+    # контроль нагрузки: ограничение одновременных запросов с очередью и частоты запросов клиентов
+    self.admission = None
+    route_limits = parse_limits(self.settings["admission_routes"])
+    rate_limits = parse_limits(self.settings["rate_limits"], parse_rate)
+    if self.settings["admission_max_in_flight"] or route_limits or rate_limits:
+      self.admission = Admission(self.settings["admission_max_in_flight"], route_limits,
+                                 queue_size=self.settings["admission_queue_size"],
+                                 queue_timeout=self.settings["admission_queue_timeout"],
+                                 rate_limits=rate_limits,
+                                 rate_limit_clients=self.settings["rate_limit_clients"])
+      if self.settings["metrics"]:
+        self._add_admission_metrics()
+    # последние медленные запросы (/admin/slow_requests) и запущенный профилировщик (/admin/profile)
+    self.slow_requests = deque(maxlen=self.settings["slow_request_log_size"])
+    self.profiler = None
+    # готовность к приему запросов (/ready): выставляется после прогрева (warm_up), снимается при остановке (drain)
+    self.ready = False
+    self.stopping = False
+    self.warmup = None
+    # фоновые задачи (fan-out постов в ленты подписчиков), завершения которых ждет close
+    self.background_tasks = set()
+
+  def _pool_options(self):
+    """
+    Настройки пулов соединений MotorClient (общие для пула записи и пула чтения); 0 - значение pymongo по умолчанию
+    (без ограничения)
+
+    :return: словарь параметров MotorClient
+    """
+    pool_options = dict(minPoolSize=self.settings["mongo_min_pool_size"],
+                        connectTimeoutMS=self.settings["mongo_connect_timeout"])
+    if self.settings["mongo_wait_queue_timeout"]:
+      pool_options["waitQueueTimeoutMS"] = self.settings["mongo_wait_queue_timeout"]
+    if self.settings["mongo_socket_timeout"]:
+      pool_options["socketTimeoutMS"] = self.settings["mongo_socket_timeout"]
+    return pool_options
+
+  def _add_cache_metrics(self):
+    """
+    Статистика кэшей приложения в метриках (читается в момент запроса /metrics)
+    """
+    caches = [("user", self.user_cache), ("forbidden", self.forbidden_cache)]
+    if self.response_cache is not None:
+      caches.append(("response", self.response_cache))
+    gauges = dict((name, self.metrics.gauge("cache_%s" % name, "Cache %s" % name, ("cache",)))
+                  for name in ("size", "hits", "misses", "evictions"))
+
+    def collect():
+      for cache_name, cache in caches:
+        stats = cache.stats()
+        for name, gauge in gauges.items():
+          gauge.set(stats[name], (cache_name,))
+
+    self.metrics.add_collector(collect)
+
+  def _add_compression_metrics(self):
+    """
+    Статистика сжатия ответов в метриках (читается в момент запроса /metrics)
+    """
+    names = ("responses", "bytes_in", "bytes_out", "bytes_saved", "seconds", "cached", "cached_bytes_saved")
+    gauges = dict((name, self.metrics.gauge("compression_%s" % name, "Response compression %s" % name, ("codec",)))
+                  for name in names)
+
+    def collect():
+      for codec, stats in self.compression.stats().items():
+        for name, gauge in gauges.items():
+          gauge.set(stats[name], (codec,))
+
+    self.metrics.add_collector(collect)
+
+  def _add_admission_metrics(self):
+    """
+    Состояние контроля нагрузки в метриках (читается в момент запроса /metrics)
+    """
+    in_flight = self.metrics.gauge("admission_in_flight", "Requests holding an admission slot", ("limit",))
+    queued = self.metrics.gauge("admission_queued", "Requests waiting for an admission slot", ("limit",))
+    rejected = self.metrics.gauge("admission_rejected", "Requests rejected by admission control with 503",
+                                  ("limit", "reason"))
+    rate_limited = self.metrics.gauge("rate_limited", "Requests rejected by client rate limits with 429", ("path",))
+
+    def collect():
+      for limiter in self.admission.limiters():
+        in_flight.set(limiter.in_flight, (limiter.name,))
+        queued.set(limiter.queued, (limiter.name,))
+        for reason in ("queue_full", "queue_timeout"):
+          rejected.set(limiter.rejected[reason], (limiter.name, reason))
+      for path, limiter in self.admission.rate_limiters.items():
+        rate_limited.set(limiter.rejected, (path,))
+
+    self.metrics.add_collector(collect)
+
+  def log_request(self, handler):
+    """
+    Запись в журнал доступа: успешные запросы записываются с вероятностью access_log_sample (ошибки - всегда),
+    при access_log_json запись - JSON-объект в одну строку
+    """
+    status = handler.get_status()
+    sample = self.settings["access_log_sample"]
+    if status < 400 and sample < 1 and random.random() >= sample:
+      return
+    if not self.settings["access_log_json"]:
+      return super(RestApplication, self).log_request(handler)
+    request = handler.request
+    if status < 400:
+      log_method = access_log.info
+    elif status < 500:
+      log_method = access_log.warning
+    else:
+      log_method = access_log.error
+    log_method(serializer.dumps({
+      "time": datetime.utcfromtimestamp(request._start_time),
+      "method": request.method,
+      "uri": request.uri,
+      "status": status,
+      "duration_ms": round(request.request_time() * 1000, 2),
+      "bytes": getattr(handler, "_bytes_written", None),
+      "ip": request.remote_ip,
+      "handler": handler.__class__.__name__,
+      "sample": sample
+    }))
+
+  def _check_read_your_writes(self):
+    """
+    Проверяет настройку read_your_writes_window: клиент читает свои записи, только если окно чтения с primary
+    не короче допустимого отставания secondary (read_max_staleness). Более короткое окно увеличивается до него.
+    """
+    window = self.settings["read_your_writes_window"]
+    modes = set(self.read_routing.values()) | {self.settings["read_preference"]}
+    if not window or modes == {"primary"}:
+      return
+    staleness = self.settings["read_max_staleness"]
+    if staleness < 0:
+      logger.warning("read_your_writes_window does not guarantee reading own writes: read_max_staleness is -1")
+    elif window < staleness:
+      logger.warning("read_your_writes_window is raised from %s to read_max_staleness %s" % (window, staleness))
+      self.settings["read_your_writes_window"] = staleness
+
+  def read_database(self, path, pinned=False):
+    """
+    Возвращает базу данных для чтения в запросе по пути path с учетом настроек read_routing и read_preference
+
+    :param path: путь запроса
+    :param pinned: клиент недавно выполнял запись и должен читать с primary (read-your-writes)
+    :return: MotorDatabase
+    """
+    if pinned:
+      return self.motor
+    return self._read_databases[self.read_routing.get(path, self.settings["read_preference"])]
+
+  def ensure_indexes(self):
+    """
+    Создает индексы, описанные в utils.indexes.INDEXES
+
+    :return: Future
+    """
+    return ensure_indexes(self.motor)
+
+  @gen.coroutine
+  def warm_up(self):
+    """
+    Прогревает приложение перед приемом запросов: открывает mongo_min_pool_size соединений в пуле записи и в пулах
+    чтения, загружает последние warmup_posts постов и их авторов (в кэш пользователей). Попытка прогрева ограничена
+    warmup_timeout секундами; после ошибки или превышения времени запросы обслуживаются "холодным" приложением,
+    /ready продолжает отвечать 503, а прогрев повторяется через warmup_retry_delay секунд - до успеха или начала
+    остановки. После прогрева /ready отвечает 200.
+    """
+    started = time.time()
+    self.warmup = {"posts": 0, "users": 0, "attempts": 0}
+    while not self.stopping:
+      self.warmup["attempts"] += 1
+      try:
+        yield gen.with_timeout(timedelta(seconds=self.settings["warmup_timeout"]), self._warm_up())
+      except Exception as e:
+        self.warmup["error"] = str(e) or e.__class__.__name__
+        logger.warning("warm-up failed (attempt %s): %s" % (self.warmup["attempts"], self.warmup["error"]))
+        yield gen.sleep(self.settings["warmup_retry_delay"])
+      else:
+        self.warmup.pop("error", None)
+        break
+    self.warmup["seconds"] = round(time.time() - started, 3)
+    logger.info("warm-up finished: %s" % self.warmup)
+    self.ready = not self.stopping
+
+  @gen.coroutine
+  def _warm_up(self):
+    databases = [self.motor] + self._read_databases.values()
+    yield [open_connections(db, self.settings["mongo_min_pool_size"]) for db in databases]
+    posts, users = yield preload(self._read_databases[self.settings["read_preference"]], self.user_cache,
+                                 self.settings["warmup_posts"], self.settings["warmup_users"])
+    self.warmup["posts"] = posts
+    self.warmup["users"] = users
+
+  def run_background(self, future):
+    """
+    Регистрирует фоновую задачу, запущенную запросом: ответ ее не ждет, а при остановке приложения она
+    завершается (см. close)
+
+    :param future: Future задачи
+    """
+    self.background_tasks.add(future)
+    future.add_done_callback(self.background_tasks.discard)
+
+  @gen.coroutine
+  def embed_comments(self, comments):
+    """
+    Обновляет посты записанных комментариев (utils.comments): счетчик comment_count и список latest_comments,
+    и вытесняет эти посты из кэша ответов. Запросы выполняются через self.motor, без deadline запроса.
+    В режимах comment_write_mode flush/enqueue вызывается буфером отложенной записи один раз на пачку.
+
+    :param comments: документы записанных комментариев
+    """
+    post_ids = yield embed_comments(self.motor, self.user_cache, comments, self.settings["post_latest_comments"])
+    if self.response_cache is not None:
+      self.response_cache.invalidate(*[("post", post_id) for post_id in post_ids])
+
+  def audit_queries(self):
+    """
+    Проверяет планы выполнения типовых запросов хэндлеров (COLLSCAN, SORT в памяти)
+
+    :return: Future со списком проблемных запросов
+    """
+    return audit_queries(self.motor)
+
+  def rebuild_tag_counts(self):
+    """
+    Пересчитывает счетчики постов по тегам по всем постам (для постов, созданных до появления счетчиков)
+
+    :return: Future
+    """
+    return rebuild_tag_counts(self.motor)
+
+  def rebuild_comment_counts(self):
+    """
+    Пересчитывает счетчики комментариев всех постов (для постов, созданных до появления счетчика)
+
+    :return: Future
+    """
+    return rebuild_comment_counts(self.motor)
+
+  @gen.coroutine
+  def drain(self):
+    """
+    Начинает остановку: /ready отвечает 503, затем shutdown_drain_delay секунд запросы продолжают приниматься,
+    пока балансировщик не перестанет направлять их в этот процесс
+    """
+    self.stopping = True
+    self.ready = False
+    yield gen.sleep(self.settings["shutdown_drain_delay"])
+
+  @gen.coroutine
+  def close(self):
+    """
+    Завершает работу приложения: записывает в БД документы из буферов отложенной записи
+    """
+    self.ready = False
+    if self.loop_monitor is not None:
+      self.loop_monitor.stop()
+    if self.comment_buffer is not None:
+      yield self.comment_buffer.close()
+    if self.background_tasks:
+      yield list(self.background_tasks)
 
 
 if __name__ == "__main__":
@@ -60,38 +478,378 @@ if __name__ == "__main__":
   define("mongo_port", default=27017, help="mongodb port", type=int)
   define("mongo_db_name", default="", help="mongodb database name")
   define("debug", default=True, help="debug mode", type=bool)
+  define("audit_queries", default=False, help="explain handlers' queries at startup and report COLLSCAN/SORT",
+         type=bool)
+  define("audit_only", default=False, help="run query audit and exit", type=bool)
+  define("rebuild_tag_stats", default=False, help="recount tag counters from all posts at startup", type=bool)
+  define("rebuild_comment_counts", default=False, help="recount comment_count of all posts from comments at startup",
+         type=bool)
+  define("title_search", default="regex", help="default title search mode for /posts/posts: regex or text")
+  define("listing_engine", default="find", help="query engine for listings: find (two queries) or aggregate ($lookup)")
+  define("bulk_chunk_size", default=1000, help="number of documents per insert_many in bulk endpoints", type=int)
+  define("bulk_max_array_size", default=1024 * 1024 * 64, help="max size of JSON array body in bulk endpoints",
+         type=int)
+  define("bulk_max_body_size", default=1024 * 1024 * 1024 * 10, help="max size of NDJSON body in bulk endpoints",
+         type=int)
+  define("response_cache", default=True, help="cache responses of get_post and posts listings", type=bool)
+  define("response_cache_size", default=10000, help="max number of cached responses", type=int)
+  define("response_cache_ttl", default=60, help="ttl of cached responses in seconds", type=int)
+  define("response_cache_max_age", default=0, help="max-age of Cache-Control for cached responses", type=int)
+  define("json_backend", default="auto", help="json library for responses: auto, json or simplejson")
+  define("stream_batch_size", default=100, help="documents per chunk in streaming listings", type=int)
+  define("comment_write_mode", default="direct",
+         help="comment writes: direct, flush (buffered, ack after flush) or enqueue (buffered, ack after enqueue)")
+  define("comment_buffer_batch", default=500, help="comments per insert_many in write-behind mode", type=int)
+  define("comment_buffer_interval", default=0.05, help="max delay of buffered comments in seconds", type=float)
+  define("comment_buffer_size", default=10000, help="max number of buffered comments", type=int)
+  define("user_cache_size", default=10000, help="max number of users in in-process cache", type=int)
+  define("user_cache_ttl", default=3600, help="ttl of user cache entries in seconds (0 - no expiration)", type=int)
+  define("forbidden_cache_size", default=1000, help="max number of posts in forbidden users cache", type=int)
+  define("forbidden_cache_ttl", default=10, help="ttl of forbidden users cache entries in seconds (bans made by "
+                                                 "other workers are seen after at most this delay)", type=int)
+  define("forbidden_cache_max_users", default=10000, help="max number of forbidden users cached per post", type=int)
+  define("workers", default=1, help="number of worker processes (>1 - supervisor with pre-forked workers)", type=int)
+  define("reuse_port", default=False, help="bind a SO_REUSEPORT socket in every worker instead of sharing one",
+         type=bool)
+  define("metrics", default=True, help="collect metrics and serve them on /metrics (Prometheus text format)",
+         type=bool)
+  define("metrics_lag_interval", default=0.5, help="interval of IOLoop lag measurements in seconds", type=float)
+  define("read_preference", default="primary",
+         help="default read preference: primary, primaryPreferred, secondary, secondaryPreferred or nearest")
+  define("read_routing", default="", help="read preference per path: /posts/posts=secondaryPreferred,...")
+  define("read_max_staleness", default=90, help="maxStalenessSeconds for secondary reads (>= 90, -1 - no limit)",
+         type=int)
+  define("read_your_writes_window", default=0, help="seconds to read from primary after a client's write "
+         "(0 - off, at least read_max_staleness)",
+         type=int)
+  define("read_pool_size", default=100, help="max connections of the read pool", type=int)
+  define("write_pool_size", default=100, help="max connections of the write (primary) pool", type=int)
+  define("mongo_min_pool_size", default=0, help="connections opened at startup and kept in every pool", type=int)
+  define("mongo_wait_queue_timeout", default=0, help="max wait for a free pool connection, ms (0 - no limit)",
+         type=int)
+  define("mongo_connect_timeout", default=20000, help="mongodb connect timeout, ms", type=int)
+  define("mongo_socket_timeout", default=0, help="mongodb socket read/write timeout, ms (0 - no limit)", type=int)
+  define("warmup_posts", default=1000, help="number of latest posts loaded at startup (their authors are cached)",
+         type=int)
+  define("warmup_users", default=1000, help="max number of users cached at startup", type=int)
+  define("warmup_timeout", default=30, help="max duration of startup warm-up, seconds", type=int)
+  define("warmup_retry_delay", default=5, help="delay before retrying a failed warm-up, seconds", type=float)
+  define("shutdown_drain_delay", default=5, help="seconds /ready answers 503 before the server stops on shutdown",
+         type=float)
+  define("post_latest_comments", default=20, help="number of latest comments embedded in a post document",
+         type=int)
+  define("timeline_size", default=500, help="max number of posts kept in a user's timeline", type=int)
+  define("timeline_fanout_batch", default=1000, help="timelines updated by one bulk write on post fan-out", type=int)
+  define("timeline_popular_threshold", default=10000,
+         help="followers count from which author's posts are read on timeline reads instead of fan-out (0 - off)",
+         type=int)
+  define("timeline_backfill", default=20, help="number of author's latest posts added to a new follower's timeline",
+         type=int)
+  define("slow_request_threshold", default=1.0,
+         help="log per-phase timings of requests slower than this, seconds (0 - off)", type=float)
+  define("slow_request_log_size", default=100, help="number of slow requests kept for /admin/slow_requests",
+         type=int)
+  define("admin_token", default="", help="token for /admin endpoints (X-Admin-Token); empty - /admin is disabled")
+  define("log_queue_size", default=10000, help="max number of log records waiting for the writer thread "
+                                              "(records are dropped and counted on overflow)", type=int)
+  define("log_max_bytes", default=1024 * 1024 * 2, help="log file size to rotate at", type=int)
+  define("log_backup_count", default=1, help="number of rotated log files to keep", type=int)
+  define("access_logpath", default="", help="separate file for the access log (empty - main log)")
+  define("access_log_json", default=False, help="write access log records as JSON objects", type=bool)
+  define("access_log_sample", default=1.0, help="fraction of successful requests written to the access log",
+         type=float)
+  define("compression", default=True, help="compress responses according to Accept-Encoding", type=bool)
+  define("compression_codecs", default="br,gzip", help="compression codecs in order of preference "
+                                                       "(br requires the brotli module)")
+  define("compression_min_size", default=1024, help="min response size to compress, bytes", type=int)
+  define("compression_level", default=6, help="gzip compression level (1-9)", type=int)
+  define("compression_brotli_quality", default=4, help="brotli compression quality (0-11)", type=int)
+  define("admission_max_in_flight", default=500, help="max concurrently processed requests (0 - no limit)", type=int)
+  define("admission_routes", default="", help="max concurrently processed requests per path: /bulk/posts=4,...")
+  define("admission_queue_size", default=1000, help="max requests waiting for a slot per limit (more - 503)",
+         type=int)
+  define("admission_queue_timeout", default=1.0, help="max wait for a slot, seconds (longer - 503)", type=float)
+  define("rate_limits", default="", help="requests per second and burst per IP and per user and path: "
+                                         "/post/create_post=5:20,...")
+  define("rate_limit_clients", default=100000, help="max number of clients tracked by rate limits", type=int)
+  define("request_timeout", default=10.0, help="max request processing time, seconds; passed to mongodb queries as "
+                                              "maxTimeMS (0 - no limit)", type=float)
+  define("request_timeouts", default="", help="max processing time per path, seconds: /posts/posts=2,...")
+  define("request_timeout_header", default="X-Request-Timeout",
+         help="request header with client's processing time limit, seconds")
+  define("request_timeout_max", default=60.0, help="max processing time a client may request", type=float)
+  define("worker_reload_delay", default=2.0, help="delay between starting a new worker and stopping the old one "
+                                                  "on rolling reload (SIGHUP) if worker_ready_timeout is 0",
+         type=float)
+  define("worker_ready_timeout", default=60.0, help="max wait for a new worker to become ready on rolling reload, "
+                                                    "seconds; reload is aborted after it (0 - do not wait)",
+         type=float)
+  define("worker_id", default=0, help="number of a worker process started by the supervisor (internal)", type=int)
+  define("worker_sockets", default="", help="listening sockets inherited from the supervisor: fd:family,... "
+                                            "(internal)")
 
   options.parse_command_line()
   configpath = expandvars(options.c)
   options.parse_config_file(configpath)
   options.parse_command_line()
 
+  log_listener = [None]
+
+  def log_handler(logfile, logformat):
+    """
+    Обработчик записи в файл с ротацией (без пути - в stderr)
+    """
+    if logfile:
+      log_dir = dirname(logfile)
+      if log_dir and not exists(log_dir):
+        makedirs(log_dir)
+      handler = RotatingFileHandler(logfile, mode='a', maxBytes=options.log_max_bytes,
+                                    backupCount=options.log_backup_count, encoding="utf8")
+    else:
+      handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logformat))
+    return handler
+
+  def init_logging(logfile, access_logfile=""):
+    """
+    Настраивает логирование: корневой логгер только кладет записи в ограниченную очередь, запись в файлы и ротацию
+    выполняет поток QueueListener. Журнал доступа при заданном access_logfile пишется в отдельный файл.
+    """
+    # clear logging
+    root = logging.getLogger()
+    for handler in root.handlers or []:
+      root.removeHandler(handler)
+    if log_listener[0] is not None:
+      log_listener[0].stop()
+
+    handler = log_handler(logfile, options.logformat)
+    handlers = [handler]
+    if access_logfile:
+      handler.addFilter(ExcludeFilter(access_log.name))
+      access_handler = log_handler(access_logfile, "%(message)s" if options.access_log_json else options.logformat)
+      access_handler.addFilter(logging.Filter(access_log.name))
+      handlers.append(access_handler)
+    queue = Queue(options.log_queue_size)
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(logging.getLevelName(options.loglevel or "INFO"))
+    log_listener[0] = QueueListener(queue, *handlers)
+    log_listener[0].start()
+
+  def stop_logging():
+    """
+    Дожидается записи логов из очереди (в рабочих процессах atexit не используется)
+    """
+    if log_listener[0] is not None:
+      log_listener[0].stop()
+
+  def worker_logpath(logfile, worker_id):
+    """
+    Путь до лог-файла рабочего процесса: rest.log -> rest.1.log
+    """
+    base, ext = splitext(logfile)
+    return "%s.%s%s" % (base, worker_id, ext)
+
+  def create_application(**overrides):
+    return RestApplication(options.mongo_host, options.mongo_port, options.mongo_db_name, options.debug,
+                           user_cache_size=options.user_cache_size,
+                           user_cache_ttl=options.user_cache_ttl,
+                           forbidden_cache_size=options.forbidden_cache_size,
+                           forbidden_cache_ttl=options.forbidden_cache_ttl,
+                           forbidden_cache_max_users=options.forbidden_cache_max_users,
+                           title_search=options.title_search,
+                           listing_engine=options.listing_engine,
+                           bulk_chunk_size=options.bulk_chunk_size,
+                           bulk_max_array_size=options.bulk_max_array_size,
+                           bulk_max_body_size=options.bulk_max_body_size,
+                           response_cache=options.response_cache,
+                           response_cache_size=options.response_cache_size,
+                           response_cache_ttl=options.response_cache_ttl,
+                           response_cache_max_age=options.response_cache_max_age,
+                           json_backend=options.json_backend,
+                           stream_batch_size=options.stream_batch_size,
+                           comment_write_mode=options.comment_write_mode,
+                           comment_buffer_batch=options.comment_buffer_batch,
+                           comment_buffer_interval=options.comment_buffer_interval,
+                           comment_buffer_size=options.comment_buffer_size,
+                           metrics=options.metrics,
+                           metrics_lag_interval=options.metrics_lag_interval,
+                           read_preference=options.read_preference,
+                           read_routing=options.read_routing,
+                           read_max_staleness=options.read_max_staleness,
+                           read_your_writes_window=options.read_your_writes_window,
+                           read_pool_size=options.read_pool_size,
+                           write_pool_size=options.write_pool_size,
+                           mongo_min_pool_size=options.mongo_min_pool_size,
+                           mongo_wait_queue_timeout=options.mongo_wait_queue_timeout,
+                           mongo_connect_timeout=options.mongo_connect_timeout,
+                           mongo_socket_timeout=options.mongo_socket_timeout,
+                           warmup_posts=options.warmup_posts,
+                           warmup_users=options.warmup_users,
+                           warmup_timeout=options.warmup_timeout,
+                           warmup_retry_delay=options.warmup_retry_delay,
+                           shutdown_drain_delay=options.shutdown_drain_delay,
+                           post_latest_comments=options.post_latest_comments,
+                           timeline_size=options.timeline_size,
+                           timeline_fanout_batch=options.timeline_fanout_batch,
+                           timeline_popular_threshold=options.timeline_popular_threshold,
+                           timeline_backfill=options.timeline_backfill,
+                           slow_request_threshold=options.slow_request_threshold,
+                           slow_request_log_size=options.slow_request_log_size,
+                           admin_token=options.admin_token,
+                           access_log_json=options.access_log_json,
+                           access_log_sample=options.access_log_sample,
+                           compression=options.compression,
+                           compression_codecs=options.compression_codecs,
+                           compression_min_size=options.compression_min_size,
+                           compression_level=options.compression_level,
+                           compression_brotli_quality=options.compression_brotli_quality,
+                           admission_max_in_flight=options.admission_max_in_flight,
+                           admission_routes=options.admission_routes,
+                           admission_queue_size=options.admission_queue_size,
+                           admission_queue_timeout=options.admission_queue_timeout,
+                           rate_limits=options.rate_limits,
+                           rate_limit_clients=options.rate_limit_clients,
+                           request_timeout=options.request_timeout,
+                           request_timeouts=options.request_timeouts,
+                           request_timeout_header=options.request_timeout_header,
+                           request_timeout_max=options.request_timeout_max,
+                           **overrides)
+
+  def run_worker(worker_id=None, sockets=None):
+    """
+    Запускает сервер в текущем процессе. Приложение (и MotorClient) создается здесь, т.е. после fork.
+
+    :param worker_id: номер рабочего процесса (None - единственный процесс)
+    :param sockets: заранее открытые слушающие сокеты (None - открыть свои)
+    """
+    overrides = {}
+    if worker_id is not None:
+      init_logging(worker_logpath(logfile, worker_id),
+                   worker_logpath(access_logfile, worker_id) if access_logfile else "")
+      # autoreload перезапустил бы рабочий процесс как сервер целиком (со своим супервизором); код и настройки
+      # рабочих процессов обновляются через rolling reload (SIGHUP)
+      overrides = dict(debug=False, autoreload=False)
+    try:
+      application = create_application(**overrides)
+      IOLoop.current().run_sync(application.ensure_indexes)
+    except Exception as e:
+      logger.exception(e)
+      stop_logging()
+      sys.exit(1)
+
+    AsyncHTTPClient.configure(CurlAsyncHTTPClient, max_clients=50)
+    server = HTTPServer(application)
+    if sockets is None:
+      sockets = bind_sockets(options.server_port, address=options.server_host, reuse_port=options.reuse_port)
+    server.add_sockets(sockets)
+    @gen.coroutine
+    def start():
+      # запросы принимаются сразу, /ready отвечает 503, пока соединения и горячие данные загружаются
+      yield application.warm_up()
+      if application.ready:
+        notify_ready()
+
+    IOLoop.current().spawn_callback(start)
+
+    @gen.coroutine
+    def shutdown():
+      if application.stopping:
+        return
+      logging.info("rest server is stopping")
+      yield application.drain()
+      server.stop()
+      yield application.close()
+      IOLoop.current().stop()
+
+    def on_signal(signum, frame):
+      IOLoop.current().add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    logging.info("rest server started on %s" % options.server_port)
+    IOLoop.current().start()
+    logging.info("rest server stopped")
+    stop_logging()
+
+  def exec_worker(worker_id, sockets=None):
+    """
+    Запускает рабочий процесс новым интерпретатором (вызывается супервизором в дочернем процессе после fork), поэтому
+    код и файл настроек загружаются заново: rolling reload (SIGHUP) применяет их изменения. Слушающие сокеты
+    передаются номерами дескрипторов.
+
+    :param worker_id: номер рабочего процесса
+    :param sockets: слушающие сокеты супервизора (None - рабочий процесс открывает свой, reuse_port)
+    """
+    inherited = []
+    for sock in sockets or []:
+      fd = sock.fileno()
+      # bind_sockets закрывает дескрипторы при exec
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+      inherited.append("%s:%s" % (fd, sock.family))
+    os.execv(sys.executable, [sys.executable] + sys.argv + ["--worker_id=%s" % worker_id,
+                                                            "--worker_sockets=%s" % ",".join(inherited)])
+
+  def inherited_sockets(value):
+    """
+    Восстанавливает слушающие сокеты, переданные exec_worker
+
+    :param value: строка fd:family,...
+    :return: список сокетов или None, если сокеты не передавались
+    """
+    sockets = []
+    for item in value.split(","):
+      if item:
+        fd, family = [int(part) for part in item.split(":")]
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets or None
+
   # init logging subsystem
   logfile = expandvars(options.logpath)
-  log_dir = dirname(logfile)
-  if log_dir and not exists(log_dir):
-    makedirs(log_dir)
-
-  # clear logging
-  root = logging.getLogger()
-  for handler in root.handlers or []:
-    root.removeHandler(handler)
-
-  logging.basicConfig(filename=logfile, level=logging.getLevelName(options.loglevel or "INFO"),
-                      format=options.logformat, filemode="w")
-  rfh = RotatingFileHandler(logfile, mode='a', maxBytes=1024 * 1024 * 2, backupCount=1, encoding="utf8")
-  logging.getLogger().addHandler(rfh)
-
-  application = None
-
-  try:
-    application = RestApplication(options.mongo_host, options.mongo_port, options.mongo_db_name, options.debug)
-  except Exception as e:
-    logger.exception(e)
-    sys.exit(1)
-
-  AsyncHTTPClient.configure(CurlAsyncHTTPClient, max_clients=50)
-  application.listen(options.server_port, address=options.server_host, max_buffer_size=200000000000)
-  logging.info("rest server started on %s" % options.server_port)
+  access_logfile = expandvars(options.access_logpath)
+  if options.worker_id:
+    # рабочий процесс, запущенный супервизором (exec_worker): логи, проверка запросов и сокеты - у супервизора
+    run_worker(options.worker_id, inherited_sockets(options.worker_sockets))
+    sys.exit(0)
+  init_logging(logfile, access_logfile)
+  atexit.register(stop_logging)
+
+  if options.audit_queries or options.audit_only or options.rebuild_tag_stats or options.rebuild_comment_counts:
+    # проверка и пересчет выполняются в отдельном IOLoop, чтобы он и MotorClient не перешли в рабочие процессы
+    audit_loop = IOLoop()
+    audit_loop.make_current()
+    problems = []
+    try:
+      audit_application = create_application()
+      audit_loop.run_sync(audit_application.ensure_indexes)
+      if options.rebuild_tag_stats:
+        audit_loop.run_sync(audit_application.rebuild_tag_counts)
+        logger.info("tag counters are rebuilt")
+      if options.rebuild_comment_counts:
+        audit_loop.run_sync(audit_application.rebuild_comment_counts)
+        logger.info("comment counters are rebuilt")
+      if options.audit_queries or options.audit_only:
+        problems = audit_loop.run_sync(audit_application.audit_queries)
+    except Exception as e:
+      logger.exception(e)
+      sys.exit(1)
+    for name, stages in problems:
+      print "query %s uses %s" % (name, ", ".join(stages))
+    if options.audit_only:
+      sys.exit(1 if problems else 0)
+    IOLoop.clear_current()
+    audit_loop.close()
+
   print "rest server started on %s" % options.server_port
-  IOLoop.instance().start()
+  if options.workers > 1:
+    # слушающие сокеты открываются до fork и разделяются рабочими процессами (либо SO_REUSEPORT в каждом)
+    shared_sockets = None
+    if not options.reuse_port:
+      shared_sockets = bind_sockets(options.server_port, address=options.server_host)
+    Supervisor(options.workers, lambda worker_id: exec_worker(worker_id, shared_sockets),
+               reload_delay=options.worker_reload_delay, ready_timeout=options.worker_ready_timeout).run()
+  else:
+    run_worker()
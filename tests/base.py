@@ -2,16 +2,45 @@
 __author__ = 'vatyakshin'
 
 import json
+import logging
 import re
+import shutil
+import signal
+import sys
+import tempfile
+import thread
+import time
 import unittest
 import urllib
+import zlib
 
 import os
+from Queue import Queue
+from datetime import datetime
 from bson import ObjectId
+from bson.tz_util import utc
 from tornado.httpclient import AsyncHTTPClient
-from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
 
 from rest_server import RestApplication
+from utils.cache import BloomFilter, LRUCache
+from utils.write_buffer import WriteBehindBuffer
+from utils.supervisor import Supervisor, notify_ready
+from utils import serializer
+from utils import dates
+from utils.dates import parse_date
+from utils.data_utils import todate
+from utils.response_cache import ResponseCache
+from utils.metrics import Registry, CommandTimer
+from utils.read_routing import parse_read_routing
+from utils.profiler import SamplingProfiler
+from utils.log_queue import QueueHandler, QueueListener
+from utils.compression import Compression
+from utils.timelines import merge_entries
+from utils.admission import Admission, RateLimiter, Rejected
+from utils.deadline import Deadline, DeadlineCollection, DeadlineDatabase, DeadlineExceeded, Cancelled
+from utils.pagination import encode_cursor, decode_cursor, keyset_query
 
 with open(os.path.join(os.path.dirname(__file__), "config/test.json"), mode="r") as fr:
   config = json.load(fr)
@@ -37,6 +66,14 @@ class BaseHTTPTestCase(AsyncHTTPTestCase):
     self.db.drop_collection("users")
     self.db.drop_collection("posts")
     self.db.drop_collection("comments")
+    self.db.drop_collection("forbidden_users")
+    self.db.drop_collection("tag_counts")
+    self.db.drop_collection("tag_counts_daily")
+    self.db.drop_collection("follows")
+    self.db.drop_collection("timelines")
+    self.get_app().user_cache.clear()
+    self.get_app().forbidden_cache.clear()
+    self.get_app().response_cache.clear()
 
   @property
   def db(self):
@@ -58,6 +95,14 @@ class MainHTTPTestCase(BaseHTTPTestCase):
     self.assertTrue(response.code == 200)
     self.assertTrue(self.is_objectid(response.body))
 
+  @gen_test(timeout=30)
+  def test_user_create_duplicate(self):
+    yield self.get_app().ensure_indexes()
+    url = self.get_url("/user/create")
+    params = urllib.urlencode(dict(username="twice"))
+    responses = yield [self.http_client.fetch(url, method="POST", body=params, raise_error=False) for _ in range(2)]
+    self.assertEqual(sorted(response.code for response in responses), [200, 400])
+
   @gen_test(timeout=10)
   def test_post_create(self):
     r = yield self.db.users.insert({"username": "test_post"})
@@ -66,5 +111,853 @@ class MainHTTPTestCase(BaseHTTPTestCase):
     response = yield self.http_client.fetch(url, method="POST", body=params)
     self.assertTrue(self.is_objectid(response.body))
 
+  @gen_test(timeout=10)
+  def test_user_cache_prefilled(self):
+    url = self.get_url("/user/create")
+    response = yield self.http_client.fetch(url, method="POST", body=urllib.urlencode(dict(username="cached")))
+    self.assertIn(ObjectId(response.body), self.get_app().user_cache)
+
+  @gen_test(timeout=10)
+  def test_forbid_user(self):
+    user = yield self.db.users.insert({"username": "forbidden"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    url = self.get_url("/post/create_comment")
+    params = urllib.urlencode(dict(user=user, post_id=post, text="first"))
+    response = yield self.http_client.fetch(url, method="POST", body=params)
+    self.assertTrue(self.is_objectid(response.body))
+    response = yield self.http_client.fetch(self.get_url("/post/forbid_user"), method="POST",
+                                            body=urllib.urlencode(dict(post_id=post, users=json.dumps([str(user)]))))
+    self.assertEqual(response.body, "1")
+    response = yield self.http_client.fetch(url, method="POST", body=params, raise_error=False)
+    self.assertEqual(response.code, 503)
+
+  @gen_test(timeout=10)
+  def test_forbid_user_legacy(self):
+    # запрет, сохраненный в посте до появления коллекции forbidden_users
+    user = yield self.db.users.insert({"username": "legacy"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": [],
+                                       "forbidden_for": [str(user)]})
+    response = yield self.http_client.fetch(self.get_url("/post/create_comment"), method="POST", raise_error=False,
+                                            body=urllib.urlencode(dict(user=user, post_id=post, text="first")))
+    self.assertEqual(response.code, 503)
+
+  @gen_test(timeout=10)
+  def test_comment_missing_post(self):
+    user = yield self.db.users.insert({"username": "orphan"})
+    params = urllib.urlencode(dict(user=user, post_id=ObjectId(), text="first"))
+    for _ in range(2):
+      # второй запрос отвечает по закэшированному отсутствию поста
+      response = yield self.http_client.fetch(self.get_url("/post/create_comment"), method="POST", body=params,
+                                              raise_error=False)
+      self.assertEqual(response.code, 404)
+    count = yield self.db.comments.find({"user_id": user}).count()
+    self.assertEqual(count, 0)
+
+  @gen_test(timeout=30)
+  def test_query_audit(self):
+    yield self.get_app().ensure_indexes()
+    problems = yield self.get_app().audit_queries()
+    self.assertEqual(problems, [])
+
+  @gen_test(timeout=30)
+  def test_title_text_search(self):
+    yield self.get_app().ensure_indexes()
+    user = yield self.db.users.insert({"username": "searcher"})
+    url = self.get_url('/post/create_post')
+    for title in (u"Tornado and motor", u"Mongo text index"):
+      params = urllib.urlencode(dict(user=user, tags=json.dumps(["test"]), title=title))
+      yield self.http_client.fetch(url, method="POST", body=params)
+    url = self.get_url("/posts/posts?" + urllib.urlencode(dict(title="motor", title_mode="text")))
+    response = yield self.http_client.fetch(url)
+    docs = json.loads(response.body)
+    self.assertEqual([doc["title"] for doc in docs], [u"Tornado and motor"])
+    self.assertEqual(docs[0]["username"], "searcher")
+
+  @gen_test(timeout=10)
+  def test_listing_engines_match(self):
+    user = yield self.db.users.insert({"username": "engine"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": ["a"],
+                                       "post_date": datetime(2017, 10, 1)})
+    yield self.db.comments.insert({"user_id": user, "post_id": post, "text": "c", "comment_date": datetime(2017, 10, 2)})
+    results = {}
+    for engine in ("find", "aggregate"):
+      self.get_app().settings["listing_engine"] = engine
+      try:
+        posts = yield self.http_client.fetch(self.get_url("/posts/by_user?user=%s" % user))
+        comments = yield self.http_client.fetch(self.get_url("/post/get_comments?post_id=%s" % post))
+      finally:
+        self.get_app().settings["listing_engine"] = "find"
+      results[engine] = (json.loads(posts.body), json.loads(comments.body))
+    self.assertEqual(results["find"], results["aggregate"])
+    self.assertEqual(results["find"][1][0]["username"], "engine")
+
+  @gen_test(timeout=10)
+  def test_bulk_users(self):
+    url = self.get_url("/bulk/users")
+    body = "\n".join(json.dumps(item) for item in [{"username": "bulk1"}, {"username": "!"}, {"username": "bulk1"}])
+    response = yield self.http_client.fetch(url, method="POST", body=body,
+                                            headers={"Content-Type": "application/x-ndjson"})
+    results = json.loads(response.body)
+    self.assertEqual([result["index"] for result in results], [0, 1, 2])
+    self.assertTrue(self.is_objectid(results[0]["_id"]))
+    self.assertIn("error", results[1])
+    self.assertEqual(results[2]["error"], "Username already used")
+
+  @gen_test(timeout=10)
+  def test_bulk_posts(self):
+    user = yield self.db.users.insert({"username": "bulkposts"})
+    body = json.dumps([{"user": str(user), "title": "One", "tags": ["a"]}, {"user": str(user)}])
+    response = yield self.http_client.fetch(self.get_url("/bulk/posts"), method="POST", body=body)
+    results = json.loads(response.body)
+    self.assertTrue(self.is_objectid(results[0]["_id"]))
+    self.assertEqual(results[1]["error"], "Fields user and title are required")
+    count = yield self.db.posts.count()
+    self.assertEqual(count, 1)
+
+  @gen_test(timeout=10)
+  def test_comments_stream(self):
+    user = yield self.db.users.insert({"username": "streamer"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    yield self.db.comments.insert_many([{"user_id": user, "post_id": post, "text": str(i),
+                                         "comment_date": datetime(2017, 10, 1, 0, i)} for i in range(5)])
+    url = self.get_url("/post/get_comments?post_id=%s&limit=5" % post)
+    response = yield self.http_client.fetch(url, headers={"Accept": "application/x-ndjson"})
+    docs = [json.loads(line) for line in response.body.splitlines()]
+    self.assertEqual([doc["text"] for doc in docs], ["4", "3", "2", "1", "0"])
+    self.assertEqual(docs[0]["username"], "streamer")
+    response = yield self.http_client.fetch(url + "&stream=json")
+    self.assertEqual(json.loads(response.body), docs)
+
+  @gen_test(timeout=10)
+  def test_get_post_etag(self):
+    user = yield self.db.users.insert({"username": "etag"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    url = self.get_url("/post/get_post?post_id=%s" % post)
+    response = yield self.http_client.fetch(url)
+    etag = response.headers["Etag"]
+    response = yield self.http_client.fetch(url, headers={"If-None-Match": etag}, raise_error=False)
+    self.assertEqual(response.code, 304)
+    yield self.db.posts.update({"_id": post}, {"$set": {"title": "Changed"}})
+    yield self.http_client.fetch(self.get_url("/post/forbid_user"), method="POST",
+                                 body=urllib.urlencode(dict(post_id=post, users=json.dumps([str(user)]))))
+    response = yield self.http_client.fetch(url, headers={"If-None-Match": etag})
+    self.assertEqual(json.loads(response.body)["title"], "Changed")
+
+  @gen_test(timeout=10)
+  def test_get_post_cache_pinned(self):
+    user = yield self.db.users.insert({"username": "pinned"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    url = self.get_url("/post/get_post?post_id=%s" % post)
+    yield self.http_client.fetch(url)
+    yield self.db.posts.update({"_id": post}, {"$set": {"title": "Changed"}})
+    self.get_app().settings["read_your_writes_window"] = 5
+    try:
+      cookie = "primary_until=%d" % (time.time() + 5)
+      response = yield self.http_client.fetch(url, headers={"Cookie": cookie})
+    finally:
+      self.get_app().settings["read_your_writes_window"] = 0
+    self.assertEqual(json.loads(response.body)["title"], "Changed")
+
+  @gen_test(timeout=10)
+  def test_metrics(self):
+    yield self.http_client.fetch(self.get_url("/user/create"), method="POST",
+                                 body=urllib.urlencode(dict(username="metrics")))
+    response = yield self.http_client.fetch(self.get_url("/metrics"))
+    self.assertIn('http_request_duration_seconds_count{handler="UserHandler",type="create",method="POST"}',
+                  response.body)
+    self.assertIn('http_responses_total{handler="UserHandler",type="create",code="200"}', response.body)
+    self.assertIn('mongo_command_duration_seconds_count{collection="users",command="insert"}', response.body)
+
+  @gen_test(timeout=10)
+  def test_tag_stats(self):
+    user = yield self.db.users.insert({"username": "tags"})
+    url = self.get_url("/post/create_post")
+    for tags in (["a", "b"], ["a"], ["a", "c", "a"]):
+      yield self.http_client.fetch(url, method="POST",
+                                   body=urllib.urlencode(dict(user=user, tags=json.dumps(tags), title="Tags")))
+    response = yield self.http_client.fetch(self.get_url("/posts/tags?limit=2"))
+    self.assertEqual(json.loads(response.body), [{"tag": "a", "count": 3}, {"tag": "b", "count": 1}])
+    response = yield self.http_client.fetch(self.get_url("/posts/tag_stats?days=1&tags=%s" % json.dumps(["c", "d"])))
+    stats = json.loads(response.body)
+    self.assertEqual(stats["c"]["count"], 1)
+    self.assertEqual([day["count"] for day in stats["c"]["days"]], [1])
+    self.assertEqual(stats["d"], {"count": 0, "days": []})
+    yield self.db.drop_collection("tag_counts")
+    yield self.get_app().rebuild_tag_counts()
+    counts = yield self.db.tag_counts.find().sort("_id").to_list(None)
+    self.assertEqual([(doc["_id"], doc["count"]) for doc in counts], [("a", 3), ("b", 1), ("c", 1)])
+    response = yield self.http_client.fetch(self.get_url("/posts/posts?tags_mode=all&tags=%s" %
+                                                         json.dumps(["a", "b"])))
+    self.assertEqual(len(json.loads(response.body)), 1)
+
+  @gen_test(timeout=10)
+  def test_get_post_with_comments(self):
+    self.addCleanup(self.get_app().settings.__setitem__, "post_latest_comments", 20)
+    self.get_app().settings["post_latest_comments"] = 3
+    user = yield self.db.users.insert({"username": "bundle"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    url = self.get_url("/post/create_comment")
+    for i in range(5):
+      yield self.http_client.fetch(url, method="POST", body=urllib.urlencode(dict(user=user, post_id=post, text=i)))
+    response = yield self.http_client.fetch(self.get_url("/post/get_post?with_comments=2&post_id=%s" % post))
+    bundle = json.loads(response.body)
+    self.assertEqual(bundle["comment_count"], 5)
+    self.assertEqual([comment["text"] for comment in bundle["comments"]], ["4", "3"])
+    self.assertEqual(bundle["comments"][0]["username"], "bundle")
+    url = self.get_url("/post/get_comments?limit=10&post_id=%s&cursor=%s" % (post, response.headers["X-Next-Cursor"]))
+    response = yield self.http_client.fetch(url)
+    self.assertEqual([comment["text"] for comment in json.loads(response.body)], ["2", "1", "0"])
+    stored = yield self.db.posts.find_one({"_id": post})
+    self.assertEqual(len(stored["latest_comments"]), 3)
+
+  @gen_test(timeout=10)
+  def test_comment_embedded_after_cancel(self):
+    def insert(collection, *args, **kwargs):
+      # клиент закрывает соединение сразу после записи комментария
+      future = collection._collection.insert(*args, **kwargs)
+      collection._deadline.cancel()
+      return future
+    DeadlineCollection.insert = insert
+    self.addCleanup(delattr, DeadlineCollection, "insert")
+    user = yield self.db.users.insert({"username": "cancelled"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": [], "comment_count": 0})
+    yield self.http_client.fetch(self.get_url("/post/create_comment"), method="POST",
+                                 body=urllib.urlencode(dict(user=user, post_id=post, text="saved")))
+    stored = yield self.db.posts.find_one({"_id": post})
+    self.assertEqual(stored["comment_count"], 1)
+    self.assertEqual(stored["latest_comments"][0]["username"], "cancelled")
+
+  @gen_test(timeout=10)
+  def test_listings_without_comments(self):
+    user = yield self.db.users.insert({"username": "listing"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": ["a"]})
+    # комментарий, записанный до появления счетчика comment_count
+    yield self.db.comments.insert({"user_id": user, "post_id": post, "text": "0", "comment_date": datetime(2017, 10, 1)})
+    response = yield self.http_client.fetch(self.get_url("/post/get_post?with_comments=1&post_id=%s" % post))
+    self.assertEqual(json.loads(response.body)["comment_count"], 1)
+    yield self.get_app().rebuild_comment_counts()
+    yield self.http_client.fetch(self.get_url("/post/create_comment"), method="POST",
+                                 body=urllib.urlencode(dict(user=user, post_id=post, text=1)))
+    response = yield self.http_client.fetch(self.get_url("/post/get_post?with_comments=1&post_id=%s" % post))
+    self.assertEqual(json.loads(response.body)["comment_count"], 2)
+    for engine in ("find", "aggregate"):
+      self.get_app().settings["listing_engine"] = engine
+      self.get_app().response_cache.clear()
+      try:
+        response = yield self.http_client.fetch(self.get_url("/posts/by_user?user=%s" % user))
+      finally:
+        self.get_app().settings["listing_engine"] = "find"
+      posts = json.loads(response.body)
+      self.assertEqual(len(posts), 1)
+      self.assertNotIn("latest_comments", posts[0])
+      self.assertNotIn("comment_count", posts[0])
+
+  @gen_test(timeout=10)
+  def test_slow_requests(self):
+    self.addCleanup(self.get_app().settings.__setitem__, "slow_request_threshold", 1.0)
+    self.get_app().settings["slow_request_threshold"] = 0.000001
+    user = yield self.db.users.insert({"username": "slow"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    yield self.http_client.fetch(self.get_url("/post/get_post?post_id=%s" % post))
+    response = yield self.http_client.fetch(self.get_url("/admin/slow_requests"), raise_error=False)
+    self.assertEqual(response.code, 403)
+    self.addCleanup(self.get_app().settings.__setitem__, "admin_token", "")
+    self.get_app().settings["admin_token"] = "secret"
+    response = yield self.http_client.fetch(self.get_url("/admin/slow_requests"), raise_error=False,
+                                            headers={"X-Admin-Token": "wrong"})
+    self.assertEqual(response.code, 403)
+    response = yield self.http_client.fetch(self.get_url("/admin/slow_requests"), headers={"X-Admin-Token": "secret"})
+    phases = dict(json.loads(response.body)[0]["phases"])
+    self.assertIn("mongo posts.find_one", phases)
+    self.assertIn("users", phases)
+    self.assertIn("serialize", phases)
+
+  @gen_test(timeout=10)
+  def test_compression(self):
+    user = yield self.db.users.insert({"username": "gzip"})
+    yield self.db.posts.insert([{"user_id": user, "title": "Test %s" % i, "text": "text " * 100, "tags": []}
+                                for i in range(10)])
+    url = self.get_url("/posts/by_user?length=10&user=%s" % user)
+    plain = yield self.http_client.fetch(url)
+    self.assertNotIn("Content-Encoding", plain.headers)
+    for _ in range(2):
+      response = yield self.http_client.fetch(url, headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+      self.assertEqual(response.headers["Content-Encoding"], "gzip")
+      self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+      self.assertNotEqual(response.headers["Etag"], plain.headers["Etag"])
+      self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), plain.body)
+    self.assertEqual(self.get_app().compression.stats()["gzip"]["cached"], 1)
+
+
+  @gen_test(timeout=10)
+  def test_ready_after_warm_up(self):
+    app = self.get_app()
+    self.addCleanup(setattr, app, "ready", app.ready)
+    app.ready = False
+    response = yield self.http_client.fetch(self.get_url("/ready"), raise_error=False)
+    self.assertEqual(response.code, 503)
+    user = yield self.db.users.insert({"username": "hot"})
+    yield self.db.posts.insert({"user_id": user, "title": "Hot", "text": "", "tags": [], "post_date": datetime.utcnow()})
+    yield app.warm_up()
+    self.assertIn(user, app.user_cache)
+    response = yield self.http_client.fetch(self.get_url("/ready"))
+    self.assertEqual(json.loads(response.body)["warmup"]["posts"], 1)
+
+
+  @gen_test(timeout=10)
+  def test_timeline(self):
+    app = self.get_app()
+    self.addCleanup(app.settings.__setitem__, "timeline_popular_threshold", app.settings["timeline_popular_threshold"])
+    app.settings["timeline_popular_threshold"] = 2
+    names = ("reader", "author", "star", "fan")
+    reader, author, star, fan = yield self.db.users.insert([{"username": name} for name in names])
+    yield self.db.posts.insert({"user_id": author, "title": "old", "text": "", "tags": [],
+                                "post_date": datetime.utcnow()})
+    follow = self.get_url("/user/follow")
+    for follower, followee in ((reader, author), (reader, star), (fan, star)):
+      response = yield self.http_client.fetch(follow, method="POST",
+                                              body=urllib.urlencode(dict(user=follower, followee=followee)))
+      self.assertEqual(json.loads(response.body), True)
+    for user, title in ((author, "new"), (star, "star")):
+      yield self.http_client.fetch(self.get_url("/post/create_post"), method="POST",
+                                   body=urllib.urlencode(dict(user=user, title=title)))
+    yield list(app.background_tasks)
+    # посты популярного автора (2 подписчика) в ленты не добавляются
+    timeline = yield self.db.timelines.find_one({"_id": fan})
+    self.assertIsNone(timeline)
+    url = self.get_url("/posts/timeline?length=2&user=%s" % reader)
+    response = yield self.http_client.fetch(url)
+    self.assertEqual([post["title"] for post in json.loads(response.body)], ["star", "new"])
+    response = yield self.http_client.fetch(url + "&cursor=" + response.headers["X-Next-Cursor"])
+    self.assertEqual([post["title"] for post in json.loads(response.body)], ["old"])
+    yield self.http_client.fetch(self.get_url("/user/unfollow"), method="POST",
+                                 body=urllib.urlencode(dict(user=reader, followee=author)))
+    response = yield self.http_client.fetch(url)
+    self.assertEqual([post["title"] for post in json.loads(response.body)], ["star"])
+
+
+  @gen_test(timeout=10)
+  def test_request_deadline(self):
+    user = yield self.db.users.insert({"username": "deadline"})
+    post = yield self.db.posts.insert({"user_id": user, "title": "Test", "text": "", "tags": []})
+    url = self.get_url("/post/get_post?post_id=%s" % post)
+    response = yield self.http_client.fetch(url, headers={"X-Request-Timeout": "0.000001"}, raise_error=False)
+    self.assertEqual(response.code, 504)
+    response = yield self.http_client.fetch(url, headers={"X-Request-Timeout": "5"})
+    self.assertEqual(json.loads(response.body)["title"], "Test")
+
+
+class LRUCacheTestCase(unittest.TestCase):
+  def test_eviction(self):
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    self.assertEqual(cache.get("b"), None)
+    self.assertEqual(cache.get("a"), 1)
+    self.assertEqual(cache.stats()["evictions"], 1)
+
+  def test_ttl(self):
+    now = [0]
+    cache = LRUCache(maxsize=10, ttl=5, timer=lambda: now[0])
+    cache.set("a", 1)
+    found, missed = cache.get_many(["a", "b"])
+    self.assertEqual(found, {"a": 1})
+    self.assertEqual(missed, ["b"])
+    now[0] = 10
+    self.assertEqual(cache.get("a"), None)
+    self.assertEqual(cache.hits, 1)
+    self.assertEqual(cache.misses, 2)
+
+  def test_bloom_filter(self):
+    ids = [ObjectId() for _ in range(1000)]
+    bloom = BloomFilter(len(ids))
+    bloom.update(ids)
+    self.assertTrue(all(_id in bloom for _id in ids))
+    false_positives = sum(ObjectId() in bloom for _ in range(1000))
+    self.assertLess(false_positives, 50)
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+  def test_cursor_roundtrip(self):
+    doc = {"_id": ObjectId(), "post_date": datetime(2017, 10, 1, 12, 30, 15, 123000, tzinfo=utc)}
+    value, _id = decode_cursor(encode_cursor(doc, "post_date"))
+    self.assertEqual(value, doc["post_date"])
+    self.assertEqual(_id, doc["_id"])
+
+  def test_keyset_query(self):
+    doc = {"_id": ObjectId(), "comment_date": datetime(2017, 10, 1, tzinfo=utc)}
+    query, sort = keyset_query({"post_id": 1}, "comment_date", -1, encode_cursor(doc, "comment_date"))
+    self.assertEqual(sort, [("comment_date", -1), ("_id", -1)])
+    self.assertEqual(query["post_id"], 1)
+    self.assertEqual(query["$or"][1], {"comment_date": doc["comment_date"], "_id": {"$lt": doc["_id"]}})
+    self.assertEqual(query["comment_date"], {"$lte": doc["comment_date"]})
+    query, sort = keyset_query({}, None, 1, encode_cursor(doc, None))
+    self.assertEqual(query, {"_id": {"$gt": doc["_id"]}})
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+  def test_invalidation(self):
+    cache = ResponseCache(maxsize=10)
+    key1 = cache.make_key("/posts/posts", {"tags": ["a"], "length": ["5"]})
+    self.assertEqual(key1, cache.make_key("/posts/posts", {"length": ["5"], "tags": ["a"]}))
+    # ?title=a&min_date=b и ?title=a%26min_date%3Db - разные запросы
+    self.assertNotEqual(cache.make_key("/posts/posts", {"title": ["a"], "min_date": ["b"]}),
+                        cache.make_key("/posts/posts", {"title": ["a&min_date=b"]}))
+    self.assertNotEqual(cache.make_key("/posts/posts", {"tags": ["a", "b"]}),
+                        cache.make_key("/posts/posts", {"tags": ["a,b"]}))
+    key2 = cache.make_key("/posts/posts", {"tags": ["b"]})
+    cache.set(key1, "[1]", {}, cache.snapshot([("tag", "a")]))
+    cache.set(key2, "[2]", {}, cache.snapshot([("tag", "b")]))
+    cache.invalidate(("tag", "a"))
+    self.assertIsNone(cache.get(key1))
+    self.assertEqual(cache.get(key2).body, "[2]")
+
+  def test_write_during_query(self):
+    cache = ResponseCache(maxsize=10)
+    post = ObjectId()
+    deps = cache.snapshot([("post", post)])
+    cache.invalidate(("post", post))
+    key = cache.make_key("/post/get_post", {"post_id": [str(post)]})
+    cache.set(key, "{}", {}, deps)
+    self.assertIsNone(cache.get(key))
+
+  def test_invalidated_within(self):
+    now = [100.0]
+    cache = ResponseCache(maxsize=10, timer=lambda: now[0])
+    post = ObjectId()
+    deps = cache.snapshot([("post", post)])
+    self.assertFalse(cache.invalidated_within(deps, 90))
+    self.assertFalse(cache.invalidated_within(deps, -1))
+    cache.invalidate(("post", post))
+    now[0] = 150.0
+    self.assertTrue(cache.invalidated_within(deps, 90))
+    now[0] = 200.0
+    self.assertFalse(cache.invalidated_within(deps, 90))
+    self.assertTrue(cache.invalidated_within(deps, -1))
+
+
+class SerializerTestCase(unittest.TestCase):
+  def test_dumps(self):
+    _id = ObjectId()
+    doc = {"_id": _id, "date": datetime(2017, 10, 1, 12, 0), "tags": set(["a"]), "re": re.compile("x"),
+           "other": object()}
+    self.assertEqual(json.loads(serializer.dumps(doc)), {"_id": str(_id), "date": "2017-10-01T12:00:00",
+                                                         "tags": ["a"], "re": "x", "other": None})
+
+  def test_subclass(self):
+    class Date(datetime):
+      pass
+    self.assertEqual(serializer.default(Date(2017, 10, 1)), "2017-10-01T00:00:00")
+
+
+class DateParserTestCase(unittest.TestCase):
+  def test_fast_paths(self):
+    self.assertEqual(parse_date("2017-10-01"), datetime(2017, 10, 1))
+    self.assertEqual(parse_date("2017-10-01T12:30:15.5Z"), datetime(2017, 10, 1, 12, 30, 15, 500000, tzinfo=utc))
+    self.assertEqual(parse_date("2017-10-01T12:30+03:00").utcoffset().total_seconds(), 3 * 3600)
+    self.assertEqual(parse_date("01.10.2017 12:30"), datetime(2017, 10, 1, 12, 30))
+    self.assertEqual(parse_date("2017.10.01"), datetime(2017, 10, 1))
+    self.assertEqual(parse_date("2017/10/01 12:30"), datetime(2017, 10, 1, 12, 30))
+    self.assertEqual(parse_date("1506800000"), datetime.fromtimestamp(1506800000))
+    self.assertEqual(parse_date("1506800000000"), datetime.fromtimestamp(1506800000))
+
+  def test_fallback(self):
+    self.assertEqual(parse_date("1 Oct 2017"), datetime(2017, 10, 1))
+    self.assertEqual(parse_date("not a date"), None)
+    # недопустимое значение в формате быстрого разбора не передается dateutil
+    self.assertEqual(parse_date("2017-13-01"), None)
+    self.assertEqual(parse_date("31.02.2017"), None)
+    self.assertEqual(todate(u"31.12.2017"), datetime(2017, 12, 31))
+    now = datetime.now()
+    self.assertIs(todate(now), now)
+
+  def test_failed_parse_cached(self):
+    parse_date("not a date either")
+    self.assertIn("not a date either", dates._cache)
+    self.assertEqual(parse_date("not a date either"), None)
+
+
+class MetricsTestCase(unittest.TestCase):
+  class Event(object):
+    def __init__(self, command_name, command, duration_micros=0):
+      self.command_name = command_name
+      self.command = command
+      self.duration_micros = duration_micros
+      self.connection_id = ("localhost", 27017)
+      self.request_id = 1
+
+  def test_render(self):
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", ("handler",))
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    counter.inc(("a\"b",))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    lines = registry.render().splitlines()
+    self.assertIn("# TYPE requests_total counter", lines)
+    self.assertIn('requests_total{handler="a\\"b"} 1', lines)
+    self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+    self.assertIn('latency_seconds_bucket{le="1.0"} 2', lines)
+    self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+    self.assertIn("latency_seconds_count 3", lines)
+    self.assertEqual(histogram.get(), (3, 5.55))
+
+  def test_command_timer(self):
+    timer = CommandTimer(Registry())
+    timer.started(self.Event("find", {"find": "posts", "filter": {}}))
+    timer.succeeded(self.Event("find", None, 2000))
+    timer.started(self.Event("getMore", {"getMore": 1, "collection": "posts"}))
+    timer.failed(self.Event("getMore", None, 1000))
+    self.assertEqual(timer.duration.get(("posts", "find")), (1, 0.002))
+    self.assertEqual(timer.failures.get(("posts", "getMore")), 1)
+
+
+class ReadRoutingTestCase(unittest.TestCase):
+  def test_parse(self):
+    self.assertEqual(parse_read_routing(" /posts/posts=secondaryPreferred, /post/get_post=primary,"),
+                     {"/posts/posts": "secondaryPreferred", "/post/get_post": "primary"})
+    self.assertRaises(ValueError, parse_read_routing, "/posts/posts=secondaryFirst")
+
+  def test_read_database(self):
+    application = RestApplication(mongo_host, mongo_port, mongo_db_name, metrics=False, read_max_staleness=120,
+                                  read_routing="/posts/posts=secondaryPreferred")
+    db = application.read_database("/posts/posts")
+    self.assertEqual(db.read_preference.mongos_mode, "secondaryPreferred")
+    self.assertEqual(db.read_preference.max_staleness, 120)
+    self.assertEqual(application.read_database("/post/get_post").read_preference.mongos_mode, "primary")
+    self.assertIs(application.read_database("/posts/posts", pinned=True), application.motor)
+
+  def test_read_your_writes_window(self):
+    application = RestApplication(mongo_host, mongo_port, mongo_db_name, metrics=False, read_max_staleness=120,
+                                  read_routing="/posts/posts=secondaryPreferred", read_your_writes_window=5)
+    self.assertEqual(application.settings["read_your_writes_window"], 120)
+    application = RestApplication(mongo_host, mongo_port, mongo_db_name, metrics=False, read_your_writes_window=5)
+    self.assertEqual(application.settings["read_your_writes_window"], 5)
+
+
+class WarmUpTestCase(AsyncTestCase):
+  @gen_test
+  def test_retry(self):
+    application = RestApplication(mongo_host, mongo_port, mongo_db_name, metrics=False, warmup_retry_delay=0)
+    attempts = []
+
+    @gen.coroutine
+    def warm_up():
+      attempts.append(application.ready)
+      if len(attempts) == 1:
+        raise IOError("mongodb is not available")
+
+    application._warm_up = warm_up
+    yield application.warm_up()
+    self.assertEqual(attempts, [False, False])
+    self.assertTrue(application.ready)
+    self.assertEqual(application.warmup["attempts"], 2)
+    self.assertNotIn("error", application.warmup)
+
+  @gen_test
+  def test_stop_while_retrying(self):
+    application = RestApplication(mongo_host, mongo_port, mongo_db_name, metrics=False, warmup_retry_delay=0)
+
+    @gen.coroutine
+    def warm_up():
+      application.stopping = True
+      raise IOError("mongodb is not available")
+
+    application._warm_up = warm_up
+    yield application.warm_up()
+    self.assertFalse(application.ready)
+    self.assertEqual(application.warmup["error"], "mongodb is not available")
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+  def test_collapsed(self):
+    profiler = SamplingProfiler(thread.get_ident())
+
+    def leaf():
+      profiler.sample()
+
+    leaf()
+    leaf()
+    stack, count = profiler.collapsed().splitlines()[0].rsplit(" ", 1)
+    self.assertEqual(count, "2")
+    self.assertTrue(stack.split(";")[-2].startswith("tests.base:leaf:"))
+
+
+class LogQueueTestCase(unittest.TestCase):
+  class ListHandler(logging.Handler):
+    def __init__(self):
+      logging.Handler.__init__(self)
+      self.messages = []
+
+    def emit(self, record):
+      self.messages.append(self.format(record))
+
+  def test_overflow_and_listener(self):
+    queue = Queue(2)
+    handler = QueueHandler(queue)
+    log = logging.getLogger("tests.log_queue")
+    log.propagate = False
+    log.addHandler(handler)
+    self.addCleanup(log.removeHandler, handler)
+    for i in range(3):
+      log.warning("record %s", i)
+    self.assertEqual(handler.dropped, 1)
+    target = self.ListHandler()
+    listener = QueueListener(queue, target)
+    listener.start()
+    listener.stop()
+    self.assertEqual(target.messages, ["record 0", "record 1"])
+
+
+class TimelinesTestCase(unittest.TestCase):
+  def test_merge_entries(self):
+    first, second, third = ObjectId(), ObjectId(), ObjectId()
+    date = datetime(2017, 1, 1)
+    entries = [{"_id": second, "post_date": date}, {"_id": first, "post_date": date}]
+    posts = [{"_id": third, "post_date": datetime(2017, 1, 2), "title": "popular"},
+             {"_id": second, "post_date": date, "title": "fetched"}]
+    page = merge_entries(posts, entries, 2)
+    self.assertEqual([item["_id"] for item in page], [third, second])
+    self.assertEqual(page[1]["title"], "fetched")
+
+
+class CompressionTestCase(unittest.TestCase):
+  def test_negotiate(self):
+    compression = Compression(["gzip"])
+    self.assertEqual(compression.negotiate("gzip, deflate"), "gzip")
+    self.assertEqual(compression.negotiate("deflate, *;q=0.5"), "gzip")
+    self.assertIsNone(compression.negotiate("gzip;q=0, *"))
+    self.assertIsNone(compression.negotiate("identity"))
+    self.assertIsNone(compression.negotiate(""))
+
+  def test_gzip(self):
+    compression = Compression(["gzip"])
+    body = "[" + ",".join(['{"title": "test"}'] * 100) + "]"
+    self.assertEqual(zlib.decompress(compression.compress("gzip", body), 16 + zlib.MAX_WBITS), body)
+    stream = compression.stream("gzip")
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # после каждой части клиент может распаковать все, что уже получил
+    self.assertEqual(decompressor.decompress(stream.process("[1,")), "[1,")
+    self.assertEqual(decompressor.decompress(stream.process("2]", flush=False) + stream.finish()), "2]")
+    stats = compression.stats()["gzip"]
+    self.assertEqual(stats["responses"], 2)
+    self.assertEqual(stats["bytes_in"], len(body) + 5)
+
+
+class AdmissionTestCase(AsyncTestCase):
+  @gen_test(timeout=5)
+  def test_queue(self):
+    admission = Admission(max_in_flight=1, queue_size=1, queue_timeout=0.05)
+    first = admission.ticket("/posts/posts")
+    self.assertIsNone(first.acquire())
+    second = admission.ticket("/posts/posts")
+    waiter = second.acquire()
+    self.assertIsNotNone(waiter)
+    with self.assertRaises(Rejected):
+      admission.ticket("/posts/posts").acquire()
+    # место завершившегося запроса передается первому в очереди
+    first.release()
+    yield waiter
+    third = admission.ticket("/posts/posts")
+    with self.assertRaises(Rejected):
+      yield third.acquire()
+    third.release()
+    second.release()
+    self.assertEqual(admission.global_limiter.in_flight, 0)
+    self.assertEqual(admission.global_limiter.rejected, {"queue_full": 1, "queue_timeout": 1})
+
+  @gen_test(timeout=5)
+  def test_cancel_queued(self):
+    admission = Admission(max_in_flight=1, queue_size=1, queue_timeout=0.05)
+    first = admission.ticket("/posts/posts")
+    first.acquire()
+    second = admission.ticket("/posts/posts")
+    waiter = second.acquire()
+    # клиент закрыл соединение, пока запрос ждал в очереди
+    second.cancel(Cancelled())
+    with self.assertRaises(Cancelled):
+      yield waiter
+    self.assertEqual(admission.global_limiter.queued, 0)
+    second.release()
+    yield gen.sleep(0.1)
+    first.release()
+    self.assertEqual(admission.global_limiter.in_flight, 0)
+    self.assertEqual(admission.global_limiter.rejected, {})
+
+  def test_check_rate(self):
+    admission = Admission(rate_limits={"/post/create_post": (1, 1)})
+    admission.check_rate("/post/create_post", [("ip", "1.1.1.1"), ("user", "a")])
+    # другой пользователь с того же IP ограничен ограничением IP
+    with self.assertRaises(Rejected):
+      admission.check_rate("/post/create_post", [("ip", "1.1.1.1"), ("user", "b")])
+    with self.assertRaises(Rejected):
+      admission.check_rate("/post/create_post", [("ip", "2.2.2.2"), ("user", "a")])
+    admission.check_rate("/post/create_post", [("ip", "3.3.3.3"), ("user", "b")])
+
+  def test_rate_limiter(self):
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=2, timer=lambda: now[0])
+    self.assertEqual([limiter.take("user") for _ in range(3)], [0, 0, 1])
+    self.assertEqual(limiter.take("other"), 0)
+    now[0] = 0.5
+    self.assertEqual(limiter.take("user"), 0)
+    self.assertEqual(limiter.rejected, 1)
+
+
+class DeadlineTestCase(unittest.TestCase):
+  class Cursor(object):
+    def __init__(self):
+      self.alive = True
+      self.max_time = None
+
+    def max_time_ms(self, max_time):
+      self.max_time = max_time
+      return self
+
+    def close(self):
+      self.alive = False
+
+  class Collection(object):
+    def find(self, *args, **kwargs):
+      return DeadlineTestCase.Cursor()
+
+    def find_one(self, *args, **kwargs):
+      return kwargs
+
+  def test_remaining_time(self):
+    now = [100.0]
+    deadline = Deadline(101.5, timer=lambda: now[0])
+    db = DeadlineDatabase({"posts": self.Collection()}, deadline)
+    self.assertEqual(db["posts"].find({}).max_time, 1500)
+    now[0] = 101.0
+    self.assertEqual(db["posts"].find_one({}), {"max_time_ms": 500})
+    now[0] = 101.5
+    with self.assertRaises(DeadlineExceeded):
+      db["posts"].find({})
+
+  def test_cancel(self):
+    deadline = Deadline()
+    db = DeadlineDatabase({"posts": self.Collection()}, deadline)
+    cursor = db["posts"].find({})
+    self.assertIsNone(cursor.max_time)
+    deadline.cancel()
+    self.assertFalse(cursor.alive)
+    with self.assertRaises(Cancelled):
+      db["posts"].find_one({})
+
+
+class SupervisorTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp)
+    self.broken = os.path.join(self.tmp, "broken")
+
+  def target(self, worker_id):
+    open(os.path.join(self.tmp, "worker-%s" % os.getpid()), "w").close()
+    if os.path.exists(self.broken):
+      sys.exit(1)
+    notify_ready()
+    time.sleep(30)
+
+  def start(self, **kwargs):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        Supervisor(1, self.target, **kwargs).run()
+      finally:
+        os._exit(0)
+    self.addCleanup(self.stop, pid)
+    return pid
+
+  def stop(self, pid):
+    try:
+      os.kill(pid, signal.SIGTERM)
+      os.waitpid(pid, 0)
+    except OSError:
+      pass
+
+  def workers(self):
+    names = sorted(os.listdir(self.tmp), key=lambda name: os.path.getmtime(os.path.join(self.tmp, name)))
+    return [int(name.split("-")[1]) for name in names if name.startswith("worker-")]
+
+  def alive(self, pid):
+    try:
+      os.kill(pid, 0)
+    except OSError:
+      return False
+    return True
+
+  def wait_for(self, predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+      self.assertLess(time.time(), deadline)
+      time.sleep(0.02)
+
+  def test_restart(self):
+    open(self.broken, "w").close()
+    self.start(min_uptime=10, restart_delay=0.05)
+    # упавший процесс запускается снова
+    self.wait_for(lambda: len(self.workers()) >= 3)
+
+  def test_rolling_reload(self):
+    supervisor = self.start(ready_timeout=5)
+    self.wait_for(lambda: len(self.workers()) == 1)
+    old = self.workers()[0]
+    os.kill(supervisor, signal.SIGHUP)
+    self.wait_for(lambda: len(self.workers()) == 2 and not self.alive(old))
+    current = self.workers()[1]
+    # новый процесс падает при запуске: замена прекращается, работающий процесс не останавливается
+    open(self.broken, "w").close()
+    os.kill(supervisor, signal.SIGHUP)
+    self.wait_for(lambda: len(self.workers()) == 3)
+    time.sleep(0.3)
+    self.assertTrue(self.alive(current))
+    self.assertEqual(len(self.workers()), 3)
+
+
+class WriteBehindBufferTestCase(AsyncTestCase):
+  class Collection(object):
+    def __init__(self):
+      self.batches = []
+
+    @gen.coroutine
+    def insert_many(self, docs, ordered=True):
+      self.batches.append(list(docs))
+
+  @gen_test(timeout=5)
+  def test_flush_by_size_and_close(self):
+    collection = self.Collection()
+    buf = WriteBehindBuffer(collection, batch_size=2, flush_interval=10, max_size=10)
+    yield [buf.put({"_id": 1}), buf.put({"_id": 2})]
+    self.assertEqual(collection.batches, [[{"_id": 1}, {"_id": 2}]])
+    yield buf.put({"_id": 3}, wait_flush=False)
+    self.assertEqual(len(buf), 1)
+    yield buf.close()
+    self.assertEqual(collection.batches[-1], [{"_id": 3}])
+    self.assertEqual(buf.flushed, 3)
+
+  @gen_test(timeout=5)
+  def test_on_write(self):
+    collection = self.Collection()
+    written = []
+
+    @gen.coroutine
+    def on_write(docs):
+      written.append([doc["_id"] for doc in docs])
+    buf = WriteBehindBuffer(collection, batch_size=2, flush_interval=10, on_write=on_write)
+    yield [buf.put({"_id": 1}), buf.put({"_id": 2})]
+    # пачка обработана до ответа ожидающим
+    self.assertEqual(written, [[1, 2]])
+
+  @gen_test(timeout=5)
+  def test_flush_by_interval(self):
+    collection = self.Collection()
+    buf = WriteBehindBuffer(collection, batch_size=100, flush_interval=0.01)
+    yield buf.put({"_id": 1})
+    self.assertEqual(collection.batches, [[{"_id": 1}]])
+
 if __name__ == "main":
   unittest.main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import math
+import time
+from collections import Counter, deque
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.web import HTTPError
+
+from utils.cache import LRUCache
+
+"""
+Модуль содержит контроль нагрузки (admission control): ограничение количества одновременно обрабатываемых запросов
+(общее и по путям) с ограниченной очередью ожидания и ограничение частоты запросов клиентов (token bucket). Запрос,
+который не помещается в очередь или ждет в ней дольше заданного времени, сразу получает 503, а не ждет свободного
+соединения пула MongoDB вместе со всеми остальными; клиент, превысивший частоту запросов, получает 429.
+"""
+
+
+class Rejected(HTTPError):
+  """
+  Запрос отклонен контролем нагрузки. В лог не пишется (при перегрузке таких запросов много), клиенту передается
+  Retry-After.
+  """
+  def __init__(self, status_code, reason, retry_after=1):
+    HTTPError.__init__(self, status_code, reason=reason)
+    self.retry_after = retry_after
+
+
+def parse_limits(value, parse=int):
+  """
+  Метод разбирает настройку ограничений по путям
+
+  :param value: строка вида "/posts/posts=100,/bulk/posts=4"
+  :param parse: функция разбора значения
+  :return: словарь путь -> значение
+  """
+  limits = {}
+  for item in value.split(","):
+    path, _, limit = item.strip().partition("=")
+    if path and limit:
+      limits[path.strip()] = parse(limit.strip())
+  return limits
+
+
+def parse_rate(value):
+  """
+  Метод разбирает частоту запросов "rate:burst" (запросов в секунду и размер пачки) или "rate" (пачка - 1 запрос)
+
+  :return: кортеж (rate, burst)
+  """
+  rate, _, burst = value.partition(":")
+  return float(rate), float(burst or 1)
+
+
+class ConcurrencyLimiter(object):
+  def __init__(self, name, limit, queue_size=0, queue_timeout=1.0):
+    """
+    Инициализация ограничителя одновременных запросов
+
+    :param name: название (путь или "*" для общего ограничения)
+    :param limit: максимальное количество одновременно обрабатываемых запросов
+    :param queue_size: максимальное количество запросов, ожидающих своей очереди
+    :param queue_timeout: максимальное время ожидания в очереди, секунд
+    """
+    self.name = name
+    self.limit = limit
+    self.queue_size = queue_size
+    self.queue_timeout = queue_timeout
+    self.in_flight = 0
+    self.rejected = Counter()
+    self._waiters = deque()
+
+  @property
+  def queued(self):
+    return len(self._waiters)
+
+  def acquire(self):
+    """
+    Метод занимает место для запроса
+
+    :return: None - место получено, Future - запрос поставлен в очередь (Future завершится, когда место
+             освободится, либо исключением Rejected по истечении queue_timeout)
+    """
+    if self.in_flight < self.limit and not self._waiters:
+      self.in_flight += 1
+      return None
+    if len(self._waiters) >= self.queue_size:
+      self.rejected["queue_full"] += 1
+      raise Rejected(503, "Overloaded")
+    waiter = Future()
+    self._waiters.append(waiter)
+    io_loop = IOLoop.current()
+    timeout = io_loop.call_later(self.queue_timeout, self._expire, waiter)
+    waiter.add_done_callback(lambda _: io_loop.remove_timeout(timeout))
+    return waiter
+
+  def _expire(self, waiter):
+    if not waiter.done():
+      self._waiters.remove(waiter)
+      self.rejected["queue_timeout"] += 1
+      waiter.set_exception(Rejected(503, "Overloaded"))
+
+  def cancel(self, waiter, exception):
+    """
+    Метод убирает из очереди запрос, завершившийся или отмененный до получения места
+
+    :param waiter: Future, полученный от acquire
+    :param exception: исключение, которым завершается ожидание
+    """
+    if not waiter.done():
+      self._waiters.remove(waiter)
+      waiter.set_exception(exception)
+
+  def release(self):
+    """
+    Метод освобождает место: оно сразу передается первому запросу в очереди
+    """
+    while self._waiters:
+      waiter = self._waiters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        return
+    self.in_flight -= 1
+
+
+class RateLimiter(object):
+  def __init__(self, rate, burst, max_clients=100000, timer=time.time):
+    """
+    Инициализация ограничителя частоты запросов (token bucket на каждого клиента)
+
+    :param rate: запросов в секунду (скорость пополнения)
+    :param burst: размер пачки запросов (емкость)
+    :param max_clients: количество клиентов, для которых хранится состояние (давно не обращавшиеся вытесняются)
+    :param timer: функция получения текущего времени
+    """
+    self.rate = rate
+    self.burst = burst
+    self.rejected = 0
+    self._timer = timer
+    self._buckets = LRUCache(max_clients)
+
+  def take(self, key):
+    """
+    Метод расходует запрос клиента
+
+    :param key: клиент (пользователь или IP)
+    :return: 0 - запрос разрешен, иначе через сколько секунд клиент может повторить запрос
+    """
+    now = self._timer()
+    bucket = self._buckets.get(key, count=False)
+    tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+    if tokens < 1:
+      self._buckets.set(key, (tokens, now))
+      self.rejected += 1
+      return int(math.ceil((1 - tokens) / self.rate))
+    self._buckets.set(key, (tokens - 1, now))
+    return 0
+
+
+class Ticket(object):
+  """
+  Места, занятые запросом в ограничителях; освобождаются при завершении запроса (release)
+  """
+  def __init__(self, limiters):
+    self._limiters = limiters
+    self._held = []
+
+  def acquire(self):
+    """
+    Метод занимает место запроса во всех ограничителях по порядку
+
+    :return: None - места получены, Future - запрос ждет в очереди
+    """
+    for position, limiter in enumerate(self._limiters):
+      waiter = limiter.acquire()
+      self._held.append((limiter, waiter))
+      if waiter is not None:
+        return self._wait(waiter, self._limiters[position + 1:])
+    return None
+
+  @gen.coroutine
+  def _wait(self, waiter, limiters):
+    yield waiter
+    for limiter in limiters:
+      waiter = limiter.acquire()
+      self._held.append((limiter, waiter))
+      if waiter is not None:
+        yield waiter
+
+  def cancel(self, exception):
+    """
+    Метод убирает запрос из очередей, в которых он еще ждет (клиент закрыл соединение): ожидание завершается
+    исключением exception. Уже полученные места освобождаются в release.
+
+    :param exception: исключение, которым завершается ожидание
+    """
+    for limiter, waiter in self._held:
+      if waiter is not None:
+        limiter.cancel(waiter, exception)
+
+  def release(self):
+    for limiter, waiter in self._held:
+      if waiter is None or (waiter.done() and waiter.exception() is None):
+        limiter.release()
+      else:
+        limiter.cancel(waiter, Rejected(503, "Overloaded"))
+    self._held = []
+
+
+class Admission(object):
+  def __init__(self, max_in_flight=0, route_limits=None, queue_size=0, queue_timeout=1.0, rate_limits=None,
+               rate_limit_clients=100000):
+    """
+    Инициализация контроля нагрузки
+
+    :param max_in_flight: общее ограничение одновременных запросов (0 - без ограничения)
+    :param route_limits: словарь путь -> ограничение одновременных запросов по этому пути
+    :param queue_size: размер очереди ожидания каждого ограничения
+    :param queue_timeout: максимальное время ожидания в очереди, секунд
+    :param rate_limits: словарь путь -> (запросов в секунду, размер пачки) на клиента (IP и пользователя)
+    :param rate_limit_clients: количество клиентов, для которых хранится состояние ограничения частоты
+    """
+    self.global_limiter = None
+    if max_in_flight:
+      self.global_limiter = ConcurrencyLimiter("*", max_in_flight, queue_size, queue_timeout)
+    self.route_limiters = dict((path, ConcurrencyLimiter(path, limit, queue_size, queue_timeout))
+                               for path, limit in (route_limits or {}).items())
+    self.rate_limiters = dict((path, RateLimiter(rate, burst, rate_limit_clients))
+                              for path, (rate, burst) in (rate_limits or {}).items())
+
+  def check_rate(self, path, clients):
+    """
+    Метод проверяет частоту запросов клиента по пути: запрос должен уложиться в ограничение каждого из ключей
+    клиента (например, IP и пользователя)
+
+    :param path: путь запроса
+    :param clients: ключи клиента
+    :raise Rejected: 429, если частота превышена
+    """
+    limiter = self.rate_limiters.get(path)
+    if limiter is not None:
+      for client in clients:
+        retry_after = limiter.take(client)
+        if retry_after:
+          raise Rejected(429, "Too Many Requests", retry_after)
+
+  def ticket(self, path):
+    """
+    Метод возвращает места запроса по пути в ограничителях (сначала ограничение пути, затем общее)
+
+    :param path: путь запроса
+    :return: Ticket
+    """
+    limiters = []
+    if path in self.route_limiters:
+      limiters.append(self.route_limiters[path])
+    if self.global_limiter is not None:
+      limiters.append(self.global_limiter)
+    return Ticket(limiters)
+
+  def limiters(self):
+    return ([self.global_limiter] if self.global_limiter is not None else []) + self.route_limiters.values()
+
+  def stats(self):
+    """
+    :return: словарь с состоянием ограничений одновременных запросов (limits: название -> limit, in_flight,
+             queued, rejected по причинам) и количеством запросов, отклоненных по частоте (rate_limited: путь ->
+             количество)
+    """
+    return {
+      "limits": dict((limiter.name, {
+        "limit": limiter.limit,
+        "in_flight": limiter.in_flight,
+        "queued": limiter.queued,
+        "rejected": dict(limiter.rejected)
+      }) for limiter in self.limiters()),
+      "rate_limited": dict((path, limiter.rejected) for path, limiter in self.rate_limiters.items())
+    }
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import hashlib
+import math
+import struct
+import time
+from collections import OrderedDict
+
+"""
+Модуль содержит внутрипроцессные кэши, используемые сервером
+"""
+
+_missing = object()
+
+
+class LRUCache(object):
+  """
+  Ограниченный по размеру кэш с вытеснением давно не использованных записей (LRU) и временем жизни записей (TTL).
+  Кэш не потокобезопасен - предполагается, что им пользуется только IOLoop.
+  """
+  def __init__(self, maxsize=10000, ttl=None, timer=time.time):
+    """
+    Инициализация кэша
+
+    :param maxsize: максимальное количество записей
+    :param ttl: время жизни записи в секундах (None или 0 - записи не устаревают)
+    :param timer: функция получения текущего времени
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._timer = timer
+    self._data = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self._data)
+
+  def __contains__(self, key):
+    return self.get(key, _missing, count=False) is not _missing
+
+  def get(self, key, default=None, count=True):
+    """
+    Метод возвращает значение по ключу и помечает запись как недавно использованную
+
+    :param key: ключ
+    :param default: значение, возвращаемое при отсутствии (или устаревании) записи
+    :param count: учитывать ли обращение в счетчиках попаданий/промахов
+    :return: значение из кэша или default
+    """
+    item = self._data.pop(key, _missing)
+    if item is not _missing:
+      value, expires = item
+      if expires is None or expires > self._timer():
+        self._data[key] = item
+        if count:
+          self.hits += 1
+        return value
+    if count:
+      self.misses += 1
+    return default
+
+  def get_many(self, keys):
+    """
+    Метод получает сразу несколько значений
+
+    :param keys: набор ключей
+    :return: кортеж (словарь найденных значений, список отсутствующих ключей)
+    """
+    found = {}
+    missed = []
+    for key in keys:
+      value = self.get(key, _missing)
+      if value is _missing:
+        missed.append(key)
+      else:
+        found[key] = value
+    return found, missed
+
+  def set(self, key, value):
+    """
+    Метод сохраняет значение в кэше, при переполнении вытесняя самые старые записи
+
+    :param key: ключ
+    :param value: значение
+    """
+    expires = self._timer() + self.ttl if self.ttl else None
+    self._data.pop(key, None)
+    self._data[key] = (value, expires)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def delete(self, key):
+    """
+    Метод удаляет запись из кэша
+
+    :param key: ключ
+    """
+    self._data.pop(key, None)
+
+  def clear(self):
+    self._data.clear()
+
+  def stats(self):
+    """
+    Метод возвращает статистику использования кэша
+
+    :return: словарь со счетчиками
+    """
+    return {
+      "size": len(self._data),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions
+    }
+
+
+class BloomFilter(object):
+  """
+  Фильтр Блума: проверка принадлежности множеству без хранения его элементов. Ответ "нет" точен, ответ "да"
+  ошибочен с вероятностью error_rate (при количестве элементов не больше capacity).
+  """
+  def __init__(self, capacity, error_rate=0.01):
+    """
+    Инициализация фильтра
+
+    :param capacity: ожидаемое количество элементов
+    :param error_rate: допустимая вероятность ложноположительного ответа
+    """
+    capacity = max(capacity, 1)
+    self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+    self._bits = bytearray((self.size + 7) // 8)
+
+  def _positions(self, key):
+    first, second = struct.unpack("<QQ", hashlib.md5(str(key)).digest())
+    return [(first + i * second) % self.size for i in range(self.hashes)]
+
+  def __contains__(self, key):
+    return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+  def add(self, key):
+    for position in self._positions(key):
+      self._bits[position >> 3] |= 1 << (position & 7)
+
+  def update(self, keys):
+    for key in keys:
+      self.add(key)
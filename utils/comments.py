@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+from collections import OrderedDict
+
+from pymongo import UpdateOne
+from tornado import gen
+
+"""
+Модуль содержит комментарии, встроенные в пост: счетчик comment_count и список latest_comments последних
+комментариев (с именем пользователя), поэтому пост с последними комментариями читается одним запросом.
+Посты обновляются после записи комментариев, без ограничения времени запроса (см. utils.deadline): запись уже
+выполнена, и прерванное обновление оставило бы счетчик неверным. Для постов, созданных до появления счетчика (или
+комментариев, записанных в БД в обход API), счетчики пересчитываются функцией rebuild_comment_counts.
+"""
+
+
+@gen.coroutine
+def get_usernames(db, user_cache, user_ids):
+  """
+  Метод возвращает имена пользователей (из кэша пользователей, отсутствующие - одним запросом к БД)
+
+  :param db: база данных (MotorDatabase)
+  :param user_cache: кэш пользователей (utils.cache.LRUCache)
+  :param user_ids: идентификаторы пользователей
+  :return: словарь _id -> имя пользователя
+  """
+  users, missed = user_cache.get_many(set(user_ids))
+  if missed:
+    docs = yield db.users.find({"_id": {"$in": missed}}).to_list(len(missed))
+    for user in docs:
+      user_cache.set(user["_id"], user)
+      users[user["_id"]] = user
+  raise gen.Return(dict((_id, user.get("username", u"")) for _id, user in users.items()))
+
+
+@gen.coroutine
+def embed_comments(db, user_cache, comments, size):
+  """
+  Метод обновляет посты созданных комментариев: увеличивает счетчик comment_count и добавляет комментарии
+  в конец списка latest_comments, оставляя в нем size последних. Каждый пост обновляется одной атомарной
+  операцией $inc/$push с $slice.
+
+  :param db: база данных (MotorDatabase)
+  :param user_cache: кэш пользователей (utils.cache.LRUCache)
+  :param comments: документы записанных комментариев
+  :param size: максимальная длина latest_comments (0 - список не ведется)
+  :return: идентификаторы обновленных постов
+  """
+  usernames = yield get_usernames(db, user_cache, [comment["user_id"] for comment in comments])
+  posts = OrderedDict()
+  for comment in sorted(comments, key=lambda comment: comment["comment_date"]):
+    posts.setdefault(comment["post_id"], []).append({
+      "_id": comment["_id"],
+      "username": usernames.get(comment["user_id"], u""),
+      "text": comment["text"],
+      "comment_date": comment["comment_date"]
+    })
+  if not posts:
+    raise gen.Return([])
+  updates = []
+  for post_id, items in posts.items():
+    update = {"$inc": {"comment_count": len(items)}}
+    if size:
+      update["$push"] = {"latest_comments": {"$each": items, "$slice": -size}}
+    updates.append(UpdateOne({"_id": post_id}, update))
+  yield db.posts.bulk_write(updates, ordered=False)
+  raise gen.Return(list(posts))
+
+
+@gen.coroutine
+def rebuild_comment_counts(db, batch_size=1000):
+  """
+  Метод пересчитывает счетчики comment_count всех постов по коллекции comments (посты без комментариев получают 0).
+  Выполняется до начала приема запросов: комментарии, созданные во время пересчета, могут быть не учтены.
+
+  :param db: база данных (MotorDatabase)
+  :param batch_size: количество постов в одном bulk_write
+  """
+  cursor = db.comments.aggregate([{"$group": {"_id": "$post_id", "count": {"$sum": 1}}}], allowDiskUse=True,
+                                 batchSize=batch_size)
+  updates = []
+  while (yield cursor.fetch_next):
+    doc = cursor.next_object()
+    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"comment_count": doc["count"]}}))
+    if len(updates) >= batch_size:
+      yield db.posts.bulk_write(updates, ordered=False)
+      updates = []
+  if updates:
+    yield db.posts.bulk_write(updates, ordered=False)
+  yield db.posts.update_many({"comment_count": {"$exists": False}}, {"$set": {"comment_count": 0}})
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+import time
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+"""
+Модуль содержит сжатие ответов по заголовку Accept-Encoding: gzip (zlib) и br (brotli, если модуль установлен;
+на низких уровнях качества brotli сжимает JSON быстрее и сильнее gzip). Ведется статистика по каждому способу:
+объем до и после сжатия и время, затраченное на сжатие.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _GzipStream(object):
+  def __init__(self, level):
+    self._compressobj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+  def process(self, data, flush=True):
+    result = self._compressobj.compress(data)
+    if flush:
+      # Z_SYNC_FLUSH - клиент может распаковать уже полученные данные, не дожидаясь конца ответа
+      result += self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+    return result
+
+  def finish(self):
+    return self._compressobj.flush()
+
+
+class _BrotliStream(object):
+  def __init__(self, quality):
+    self._compressor = brotli.Compressor(quality=quality)
+
+  def process(self, data, flush=True):
+    result = self._compressor.process(data)
+    if flush:
+      result += self._compressor.flush()
+    return result
+
+  def finish(self):
+    return self._compressor.finish()
+
+
+def _codecs():
+  codecs = {"gzip": _GzipStream}
+  if brotli is not None:
+    codecs["br"] = _BrotliStream
+  return codecs
+
+
+def parse_accept_encoding(value):
+  """
+  Метод разбирает заголовок Accept-Encoding
+
+  :param value: значение заголовка, например "gzip, deflate, br;q=0.5"
+  :return: словарь способ сжатия -> вес (q)
+  """
+  result = {}
+  for item in value.split(","):
+    name, _, params = item.partition(";")
+    name = name.strip().lower()
+    if not name:
+      continue
+    q = 1.0
+    params = params.strip()
+    if params.startswith("q="):
+      try:
+        q = float(params[2:])
+      except ValueError:
+        q = 0.0
+    result[name] = q
+  return result
+
+
+class Compression(object):
+  def __init__(self, codecs=("br", "gzip"), min_size=1024, level=6, brotli_quality=4):
+    """
+    Инициализация
+
+    :param codecs: способы сжатия в порядке предпочтения (недоступные пропускаются)
+    :param min_size: минимальный размер тела ответа для сжатия, байт
+    :param level: уровень сжатия gzip (1-9)
+    :param brotli_quality: качество сжатия brotli (0-11)
+    """
+    available = _codecs()
+    for name in codecs:
+      if name not in available:
+        logger.warning("compression codec %s is not available" % name)
+    self.codecs = [name for name in codecs if name in available]
+    self.min_size = min_size
+    self._streams = available
+    self._levels = {"gzip": level, "br": brotli_quality}
+    self._stats = dict((name, {"responses": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0, "cached": 0,
+                               "cached_bytes_saved": 0})
+                       for name in self.codecs)
+
+  def negotiate(self, accept_encoding):
+    """
+    Метод выбирает способ сжатия ответа
+
+    :param accept_encoding: значение заголовка Accept-Encoding запроса
+    :return: название способа сжатия или None
+    """
+    if not accept_encoding or not self.codecs:
+      return None
+    accepted = parse_accept_encoding(accept_encoding)
+    default = accepted.get("*", 0)
+    for name in self.codecs:
+      if accepted.get(name, default) > 0:
+        return name
+    return None
+
+  def stream(self, codec):
+    """
+    Метод создает потоковый компрессор для ответа, отправляемого частями
+
+    :param codec: способ сжатия
+    :return: объект с методами process(data, flush=True) и finish()
+    """
+    self._stats[codec]["responses"] += 1
+    return _StreamStats(self._streams[codec](self._levels[codec]), self._stats[codec])
+
+  def compress(self, codec, data):
+    """
+    Метод сжимает тело ответа целиком
+
+    :param codec: способ сжатия
+    :param data: тело ответа
+    :return: сжатое тело
+    """
+    self._stats[codec]["responses"] += 1
+    stream = _StreamStats(self._streams[codec](self._levels[codec]), self._stats[codec])
+    return stream.process(data, flush=False) + stream.finish()
+
+  def cached(self, codec, saved):
+    """
+    Метод учитывает ответ, сжатое тело которого взято из кэша ответов
+
+    :param codec: способ сжатия
+    :param saved: разница размеров исходного и сжатого тела
+    """
+    self._stats[codec]["cached"] += 1
+    self._stats[codec]["cached_bytes_saved"] += saved
+
+  def stats(self):
+    """
+    :return: словарь способ сжатия -> счетчики: сжатые ответы (responses), объем до и после сжатия (bytes_in,
+             bytes_out, bytes_saved), время сжатия (seconds), ответы со сжатым телом из кэша (cached,
+             cached_bytes_saved)
+    """
+    stats = {}
+    for name, values in self._stats.items():
+      stats[name] = dict(values, bytes_saved=values["bytes_in"] - values["bytes_out"])
+    return stats
+
+
+class _StreamStats(object):
+  """
+  Обертка потокового компрессора, учитывающая объем данных и время сжатия
+  """
+  def __init__(self, stream, stats):
+    self._stream = stream
+    self._stats = stats
+
+  def process(self, data, flush=True):
+    started = time.time()
+    result = self._stream.process(data, flush)
+    self._add(len(data), len(result), time.time() - started)
+    return result
+
+  def finish(self):
+    started = time.time()
+    result = self._stream.finish()
+    self._add(0, len(result), time.time() - started)
+    return result
+
+  def _add(self, size_in, size_out, seconds):
+    self._stats["bytes_in"] += size_in
+    self._stats["bytes_out"] += size_out
+    self._stats["seconds"] += seconds
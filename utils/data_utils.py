@@ -1,17 +1,16 @@
 # -*- coding: utf-8 -*-
 __author__ = 'vatyakshin'
 
-import re
 from datetime import datetime
 from dateutil.tz import tzlocal, tzutc
-from dateutil.parser import parse
+
+from utils import serializer
+from utils.dates import parse_date
 
 """
 Модуль содержит все дополнительные методы, необходимые для работы сервера
 """
 
-_retype = type(re.compile(''))
-
 def custom_handler(obj):
   """
   Специальный метод для параметра default метода json.dumps
@@ -19,15 +18,7 @@ def custom_handler(obj):
   :param obj: объект, к которому нужно применить определенное изменение (в завимости от типа)
   :return: преобразованний к нужному формату obj
   """
-  if hasattr(obj, 'isoformat') and callable(getattr(obj, 'isoformat')):
-    return obj.isoformat()
-  if obj.__class__.__name__ == "ObjectId":
-    return str(obj)
-  if obj.__class__ is set:
-    return list(obj)
-  if obj.__class__ is _retype:
-    return obj.pattern
-  return None
+  return serializer.default(obj)
 
 def now_aware():
   """
@@ -46,16 +37,13 @@ def todate(obj):
   :param obj: значение, которое необходимо перевести в datetime
   :return: obj, если преобразование невозможно, иначе datetime
   """
+  if obj.__class__ is datetime:
+    return obj
   if not obj:
     return None
   res = None
-  if obj.__class__ is datetime:
-    res = obj
   if obj.__class__ in (str, unicode):
-    try:
-      res = parse(obj, dayfirst=True, yearfirst=True)
-    except Exception:
-      pass
+    res = parse_date(obj)
   if obj.__class__ in (int, long, float):
     try:
       res = datetime.fromtimestamp(obj)
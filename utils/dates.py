@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import re
+from datetime import datetime
+
+from dateutil.parser import parse
+from dateutil.tz import tzoffset, tzutc
+
+from utils.cache import LRUCache
+
+"""
+Модуль содержит разбор дат из строк. Частые форматы (ISO-8601, unix time в секундах и миллисекундах, дд.мм.гггг)
+разбираются регулярными выражениями, остальные строки передаются dateutil. Результаты запоминаются.
+Дата, начинающаяся с года, читается как год, месяц, день с любым разделителем (гггг-мм-дд, гггг.мм.дд, гггг/мм/дд),
+дата, заканчивающаяся годом, - как день, месяц, год. Строки, подходящие под формат, но с недопустимыми значениями
+(например, "2017-13-01"), не передаются dateutil (он мог бы прочитать их в другом порядке полей): такая дата
+недопустима. Неудачные разборы тоже запоминаются.
+"""
+
+_iso_re = re.compile(
+  r"^(\d{4})-(\d{2})-(\d{2})"
+  r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?"
+  r"(Z|[+-]\d{2}(?::?\d{2})?)?$"
+)
+_ymd_re = re.compile(
+  r"^(\d{4})([./])(\d{1,2})\2(\d{1,2})"
+  r"(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?$"
+)
+_dmy_re = re.compile(
+  r"^(\d{1,2})([./-])(\d{1,2})\2(\d{4})"
+  r"(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?$"
+)
+_epoch_re = re.compile(r"^\d{9,13}(?:\.\d+)?$")
+
+_utc = tzutc()
+_cache = LRUCache(maxsize=1024)
+# отсутствие значения в кэше (None в кэше - строка, которую не удалось разобрать)
+_missing = object()
+
+
+def _tz(value):
+  if not value:
+    return None
+  if value == "Z":
+    return _utc
+  sign = -1 if value[0] == "-" else 1
+  value = value[1:].replace(":", "")
+  minutes = int(value[:2]) * 60 + int(value[2:] or 0)
+  return tzoffset(None, sign * minutes * 60)
+
+
+def _parse_fast(value):
+  """
+  Метод разбирает частые форматы регулярными выражениями
+
+  :return: datetime или None, если строка не подходит ни под один из них
+  :raise ValueError: строка подходит под формат, но значения недопустимы
+  """
+  m = _iso_re.match(value)
+  if m:
+    year, month, day, hour, minute, second, fraction, tz = m.groups()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                    int((fraction or "0").ljust(6, "0")), _tz(tz))
+  m = _ymd_re.match(value)
+  if m:
+    year, _, month, day, hour, minute, second = m.groups()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+  m = _dmy_re.match(value)
+  if m:
+    day, _, month, year, hour, minute, second = m.groups()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+  if _epoch_re.match(value):
+    timestamp = float(value)
+    # 13 цифр - миллисекунды
+    if timestamp >= 1e11:
+      timestamp /= 1000.0
+    return datetime.fromtimestamp(timestamp)
+  return None
+
+
+def _parse(value):
+  value = value.strip()
+  try:
+    res = _parse_fast(value)
+  except ValueError:
+    return None
+  if res is not None:
+    return res
+  return parse(value, dayfirst=True, yearfirst=True)
+
+
+def parse_date(value):
+  """
+  Метод превращает строку в datetime
+
+  :param value: строка с датой
+  :return: datetime или None, если строку разобрать не удалось
+  """
+  res = _cache.get(value, _missing, count=False)
+  if res is _missing:
+    try:
+      res = _parse(value)
+    except Exception:
+      res = None
+    _cache.set(value, res)
+  return res
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import time
+
+from motor import MotorCollection
+from pymongo.errors import ExecutionTimeout
+from tornado.web import HTTPError
+
+"""
+Модуль содержит ограничение времени обработки запроса (deadline). Запросы к MongoDB выполняются через обертки
+базы данных и коллекций, которые передают в каждый find, find_one, aggregate и count оставшееся до deadline время
+(maxTimeMS): чем больше времени ушло на предыдущие шаги запроса, тем меньше его остается следующим. Если время уже
+вышло или клиент закрыл соединение, запрос к MongoDB не выполняется, а открытые курсоры запроса закрываются.
+"""
+
+
+class DeadlineExceeded(HTTPError):
+  """
+  Время обработки запроса истекло до очередного обращения к MongoDB
+  """
+  def __init__(self):
+    HTTPError.__init__(self, 504, reason="Deadline Exceeded")
+
+
+class Cancelled(HTTPError):
+  """
+  Клиент закрыл соединение, обработка запроса прекращена (ответ клиенту уже не отправляется)
+  """
+  def __init__(self):
+    HTTPError.__init__(self, 499, reason="Client Closed Request")
+
+
+def deadline_reason(exception):
+  """
+  Метод определяет, прервана ли обработка запроса по deadline
+
+  :param exception: исключение обработчика запроса
+  :return: "deadline" - время истекло до обращения к MongoDB, "mongo" - MongoDB прервала операцию по maxTimeMS,
+           "cancelled" - клиент закрыл соединение, None - другая ошибка
+  """
+  if isinstance(exception, DeadlineExceeded):
+    return "deadline"
+  if isinstance(exception, ExecutionTimeout):
+    return "mongo"
+  if isinstance(exception, Cancelled):
+    return "cancelled"
+  return None
+
+
+class Deadline(object):
+  def __init__(self, expires=None, timer=time.time):
+    """
+    Инициализация
+
+    :param expires: время (timestamp), до которого должна завершиться обработка запроса (None - без ограничения)
+    :param timer: функция получения текущего времени
+    """
+    self.expires = expires
+    self.cancelled = False
+    self._timer = timer
+    self._cursors = []
+
+  def remaining_ms(self):
+    """
+    Метод возвращает оставшееся время для очередной операции MongoDB
+
+    :return: миллисекунды (None - без ограничения)
+    :raise DeadlineExceeded: время истекло
+    :raise Cancelled: клиент закрыл соединение
+    """
+    if self.cancelled:
+      raise Cancelled()
+    if self.expires is None:
+      return None
+    remaining = int((self.expires - self._timer()) * 1000)
+    if remaining <= 0:
+      raise DeadlineExceeded()
+    return remaining
+
+  def track(self, cursor):
+    """
+    Метод запоминает курсор запроса, чтобы закрыть его при отмене
+    """
+    self._cursors.append(cursor)
+    return cursor
+
+  def cancel(self):
+    """
+    Метод отменяет обработку запроса: следующие операции MongoDB не выполняются, открытые курсоры закрываются
+    (курсоры на сервере освобождаются, не дожидаясь таймаута)
+    """
+    self.cancelled = True
+    cursors, self._cursors = self._cursors, []
+    for cursor in cursors:
+      if cursor.alive:
+        cursor.close()
+
+
+class DeadlineDatabase(object):
+  """
+  Обертка MotorDatabase, коллекции которой ограничивают операции чтения временем Deadline
+  """
+  def __init__(self, db, deadline):
+    self._db = db
+    self._deadline = deadline
+
+  def __getitem__(self, name):
+    return DeadlineCollection(self._db[name], self._deadline)
+
+  def __getattr__(self, name):
+    attr = getattr(self._db, name)
+    if isinstance(attr, MotorCollection):
+      return DeadlineCollection(attr, self._deadline)
+    return attr
+
+
+class DeadlineCollection(object):
+  """
+  Обертка MotorCollection: find, find_one, aggregate и count выполняются с maxTimeMS по оставшемуся времени,
+  остальные методы (запись) передаются коллекции без изменений
+  """
+  def __init__(self, collection, deadline):
+    self._collection = collection
+    self._deadline = deadline
+
+  def __getattr__(self, name):
+    return getattr(self._collection, name)
+
+  def find(self, *args, **kwargs):
+    remaining = self._deadline.remaining_ms()
+    cursor = self._collection.find(*args, **kwargs)
+    if remaining is not None:
+      cursor.max_time_ms(remaining)
+    return self._deadline.track(cursor)
+
+  def find_one(self, *args, **kwargs):
+    remaining = self._deadline.remaining_ms()
+    if remaining is not None:
+      kwargs["max_time_ms"] = remaining
+    return self._collection.find_one(*args, **kwargs)
+
+  def aggregate(self, pipeline, **kwargs):
+    remaining = self._deadline.remaining_ms()
+    if remaining is not None:
+      kwargs["maxTimeMS"] = remaining
+    return self._deadline.track(self._collection.aggregate(pipeline, **kwargs))
+
+  def count(self, *args, **kwargs):
+    remaining = self._deadline.remaining_ms()
+    if remaining is not None:
+      kwargs["maxTimeMS"] = remaining
+    return self._collection.count(*args, **kwargs)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+import re
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT
+from tornado import gen
+
+from utils.pagination import encode_cursor, keyset_query
+
+"""
+Модуль содержит описание индексов MongoDB, необходимых хэндлерам, а также проверку планов выполнения запросов
+"""
+
+logger = logging.getLogger(__name__)
+
+# коллекция -> список пар (ключи индекса, дополнительные параметры create_index)
+INDEXES = {
+  "users": [
+    ([("username", ASCENDING)], {"unique": True}),
+  ],
+  "posts": [
+    ([("post_date", DESCENDING), ("_id", DESCENDING)], {}),
+    ([("user_id", ASCENDING), ("post_date", DESCENDING), ("_id", DESCENDING)], {}),
+    ([("tags", ASCENDING), ("post_date", DESCENDING), ("_id", DESCENDING)], {}),
+    # инвертированный индекс слов заголовков (без стемминга - заголовки бывают на разных языках)
+    ([("title", TEXT)], {"default_language": "none", "name": "title_text"}),
+  ],
+  "comments": [
+    ([("post_id", ASCENDING), ("comment_date", DESCENDING), ("_id", DESCENDING)], {}),
+  ],
+  "forbidden_users": [
+    ([("post_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+  ],
+  "follows": [
+    ([("follower", ASCENDING), ("followee", ASCENDING)], {"unique": True}),
+    # подписчики автора для fan-out (покрывающий индекс)
+    ([("followee", ASCENDING), ("follower", ASCENDING)], {}),
+  ],
+  "tag_counts": [
+    ([("count", DESCENDING)], {}),
+  ],
+  "tag_counts_daily": [
+    ([("tag", ASCENDING), ("day", ASCENDING)], {"unique": True}),
+  ],
+}
+
+
+def query_shapes():
+  """
+  Метод возвращает типовые запросы хэндлеров (с подставленными значениями) для проверки их планов выполнения
+
+  :return: список кортежей (название, коллекция, запрос, сортировка)
+  """
+  _id = ObjectId()
+  now = datetime.utcnow()
+  # запросы следующих страниц (keyset-пагинация): условие продолжения по последнему документу страницы
+  posts_page, posts_sort = keyset_query({"user_id": _id}, "post_date", -1,
+                                        encode_cursor({"_id": _id, "post_date": now}, "post_date"))
+  all_page, _ = keyset_query({}, "post_date", -1, encode_cursor({"_id": _id, "post_date": now}, "post_date"))
+  comments_page, comments_sort = keyset_query({"post_id": _id}, "comment_date", -1,
+                                              encode_cursor({"_id": _id, "comment_date": now}, "comment_date"))
+  return [
+    ("UserHandler._create_user", "users", {"username": "audit"}, None),
+    ("PostsHandler.get_posts_by_user", "posts", {"user_id": _id}, [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostsHandler.get_posts_by_user(cursor)", "posts", posts_page, posts_sort),
+    ("PostsHandler.get_posts", "posts", {}, [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostsHandler.get_posts(cursor)", "posts", all_page, posts_sort),
+    ("PostsHandler.get_posts(dates)", "posts", {"post_date": {"$gte": now - timedelta(days=1), "$lte": now}},
+     [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostsHandler.get_posts(tags)", "posts", {"tags": {"$in": ["audit"]}},
+     [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostsHandler.get_posts(all tags)", "posts", {"tags": {"$all": ["audit", "other"]}},
+     [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostsHandler.get_tags", "tag_counts", {}, [("count", DESCENDING)]),
+    ("PostsHandler.get_tag_stats", "tag_counts_daily", {"tag": {"$in": ["audit"]}, "day": {"$gte": now}},
+     [("tag", ASCENDING), ("day", ASCENDING)]),
+    ("PostsHandler.get_posts(title)", "posts", {"title": re.compile(u"audit", re.IGNORECASE)},
+     [("post_date", DESCENDING), ("_id", DESCENDING)]),
+    # результаты поиска по текстовому индексу всегда сортируются в памяти (top-k по limit), проверяем только выборку
+    ("PostsHandler.get_posts(title text)", "posts", {"$text": {"$search": u'"audit"'}}, None),
+    ("PostHandler.get_comments", "comments", {"post_id": _id}, [("comment_date", DESCENDING), ("_id", DESCENDING)]),
+    ("PostHandler.get_comments(cursor)", "comments", comments_page, comments_sort),
+    ("BaseHandler.check_forbid_status", "forbidden_users", {"post_id": _id}, None),
+    ("timelines.fan_out", "follows", {"followee": _id}, None),
+    ("PostsHandler.get_timeline(followees)", "follows", {"follower": _id}, None),
+    ("PostsHandler.get_timeline(popular)", "posts", {"user_id": {"$in": [_id, ObjectId()]}},
+     [("post_date", DESCENDING), ("_id", DESCENDING)]),
+  ]
+
+
+@gen.coroutine
+def ensure_indexes(db, indexes=None):
+  """
+  Метод создает (при отсутствии) все индексы из описания
+
+  :param db: база данных (MotorDatabase)
+  :param indexes: описание индексов в формате INDEXES
+  """
+  for collection, specs in sorted((indexes or INDEXES).items()):
+    for keys, kwargs in specs:
+      name = yield db[collection].create_index(keys, **kwargs)
+      logger.info("index %s.%s is ensured" % (collection, name))
+
+
+def _plan_stages(plan):
+  """
+  Метод обходит дерево плана выполнения и возвращает названия всех его стадий
+  """
+  if not plan:
+    return []
+  stages = [plan.get("stage")]
+  if "inputStage" in plan:
+    stages.extend(_plan_stages(plan["inputStage"]))
+  for stage in plan.get("inputStages") or []:
+    stages.extend(_plan_stages(stage))
+  return stages
+
+
+@gen.coroutine
+def audit_queries(db, shapes=None):
+  """
+  Метод выполняет explain для типовых запросов хэндлеров и находит полные сканирования коллекций (COLLSCAN) и
+  сортировки в памяти (SORT)
+
+  :param db: база данных (MotorDatabase)
+  :param shapes: список запросов в формате query_shapes()
+  :return: список кортежей (название запроса, список проблемных стадий)
+  """
+  problems = []
+  for name, collection, query, sort in shapes or query_shapes():
+    cursor = db[collection].find(query)
+    if sort:
+      cursor = cursor.sort(sort)
+    plan = yield cursor.limit(10).explain()
+    stages = _plan_stages(plan.get("queryPlanner", {}).get("winningPlan"))
+    bad = [stage for stage in stages if stage in ("COLLSCAN", "SORT")]
+    if bad:
+      logger.warning("query %s on %s uses %s" % (name, collection, ", ".join(bad)))
+      problems.append((name, bad))
+  raise gen.Return(problems)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+import threading
+from Queue import Queue, Full
+
+"""
+Модуль содержит запись логов через очередь (аналог logging.handlers.QueueHandler/QueueListener из Python 3):
+поток IOLoop только кладет запись в ограниченную очередь, а запись в файл и ротацию выполняет отдельный поток.
+При переполнении очереди записи отбрасываются и подсчитываются, цикл событий не блокируется.
+"""
+
+_sentinel = None
+
+
+class QueueHandler(logging.Handler):
+  def __init__(self, queue):
+    """
+    Инициализация обработчика
+
+    :param queue: очередь (Queue.Queue с ограничением размера)
+    """
+    logging.Handler.__init__(self)
+    self.queue = queue
+    self.dropped = 0
+
+  def prepare(self, record):
+    """
+    Метод подготавливает запись к передаче в другой поток: сообщение форматируется с аргументами и текстом
+    исключения сразу, чтобы не хранить ссылки на объекты, которые могут измениться
+    """
+    record.msg = self.format(record)
+    record.args = None
+    record.exc_info = None
+    record.exc_text = None
+    return record
+
+  def emit(self, record):
+    try:
+      self.queue.put_nowait(self.prepare(record))
+    except Full:
+      self.dropped += 1
+    except Exception:
+      self.handleError(record)
+
+
+class QueueListener(object):
+  def __init__(self, queue, *handlers):
+    """
+    Инициализация слушателя очереди
+
+    :param queue: очередь, в которую пишет QueueHandler
+    :param handlers: обработчики, выполняющие запись (файлы, ротация)
+    """
+    self.queue = queue
+    self.handlers = handlers
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._monitor, name="log-listener")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """
+    Метод дожидается записи всех записей из очереди и останавливает поток. В дочернем процессе после fork потока
+    слушателя нет: тогда метод ничего не ждет и не закрывает обработчики (их блокировки могли остаться захваченными
+    потоком родительского процесса).
+    """
+    if self._thread is None:
+      return
+    thread, self._thread = self._thread, None
+    if thread.is_alive():
+      self.queue.put(_sentinel)
+      thread.join()
+      for handler in self.handlers:
+        handler.close()
+
+  def _monitor(self):
+    while True:
+      record = self.queue.get()
+      if record is _sentinel:
+        break
+      for handler in self.handlers:
+        if record.levelno >= handler.level:
+          handler.handle(record)
+
+
+class ExcludeFilter(logging.Filter):
+  """
+  Фильтр, пропускающий все записи, кроме записей логгера name и его потомков (обратный logging.Filter)
+  """
+  def filter(self, record):
+    return not logging.Filter.filter(self, record)
+
+
+def dropped_records():
+  """
+  Метод возвращает количество записей, отброшенных обработчиками QueueHandler корневого логгера
+  """
+  return sum(handler.dropped for handler in logging.getLogger().handlers if isinstance(handler, QueueHandler))
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+from tornado.ioloop import IOLoop
+
+"""
+Модуль содержит метрики приложения в формате Prometheus (text exposition format 0.0.4): счетчики, значения и
+гистограммы с метками, сбор длительности команд MongoDB через command monitoring pymongo и измерение задержки IOLoop.
+Команды MongoDB выполняются в потоках Motor, поэтому изменение метрик защищено блокировкой.
+"""
+
+# границы гистограмм длительности (секунды) и размера (байты)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value):
+  if not isinstance(value, basestring):
+    value = str(value)
+  if isinstance(value, unicode):
+    value = value.encode("utf-8")
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+  pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+  if extra:
+    pairs.append('%s="%s"' % extra)
+  return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value):
+  if isinstance(value, float):
+    if value == float("inf"):
+      return "+Inf"
+    return repr(value)
+  return str(value)
+
+
+class Metric(object):
+  type = None
+
+  def __init__(self, name, documentation, labelnames=()):
+    """
+    Инициализация метрики
+
+    :param name: имя метрики
+    :param documentation: описание (HELP)
+    :param labelnames: имена меток; значения меток передаются кортежем в том же порядке
+    """
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _samples(self):
+    for labels, value in sorted(self._values.items()):
+      yield self.name, _format_labels(self.labelnames, labels), value
+
+  def render(self):
+    lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+    with self._lock:
+      samples = list(self._samples())
+    for name, labels, value in samples:
+      lines.append("%s%s %s" % (name, labels, _format_value(value)))
+    return "\n".join(lines)
+
+  def get(self, labels=()):
+    return self._values.get(tuple(labels), 0)
+
+  def clear(self):
+    with self._lock:
+      self._values.clear()
+
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, labels=(), amount=1):
+    labels = tuple(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+  type = "gauge"
+
+  def set(self, value, labels=()):
+    with self._lock:
+      self._values[tuple(labels)] = value
+
+  def inc(self, labels=(), amount=1):
+    labels = tuple(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def dec(self, labels=(), amount=1):
+    self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, labels=()):
+    labels = tuple(labels)
+    # значения по меткам: [количество в каждом интервале..., количество сверх последней границы, сумма]
+    index = bisect_left(self.buckets, value)
+    with self._lock:
+      counts = self._values.get(labels)
+      if counts is None:
+        counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+      counts[index] += 1
+      counts[-1] += value
+
+  def get(self, labels=()):
+    """
+    :return: кортеж (количество наблюдений, сумма)
+    """
+    counts = self._values.get(tuple(labels))
+    if counts is None:
+      return 0, 0.0
+    return sum(counts[:-1]), counts[-1]
+
+  def _samples(self):
+    for labels, counts in sorted(self._values.items()):
+      total = 0
+      for bound, count in zip(self.buckets + (float("inf"),), counts):
+        total += count
+        yield (self.name + "_bucket", _format_labels(self.labelnames, labels, ("le", _format_value(float(bound)))),
+               total)
+      yield self.name + "_sum", _format_labels(self.labelnames, labels), counts[-1]
+      yield self.name + "_count", _format_labels(self.labelnames, labels), total
+
+
+class Registry(object):
+  """
+  Набор метрик приложения
+  """
+  def __init__(self):
+    self._metrics = []
+    self._collectors = []
+
+  def _add(self, metric):
+    self._metrics.append(metric)
+    return metric
+
+  def counter(self, name, documentation, labelnames=()):
+    return self._add(Counter(name, documentation, labelnames))
+
+  def gauge(self, name, documentation, labelnames=()):
+    return self._add(Gauge(name, documentation, labelnames))
+
+  def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return self._add(Histogram(name, documentation, labelnames, buckets))
+
+  def add_collector(self, collector):
+    """
+    Метод добавляет функцию, которая вызывается перед выводом метрик (для значений, которые дешевле прочитать
+    в момент запроса /metrics, чем обновлять постоянно, например статистика кэшей)
+
+    :param collector: функция без параметров
+    """
+    self._collectors.append(collector)
+
+  def render(self):
+    """
+    Метод возвращает метрики в текстовом формате Prometheus
+
+    :return: строка
+    """
+    for collector in self._collectors:
+      collector()
+    return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class RequestMetrics(object):
+  """
+  Метрики HTTP-запросов по хэндлерам и типам запросов (_type из пути: /post/get_post -> PostHandler, get_post)
+  """
+  def __init__(self, registry):
+    self.duration = registry.histogram("http_request_duration_seconds", "HTTP request latency",
+                                       ("handler", "type", "method"))
+    self.in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being processed", ("handler",))
+    self.size = registry.histogram("http_response_size_bytes", "HTTP response body size", ("handler", "type"),
+                                   buckets=SIZE_BUCKETS)
+    self.responses = registry.counter("http_responses_total", "HTTP responses by status code",
+                                      ("handler", "type", "code"))
+    self.deadlines = registry.counter("http_request_deadline_total", "Requests stopped by deadline "
+                                      "(deadline, mongo maxTimeMS) or client disconnect (cancelled)",
+                                      ("handler", "type", "reason"))
+
+  def started(self, handler):
+    self.in_flight.inc((handler,))
+
+  def deadline(self, handler, _type, reason):
+    self.deadlines.inc((handler, _type, reason))
+
+  def finished(self, handler, _type, method, status, duration, size):
+    self.in_flight.dec((handler,))
+    self.duration.observe(duration, (handler, _type, method))
+    self.size.observe(size, (handler, _type))
+    self.responses.inc((handler, _type, status))
+
+
+class CommandTimer(monitoring.CommandListener):
+  """
+  Слушатель команд pymongo: длительность и ошибки команд по коллекциям и названиям команд.
+  Передается в MotorClient(event_listeners=[...]).
+  """
+  def __init__(self, registry):
+    self.duration = registry.histogram("mongo_command_duration_seconds", "MongoDB command duration",
+                                       ("collection", "command"))
+    self.failures = registry.counter("mongo_command_failures_total", "Failed MongoDB commands",
+                                     ("collection", "command"))
+    # (connection_id, request_id) -> коллекция; в событиях завершения команды самой команды нет
+    self._pending = {}
+
+  def started(self, event):
+    command = event.command
+    collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+    if not isinstance(collection, basestring):
+      collection = ""
+    self._pending[(event.connection_id, event.request_id)] = collection
+
+  def succeeded(self, event):
+    collection = self._pending.pop((event.connection_id, event.request_id), "")
+    self.duration.observe(event.duration_micros / 1e6, (collection, event.command_name))
+
+  def failed(self, event):
+    collection = self._pending.pop((event.connection_id, event.request_id), "")
+    self.duration.observe(event.duration_micros / 1e6, (collection, event.command_name))
+    self.failures.inc((collection, event.command_name))
+
+
+class LoopLagMonitor(object):
+  """
+  Измерение задержки IOLoop: обратный вызов планируется через interval секунд, и разница между фактическим и
+  запланированным временем его выполнения показывает, насколько цикл занят синхронной работой
+  """
+  def __init__(self, registry, interval=0.5):
+    self.interval = interval
+    self.lag = registry.gauge("ioloop_lag_seconds", "Last measured IOLoop callback delay")
+    self.lag_histogram = registry.histogram("ioloop_lag_histogram_seconds", "IOLoop callback delay")
+    self._io_loop = None
+    self._timeout = None
+    self._expected = None
+
+  def start(self, io_loop=None):
+    self._io_loop = io_loop or IOLoop.current()
+    self._schedule()
+
+  def stop(self):
+    if self._timeout is not None:
+      self._io_loop.remove_timeout(self._timeout)
+      self._timeout = None
+
+  def _schedule(self):
+    self._expected = time.time() + self.interval
+    self._timeout = self._io_loop.call_later(self.interval, self._tick)
+
+  def _tick(self):
+    lag = max(0.0, time.time() - self._expected)
+    self.lag.set(lag)
+    self.lag_histogram.observe(lag)
+    self._schedule()
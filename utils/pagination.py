@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import base64
+import calendar
+import json
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.tz_util import utc
+
+"""
+Модуль содержит функции для постраничной выдачи по ключу (keyset pagination): вместо skip следующая страница
+запрашивается диапазонным запросом от последнего документа предыдущей страницы по паре (поле даты, _id)
+"""
+
+_epoch = datetime(1970, 1, 1, tzinfo=utc)
+
+
+class InvalidCursor(ValueError):
+  pass
+
+
+def _to_millis(date):
+  if date is None:
+    return None
+  if date.tzinfo is not None:
+    date = date.astimezone(utc).replace(tzinfo=None)
+  return calendar.timegm(date.timetuple()) * 1000 + date.microsecond // 1000
+
+
+def _from_millis(millis):
+  if millis is None:
+    return None
+  return _epoch + timedelta(milliseconds=millis)
+
+
+def encode_cursor(doc, field):
+  """
+  Метод формирует непрозрачный токен продолжения по последнему документу страницы
+
+  :param doc: последний документ страницы (до каких-либо преобразований)
+  :param field: поле даты, по которому идет сортировка (None - сортировка только по _id)
+  :return: токен в виде строки
+  """
+  value = _to_millis(doc.get(field)) if field else None
+  raw = json.dumps([value, str(doc["_id"])], separators=(",", ":"))
+  return base64.urlsafe_b64encode(raw).rstrip("=")
+
+
+def decode_cursor(token):
+  """
+  Метод разбирает токен продолжения
+
+  :param token: токен, полученный из encode_cursor
+  :return: кортеж (дата или None, ObjectId)
+  """
+  try:
+    raw = base64.urlsafe_b64decode(str(token) + "=" * (-len(token) % 4))
+    value, _id = json.loads(raw)
+    return _from_millis(value), ObjectId(_id)
+  except Exception:
+    raise InvalidCursor(token)
+
+
+def keyset_query(query, field, direction, cursor=None):
+  """
+  Метод дополняет запрос условием продолжения и возвращает сортировку, согласованную с ним
+
+  :param query: исходный запрос MongoDB
+  :param field: поле даты, по которому идет сортировка (None - сортировка только по _id)
+  :param direction: направление сортировки (1 или -1)
+  :param cursor: токен продолжения (None - первая страница)
+  :return: кортеж (запрос, сортировка в формате списка пар)
+  """
+  direction = -1 if direction < 0 else 1
+  sort = [(field, direction), ("_id", direction)] if field else [("_id", direction)]
+  if not cursor:
+    return query, sort
+  value, _id = decode_cursor(cursor)
+  op = "$lt" if direction < 0 else "$gt"
+  if field:
+    # условие по field без $or избыточно, но по нему планировщик ограничивает диапазон индекса (при других условиях
+    # запроса, например user_id, одного $or для этого недостаточно)
+    condition = {field: {"$lte" if direction < 0 else "$gte": value},
+                 "$or": [{field: {op: value}}, {field: value, "_id": {op: _id}}]}
+  else:
+    condition = {"_id": {op: _id}}
+  if not query:
+    query = condition
+  elif set(query) & set(condition):
+    query = {"$and": [query, condition]}
+  else:
+    query = dict(query, **condition)
+  return query, sort
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+Модуль содержит сэмплирующий профилировщик: отдельный поток с заданным интервалом снимает стек потока IOLoop
+(sys._current_frames) и считает одинаковые стеки. Результат - "свернутые" стеки (collapsed stacks: функции от корня
+к листу через ";" и количество снимков), которые принимают flamegraph.pl и speedscope. Профилируемый поток не
+останавливается и не инструментируется, поэтому накладные расходы ограничены временем снятия стека.
+"""
+
+
+def _frame_name(frame):
+  code = frame.f_code
+  return "%s:%s:%s" % (frame.f_globals.get("__name__", "?"), code.co_name, code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+  def __init__(self, thread_id, interval=0.005):
+    """
+    Инициализация профилировщика
+
+    :param thread_id: идентификатор профилируемого потока (thread.get_ident())
+    :param interval: интервал между снимками стека в секундах
+    """
+    self.thread_id = thread_id
+    self.interval = interval
+    self.stacks = Counter()
+    self.samples = 0
+    self._running = False
+    self._thread = None
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name="sampling-profiler")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._running = False
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    while self._running:
+      time.sleep(self.interval)
+      self.sample()
+
+  def sample(self):
+    """
+    Метод снимает стек профилируемого потока
+    """
+    frame = sys._current_frames().get(self.thread_id)
+    if frame is None:
+      return
+    stack = []
+    while frame is not None:
+      stack.append(_frame_name(frame))
+      frame = frame.f_back
+    stack.reverse()
+    self.stacks[";".join(stack)] += 1
+    self.samples += 1
+
+  def collapsed(self):
+    """
+    Метод возвращает свернутые стеки: строки "стек количество", от самых частых
+
+    :return: строка
+    """
+    return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
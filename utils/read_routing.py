@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+
+"""
+Модуль содержит настройку маршрутизации чтения: для каждого пути запроса задается режим чтения MongoDB
+(read preference), листинги можно направлять на вторичные узлы набора реплик с ограничением отставания
+(maxStalenessSeconds, не меньше 90 секунд)
+"""
+
+_modes = {
+  "primary": Primary,
+  "primaryPreferred": PrimaryPreferred,
+  "secondary": Secondary,
+  "secondaryPreferred": SecondaryPreferred,
+  "nearest": Nearest,
+}
+
+
+def read_preference(mode, max_staleness=-1):
+  """
+  Метод создает режим чтения pymongo по названию
+
+  :param mode: primary, primaryPreferred, secondary, secondaryPreferred или nearest
+  :param max_staleness: допустимое отставание вторичного узла в секундах (-1 - без ограничения)
+  :return: объект режима чтения
+  """
+  if mode not in _modes:
+    raise ValueError("Unknown read preference: %s" % mode)
+  if mode == "primary":
+    return Primary()
+  return _modes[mode](max_staleness=max_staleness)
+
+
+def parse_read_routing(value):
+  """
+  Метод разбирает настройку маршрутизации чтения вида "/posts/posts=secondaryPreferred,/post/get_comments=nearest"
+
+  :param value: строка настройки
+  :return: словарь путь -> режим чтения
+  """
+  routing = {}
+  for item in value.split(","):
+    item = item.strip()
+    if not item:
+      continue
+    path, _, mode = item.partition("=")
+    mode = mode.strip()
+    if mode not in _modes:
+      raise ValueError("Unknown read preference for %s: %s" % (path, mode))
+    routing[path.strip()] = mode
+  return routing
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import hashlib
+import time
+import urllib
+
+from utils.cache import LRUCache
+
+"""
+Модуль содержит кэш HTTP-ответов. Каждый ответ запоминает поколения (generation) объектов, от которых он зависит
+(пост, пользователь, тег, все посты); запись в БД увеличивает поколения затронутых объектов, и ответы со старыми
+поколениями считаются недействительными. Так запись вытесняет только те ответы, на которые она влияет.
+Поколения хранятся в массиве фиксированного размера (по хэшу объекта), поэтому память не растет с числом объектов;
+коллизия приводит лишь к лишнему вытеснению. Для каждого счетчика хранится и время последней записи: ответ,
+прочитанный с отстающей secondary вскоре после записи, мог не увидеть ее, поэтому такие ответы читаются с primary
+(см. BaseHandler.serve_cached).
+"""
+
+
+class CachedResponse(object):
+  __slots__ = ("body", "etag", "headers", "deps", "encoded")
+
+  def __init__(self, body, etag, headers, deps):
+    self.body = body
+    self.etag = etag
+    self.headers = headers
+    self.deps = deps
+    # сжатые варианты тела: способ сжатия -> тело (заполняется при первом запросе со сжатием)
+    self.encoded = {}
+
+
+class ResponseCache(object):
+  """
+  Кэш ответов с инвалидацией по счетчикам поколений. Используется только из IOLoop.
+  """
+  def __init__(self, maxsize=10000, ttl=60, slots=65536, timer=time.time):
+    """
+    Инициализация кэша
+
+    :param maxsize: максимальное количество ответов
+    :param ttl: время жизни ответа в секундах (ограничивает устаревание при записи из других процессов)
+    :param slots: размер массива счетчиков поколений
+    :param timer: функция получения текущего времени
+    """
+    self._entries = LRUCache(maxsize, ttl)
+    self._generations = [0] * slots
+    self._invalidated = [None] * slots
+    self._timer = timer
+    self.invalidations = 0
+
+  def _slot(self, scope, key):
+    if not isinstance(key, basestring):
+      key = str(key)
+    return hash((scope, key)) % len(self._generations)
+
+  @staticmethod
+  def make_key(path, arguments):
+    """
+    Метод формирует ключ кэша из пути и аргументов запроса (порядок аргументов не важен). Имена и значения
+    экранируются, поэтому разные наборы аргументов не дают одинаковый ключ
+
+    :param path: путь запроса
+    :param arguments: словарь аргументов запроса (имя -> список значений)
+    :return: ключ
+    """
+    return path + "?" + urllib.urlencode(sorted(arguments.items()), doseq=True)
+
+  @staticmethod
+  def make_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+  def snapshot(self, deps):
+    """
+    Метод запоминает текущие поколения зависимостей (вызывается до запроса к БД)
+
+    :param deps: список пар (тип объекта, идентификатор)
+    :return: кортеж пар (номер счетчика, поколение)
+    """
+    slots = [self._slot(scope, key) for scope, key in deps]
+    return tuple((slot, self._generations[slot]) for slot in slots)
+
+  def get(self, key):
+    """
+    Метод возвращает действительный закэшированный ответ
+
+    :param key: ключ
+    :return: CachedResponse или None
+    """
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    for slot, generation in entry.deps:
+      if self._generations[slot] != generation:
+        self._entries.delete(key)
+        return None
+    return entry
+
+  def set(self, key, body, headers, deps):
+    """
+    Метод сохраняет ответ
+
+    :param key: ключ
+    :param body: тело ответа
+    :param headers: дополнительные заголовки ответа (словарь)
+    :param deps: результат snapshot, сделанного до запроса к БД
+    :return: CachedResponse
+    """
+    entry = CachedResponse(body, self.make_etag(body), headers, deps)
+    self._entries.set(key, entry)
+    return entry
+
+  def invalidate(self, *deps):
+    """
+    Метод увеличивает поколения объектов, затронутых записью
+
+    :param deps: пары (тип объекта, идентификатор)
+    """
+    now = self._timer()
+    for scope, key in deps:
+      slot = self._slot(scope, key)
+      self._generations[slot] += 1
+      self._invalidated[slot] = now
+      self.invalidations += 1
+
+  def invalidated_within(self, deps, seconds):
+    """
+    Метод проверяет, менялись ли объекты за последние seconds секунд
+
+    :param deps: результат snapshot
+    :param seconds: интервал в секундах (отрицательный - без ограничения: менялись ли объекты когда-либо)
+    :return: True, если хотя бы один объект менялся
+    """
+    now = self._timer()
+    for slot, _ in deps:
+      invalidated = self._invalidated[slot]
+      if invalidated is not None and (seconds < 0 or now - invalidated < seconds):
+        return True
+    return False
+
+  def clear(self):
+    self._entries.clear()
+
+  def stats(self):
+    stats = self._entries.stats()
+    stats["invalidations"] = self.invalidations
+    return stats
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import json
+import logging
+import re
+from datetime import datetime, date, time
+
+from bson import ObjectId
+
+"""
+Модуль содержит сериализацию ответов в JSON: типы, которые json не умеет кодировать, преобразуются по таблице
+"тип -> функция", а сам кодировщик создается один раз (стандартный json или simplejson, если он установлен)
+"""
+
+logger = logging.getLogger(__name__)
+
+_retype = type(re.compile(''))
+
+
+def _isoformat(obj):
+  return obj.isoformat()
+
+
+def _none(obj):
+  return None
+
+
+_encoders = {
+  ObjectId: str,
+  datetime: _isoformat,
+  date: _isoformat,
+  time: _isoformat,
+  set: list,
+  frozenset: list,
+  _retype: lambda obj: obj.pattern,
+}
+
+
+def register(cls, encoder):
+  """
+  Метод добавляет функцию преобразования для типа
+
+  :param cls: тип
+  :param encoder: функция, возвращающая представление объекта, которое умеет кодировать json
+  """
+  _encoders[cls] = encoder
+
+
+def _resolve(cls):
+  """
+  Метод подбирает функцию преобразования для типа, отсутствующего в таблице (по родительским классам), и запоминает ее
+  """
+  for base in cls.__mro__[1:]:
+    if base in _encoders:
+      encoder = _encoders[base]
+      break
+  else:
+    encoder = _isoformat if callable(getattr(cls, "isoformat", None)) else _none
+  _encoders[cls] = encoder
+  return encoder
+
+
+def default(obj):
+  """
+  Функция для параметра default кодировщика JSON
+
+  :param obj: объект, который json не умеет кодировать
+  :return: преобразованный объект
+  """
+  encoder = _encoders.get(obj.__class__)
+  if encoder is None:
+    encoder = _resolve(obj.__class__)
+  return encoder(obj)
+
+
+_encoder = json.JSONEncoder(default=default, sort_keys=False)
+backend = "json"
+
+
+def configure(name="auto"):
+  """
+  Метод выбирает библиотеку для кодирования JSON
+
+  :param name: json, simplejson или auto (simplejson, если установлен)
+  :return: название выбранной библиотеки
+  """
+  global _encoder, backend
+  if name in ("auto", "simplejson"):
+    try:
+      import simplejson
+      _encoder = simplejson.JSONEncoder(default=default, sort_keys=False)
+      backend = "simplejson"
+      return backend
+    except ImportError:
+      if name == "simplejson":
+        logger.warning("simplejson is not installed, json is used")
+  _encoder = json.JSONEncoder(default=default, sort_keys=False)
+  backend = "json"
+  return backend
+
+
+def dumps(obj):
+  """
+  Метод кодирует объект в JSON
+
+  :param obj: объект
+  :return: строка JSON
+  """
+  return _encoder.encode(obj)
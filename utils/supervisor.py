@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import errno
+import logging
+import os
+import random
+import select
+import signal
+import time
+
+"""
+Модуль содержит супервизор рабочих процессов: процессы порождаются через fork (приложение и подключение к MongoDB
+создаются уже в дочернем процессе), упавшие процессы перезапускаются, по SIGHUP процессы по одному заменяются новыми
+(rolling reload), по SIGTERM/SIGINT всем процессам передается SIGTERM и супервизор дожидается их завершения.
+Порожденный через fork процесс выполняет уже загруженный супервизором код; чтобы rolling reload применял новый код и
+настройки, target запускает в дочернем процессе новый интерпретатор (exec), как это делает rest_server. Настройки
+самого супервизора (количество процессов, порт) меняются только его перезапуском.
+При rolling reload старый процесс останавливается, только когда новый сообщил о готовности (notify_ready, через
+канал, номер дескриптора которого передается в переменной окружения READY_FD_ENV); если новый процесс завершился
+или не стал готов за ready_timeout секунд, замена прекращается и оставшиеся старые процессы продолжают работать.
+"""
+
+logger = logging.getLogger(__name__)
+
+# переменная окружения рабочего процесса с номером дескриптора канала готовности
+READY_FD_ENV = "SUPERVISOR_READY_FD"
+
+
+def notify_ready():
+  """
+  Метод сообщает супервизору, что рабочий процесс готов принимать запросы (вне супервизора ничего не делает)
+  """
+  fd = os.environ.pop(READY_FD_ENV, None)
+  if not fd:
+    return
+  try:
+    os.write(int(fd), b"1")
+    os.close(int(fd))
+  except OSError:
+    pass
+
+
+class Supervisor(object):
+  def __init__(self, workers, target, min_uptime=5.0, restart_delay=1.0, reload_delay=2.0, ready_timeout=0):
+    """
+    Инициализация супервизора
+
+    :param workers: количество рабочих процессов
+    :param target: функция target(worker_id), выполняемая в рабочем процессе (может заменить его через exec)
+    :param min_uptime: если процесс упал быстрее, перед перезапуском выдерживается пауза restart_delay
+    :param restart_delay: пауза перед перезапуском быстро упавшего процесса, в секундах
+    :param reload_delay: пауза между запуском нового процесса и остановкой старого при rolling reload (если
+                         ready_timeout не задан); процесс, завершившийся за это время, прерывает замену
+    :param ready_timeout: максимальное время ожидания готовности нового процесса при rolling reload, в секундах
+                          (0 - готовность не ожидается, процесс только должен проработать reload_delay)
+    """
+    self.workers = workers
+    self.target = target
+    self.min_uptime = min_uptime
+    self.restart_delay = restart_delay
+    self.reload_delay = reload_delay
+    self.ready_timeout = ready_timeout
+    self.children = {}
+    self.started = {}
+    self._ready_fds = {}
+    self._stopping = False
+    self._reload = False
+
+  def _spawn(self, worker_id):
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      # дочерний процесс: обработчики сигналов и каналы готовности других процессов ему не нужны
+      for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+      for fd in [ready_r] + self._ready_fds.values():
+        os.close(fd)
+      os.environ[READY_FD_ENV] = str(ready_w)
+      random.seed()
+      code = 0
+      try:
+        self.target(worker_id)
+      except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+      except BaseException:
+        logger.exception("worker %s failed" % worker_id)
+        code = 1
+      finally:
+        os._exit(code)
+    os.close(ready_w)
+    self.children[pid] = worker_id
+    self.started[pid] = time.time()
+    self._ready_fds[pid] = ready_r
+    logger.info("worker %s started, pid %s" % (worker_id, pid))
+    return pid
+
+  def _forget(self, pid):
+    """
+    Метод удаляет сведения о завершенном (или останавливаемом) процессе
+
+    :return: номер рабочего процесса
+    """
+    fd = self._ready_fds.pop(pid, None)
+    if fd is not None:
+      os.close(fd)
+    self.started.pop(pid, None)
+    return self.children.pop(pid, None)
+
+  def _on_stop(self, signum, frame):
+    self._stopping = True
+    for pid in list(self.children):
+      self._kill(pid)
+
+  def _on_reload(self, signum, frame):
+    self._reload = True
+
+  def _kill(self, pid):
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+
+  def _wait(self, pid=-1):
+    """
+    Метод ожидает завершения дочернего процесса (прерывается сигналами)
+
+    :return: (pid, status) или (None, None), если ожидание прервано сигналом
+    """
+    try:
+      return os.waitpid(pid, 0)
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        return None, None
+      raise
+
+  def _exited(self, pid):
+    """
+    Метод проверяет без ожидания, завершился ли дочерний процесс (завершившийся процесс забывается)
+
+    :return: True, если процесс завершился
+    """
+    try:
+      waited, status = os.waitpid(pid, os.WNOHANG)
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        return False
+      if e.errno == errno.ECHILD:
+        return True
+      raise
+    if not waited:
+      return False
+    worker_id = self._forget(pid)
+    logger.warning("worker %s (pid %s) exited with status %s during reload" % (worker_id, pid, status))
+    return True
+
+  def _wait_ready(self, pid):
+    """
+    Метод ожидает готовности нового процесса: сообщения notify_ready за ready_timeout секунд, либо (без
+    ready_timeout) того, что процесс проработал reload_delay секунд
+
+    :return: True - процесс готов, False - процесс завершился, не стал готов вовремя или супервизор остановлен
+    """
+    fd = self._ready_fds.get(pid) if self.ready_timeout else None
+    deadline = time.time() + (self.ready_timeout or self.reload_delay)
+    while time.time() < deadline and not self._stopping:
+      if self._exited(pid):
+        return False
+      if fd is None:
+        time.sleep(0.05)
+        continue
+      try:
+        readable, _, _ = select.select([fd], [], [], 0.05)
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if readable:
+        if os.read(fd, 1):
+          return True
+        # канал закрыт без сообщения о готовности: процесс завершается
+        fd = None
+    if self._stopping or self._exited(pid):
+      return False
+    return not self.ready_timeout
+
+  def _stop_worker(self, pid):
+    """
+    Метод останавливает процесс и дожидается его завершения
+    """
+    self._forget(pid)
+    self._kill(pid)
+    while True:
+      waited, _ = self._wait(pid)
+      if waited is not None or self._stopping:
+        break
+
+  def _rolling_reload(self):
+    """
+    Метод по одному заменяет рабочие процессы: запускает новый, дожидается его готовности (см. _wait_ready) и
+    останавливает старый. Если новый процесс не стал готов, замена прекращается: он останавливается, а старые
+    процессы продолжают работать. Новый код и настройки загружаются, только если target выполняет exec
+    (см. описание модуля)
+    """
+    self._reload = False
+    logger.info("rolling reload of %s workers" % len(self.children))
+    for old_pid, worker_id in sorted(self.children.items(), key=lambda item: item[1]):
+      if self._stopping:
+        return
+      new_pid = self._spawn(worker_id)
+      if not self._wait_ready(new_pid):
+        if new_pid in self.children:
+          self._stop_worker(new_pid)
+        if not self._stopping:
+          logger.error("rolling reload aborted: new worker %s did not become ready" % worker_id)
+        return
+      self._stop_worker(old_pid)
+
+  def run(self):
+    """
+    Метод запускает рабочие процессы и следит за ними до остановки супервизора
+    """
+    signal.signal(signal.SIGTERM, self._on_stop)
+    signal.signal(signal.SIGINT, self._on_stop)
+    signal.signal(signal.SIGHUP, self._on_reload)
+    for worker_id in range(1, self.workers + 1):
+      self._spawn(worker_id)
+    while self.children:
+      if self._reload and not self._stopping:
+        self._rolling_reload()
+        continue
+      pid, status = self._wait()
+      if pid is None or pid not in self.children:
+        continue
+      uptime = time.time() - self.started[pid]
+      worker_id = self._forget(pid)
+      if self._stopping:
+        logger.info("worker %s stopped" % worker_id)
+        continue
+      if os.WIFSIGNALED(status):
+        logger.warning("worker %s (pid %s) killed by signal %s" % (worker_id, pid, os.WTERMSIG(status)))
+      else:
+        logger.warning("worker %s (pid %s) exited with status %s" % (worker_id, pid, os.WEXITSTATUS(status)))
+      if uptime < self.min_uptime:
+        time.sleep(self.restart_delay)
+      self._spawn(worker_id)
+    logger.info("all workers stopped")
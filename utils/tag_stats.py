@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+from collections import Counter
+from datetime import datetime
+
+from pymongo import UpdateOne
+from tornado import gen
+
+from utils.data_utils import tolist
+
+"""
+Модуль содержит счетчики постов по тегам: общее количество (коллекция tag_counts, _id - тег) и количество по дням
+(коллекция tag_counts_daily, поля tag, day, count). Счетчики увеличиваются при создании постов, поэтому статистика
+тегов читается без агрегации по всем постам. Для постов, созданных до появления счетчиков (или записанных в БД
+в обход API), счетчики пересчитываются функцией rebuild_tag_counts.
+"""
+
+DAY_MILLIS = 24 * 60 * 60 * 1000
+
+
+def day_of(date):
+  """
+  Метод возвращает начало дня даты (день - интервал счетчика tag_counts_daily)
+  """
+  return datetime(date.year, date.month, date.day)
+
+
+def post_tags(post):
+  """
+  Метод возвращает теги поста, которые учитываются в счетчиках (строки без повторов)
+  """
+  return set(tag for tag in tolist(post.get("tags")) if isinstance(tag, basestring))
+
+
+@gen.coroutine
+def count_tags(db, posts):
+  """
+  Метод увеличивает счетчики тегов для созданных постов (по одному bulk_write на коллекцию счетчиков)
+
+  :param db: база данных (MotorDatabase)
+  :param posts: документы созданных постов
+  """
+  totals = Counter()
+  daily = Counter()
+  for post in posts:
+    day = day_of(post["post_date"])
+    for tag in post_tags(post):
+      totals[tag] += 1
+      daily[(tag, day)] += 1
+  if not totals:
+    return
+  yield [
+    db.tag_counts.bulk_write([
+      UpdateOne({"_id": tag}, {"$inc": {"count": count}}, upsert=True) for tag, count in totals.items()
+    ], ordered=False),
+    db.tag_counts_daily.bulk_write([
+      UpdateOne({"tag": tag, "day": day}, {"$inc": {"count": count}}, upsert=True)
+      for (tag, day), count in daily.items()
+    ], ordered=False)
+  ]
+
+
+@gen.coroutine
+def get_tag_counts(db, tags):
+  """
+  Метод возвращает общее количество постов по тегам
+
+  :param db: база данных (MotorDatabase)
+  :param tags: список тегов
+  :return: словарь тег -> количество (0 для тегов без постов)
+  """
+  docs = yield db.tag_counts.find({"_id": {"$in": tags}}).to_list(len(tags))
+  counts = dict((tag, 0) for tag in tags)
+  counts.update((doc["_id"], doc["count"]) for doc in docs)
+  raise gen.Return(counts)
+
+
+@gen.coroutine
+def rebuild_tag_counts(db):
+  """
+  Метод пересчитывает счетчики тегов по всем постам (агрегация с $out заменяет коллекции счетчиков)
+
+  :param db: база данных (MotorDatabase)
+  """
+  day = {"$subtract": ["$post_date", {"$mod": [{"$subtract": ["$post_date", datetime(1970, 1, 1)]}, DAY_MILLIS]}]}
+  # пары (пост, тег) без повторов тегов внутри поста
+  unwind = [
+    {"$match": {"tags": {"$type": "string"}}},
+    {"$unwind": "$tags"},
+    {"$match": {"tags": {"$type": "string"}}},
+    {"$group": {"_id": {"post": "$_id", "tag": "$tags"}, "post_date": {"$first": "$post_date"}}}
+  ]
+  yield db.posts.aggregate(unwind + [
+    {"$group": {"_id": "$_id.tag", "count": {"$sum": 1}}},
+    {"$out": "tag_counts"}
+  ], allowDiskUse=True).to_list(None)
+  yield db.posts.aggregate(unwind + [
+    {"$group": {"_id": {"tag": "$_id.tag", "day": day}, "count": {"$sum": 1}}},
+    {"$project": {"_id": False, "tag": "$_id.tag", "day": "$_id.day", "count": True}},
+    {"$out": "tag_counts_daily"}
+  ], allowDiskUse=True).to_list(None)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+
+from bson.son import SON
+from pymongo import UpdateOne, DESCENDING
+from tornado import gen
+
+"""
+Модуль содержит ленты подписок (fan-out on write). Подписки хранятся в коллекции follows (поля follower, followee),
+количество подписчиков - в поле followers_count пользователя. Лента пользователя - документ коллекции timelines
+(_id - пользователь) со списком entries: ссылки на посты ({"_id": пост, "user_id": автор, "post_date": дата})
+от новых к старым, не больше заданного количества. Новый пост добавляется в ленты подписчиков автора пачками
+(по одному bulk_write на пачку), поэтому чтение ленты - один запрос по _id. Посты популярных авторов (подписчиков
+не меньше порога) в ленты не добавляются, а читаются из posts при чтении ленты (fan-out on read), чтобы один пост
+не приводил к миллионам записей.
+"""
+
+logger = logging.getLogger(__name__)
+
+# порядок записей ленты: от новых постов к старым (как сортировка выдачи по post_date, _id)
+ENTRY_SORT = SON([("post_date", DESCENDING), ("_id", DESCENDING)])
+
+
+def timeline_entry(post):
+  """
+  Метод возвращает запись ленты для поста
+  """
+  return {"_id": post["_id"], "user_id": post["user_id"], "post_date": post["post_date"]}
+
+
+def push_entries(db, user_ids, entries, size):
+  """
+  Метод добавляет записи в ленты пользователей (одним bulk_write), в каждой ленте остается size последних записей
+
+  :param db: база данных (MotorDatabase)
+  :param user_ids: пользователи, в ленты которых добавляются записи
+  :param entries: записи ленты
+  :param size: максимальная длина ленты
+  :return: Future
+  """
+  update = {"$push": {"entries": {"$each": entries, "$sort": ENTRY_SORT, "$slice": size}}}
+  return db.timelines.bulk_write([UpdateOne({"_id": user_id}, update, upsert=True) for user_id in user_ids],
+                                 ordered=False)
+
+
+@gen.coroutine
+def popular_authors(db, user_ids, threshold):
+  """
+  Метод выбирает популярных авторов (подписчиков не меньше threshold)
+
+  :param db: база данных (MotorDatabase)
+  :param user_ids: идентификаторы авторов
+  :param threshold: порог количества подписчиков (0 - популярных авторов нет)
+  :return: множество идентификаторов
+  """
+  if not threshold or not user_ids:
+    raise gen.Return(set())
+  docs = yield db.users.find({"_id": {"$in": list(user_ids)}, "followers_count": {"$gte": threshold}},
+                             {"_id": True}).to_list(None)
+  raise gen.Return(set(doc["_id"] for doc in docs))
+
+
+@gen.coroutine
+def fan_out(db, posts, size, batch_size=1000, threshold=0):
+  """
+  Метод добавляет посты в ленты подписчиков их авторов. Подписчики читаются курсором пачками по batch_size,
+  каждая пачка лент обновляется одним bulk_write. Посты популярных авторов пропускаются.
+
+  :param db: база данных (MotorDatabase)
+  :param posts: документы созданных постов
+  :param size: максимальная длина ленты
+  :param batch_size: количество лент в одном bulk_write
+  :param threshold: порог количества подписчиков популярного автора (0 - без ограничения)
+  :return: количество обновленных лент
+  """
+  entries = {}
+  for post in posts:
+    entries.setdefault(post["user_id"], []).append(timeline_entry(post))
+  popular = yield popular_authors(db, entries.keys(), threshold)
+  updated = 0
+  for author, items in entries.items():
+    if author in popular:
+      continue
+    cursor = db.follows.find({"followee": author}, {"_id": False, "follower": True}).batch_size(batch_size)
+    followers = []
+    while (yield cursor.fetch_next):
+      followers.append(cursor.next_object()["follower"])
+      if len(followers) >= batch_size:
+        yield push_entries(db, followers, items, size)
+        updated += len(followers)
+        followers = []
+    if followers:
+      yield push_entries(db, followers, items, size)
+      updated += len(followers)
+  raise gen.Return(updated)
+
+
+@gen.coroutine
+def fan_out_background(db, posts, size, batch_size=1000, threshold=0):
+  """
+  Метод для фонового вызова fan_out: ответ на запрос, создавший пост, уже отправлен, поэтому ошибки только
+  записываются в лог (пост, не попавший в ленты, остается доступен в posts)
+  """
+  try:
+    yield fan_out(db, posts, size, batch_size, threshold)
+  except Exception:
+    logger.exception("timeline fan-out failed")
+
+
+def merge_entries(posts, entries, limit):
+  """
+  Метод объединяет посты популярных авторов и записи ленты (без повторов) в порядке от новых к старым
+
+  :param posts: документы постов популярных авторов
+  :param entries: записи ленты
+  :param limit: размер страницы
+  :return: список документов постов и записей ленты длиной не больше limit
+  """
+  merged = {}
+  for item in list(posts) + list(entries):
+    merged.setdefault(item["_id"], item)
+  return sorted(merged.values(), key=lambda item: (item["post_date"], item["_id"]), reverse=True)[:limit]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+
+from pymongo import DESCENDING
+from tornado import gen
+
+"""
+Модуль содержит прогрев приложения перед приемом запросов: открытие соединений пулов MotorClient (иначе они
+открываются первыми запросами после запуска) и загрузку "горячих" данных - последних постов (их документы и индекс
+по дате попадают в кэш MongoDB) и их авторов (в кэш пользователей приложения).
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@gen.coroutine
+def open_connections(db, count):
+  """
+  Метод открывает соединения пула: одновременно выполняемые команды занимают каждая свое соединение
+
+  :param db: база данных (MotorDatabase), команды выполняются с ее read preference
+  :param count: количество соединений
+  """
+  if count > 0:
+    yield [db.command("ping", read_preference=db.read_preference) for _ in xrange(count)]
+
+
+@gen.coroutine
+def preload(db, user_cache, posts=1000, users=1000):
+  """
+  Метод загружает последние посты и их авторов
+
+  :param db: база данных для чтения (MotorDatabase)
+  :param user_cache: кэш пользователей (LRUCache), в который сохраняются авторы
+  :param posts: количество последних постов
+  :param users: максимальное количество авторов (авторы более новых постов загружаются первыми)
+  :return: (количество загруженных постов, количество загруженных пользователей)
+  """
+  docs = []
+  if posts > 0:
+    docs = yield db.posts.find({}, {"user_id": True}, sort=[("post_date", DESCENDING), ("_id", DESCENDING)],
+                               limit=posts).to_list(posts)
+  ids = []
+  seen = set()
+  for doc in docs:
+    user_id = doc.get("user_id")
+    if user_id is not None and user_id not in seen and len(ids) < users:
+      seen.add(user_id)
+      ids.append(user_id)
+  loaded = []
+  if ids:
+    loaded = yield db.users.find({"_id": {"$in": ids}}).to_list(len(ids))
+    for user in loaded:
+      user_cache.set(user["_id"], user)
+  raise gen.Return((len(docs), len(loaded)))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+__author__ = 'vatyakshin'
+
+import logging
+
+from pymongo.errors import BulkWriteError
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Lock
+
+"""
+Модуль содержит буфер отложенной записи (write-behind): документы накапливаются в памяти процесса и записываются
+в MongoDB пачками insert_many по достижении размера пачки или по таймеру
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class BufferClosed(Exception):
+  pass
+
+
+class WriteBehindBuffer(object):
+  """
+  Буфер отложенной записи в коллекцию. Используется только из IOLoop.
+  """
+  def __init__(self, collection, batch_size=500, flush_interval=0.05, max_size=10000, on_write=None):
+    """
+    Инициализация буфера
+
+    :param collection: коллекция (MotorCollection)
+    :param batch_size: размер пачки, при достижении которого запись начинается сразу
+    :param flush_interval: максимальное время ожидания документа в буфере, в секундах
+    :param max_size: максимальное количество документов в буфере; при заполнении put ожидает освобождения места
+    :param on_write: корутина, вызываемая со списком записанных документов пачки (до передачи результата
+                     ожидающим); ее ошибка пишется в лог и на результат записи не влияет
+    """
+    self.collection = collection
+    self.on_write = on_write
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_size = max_size
+    self._items = []
+    self._timeout = None
+    self._closed = False
+    self._lock = Lock()
+    self._not_full = Condition()
+    self.flushed = 0
+    self.failed = 0
+
+  def __len__(self):
+    return len(self._items)
+
+  @gen.coroutine
+  def put(self, doc, wait_flush=True):
+    """
+    Метод добавляет документ в буфер. У документа заранее должен быть задан _id.
+
+    :param doc: документ
+    :param wait_flush: ждать ли записи документа в БД (иначе - только постановки в буфер)
+    """
+    while len(self._items) >= self.max_size and not self._closed:
+      yield self._not_full.wait()
+    if self._closed:
+      raise BufferClosed("Buffer is closed")
+    future = Future()
+    self._items.append((doc, future))
+    if len(self._items) >= self.batch_size:
+      IOLoop.current().add_callback(self.flush)
+    elif self._timeout is None:
+      self._timeout = IOLoop.current().call_later(self.flush_interval, self.flush)
+    if wait_flush:
+      yield future
+
+  @gen.coroutine
+  def flush(self):
+    """
+    Метод записывает в БД все накопленные документы пачками
+    """
+    if self._timeout is not None:
+      IOLoop.current().remove_timeout(self._timeout)
+      self._timeout = None
+    with (yield self._lock.acquire()):
+      while self._items:
+        batch, self._items = self._items[:self.batch_size], self._items[self.batch_size:]
+        self._not_full.notify_all()
+        yield self._write(batch)
+
+  @gen.coroutine
+  def _write(self, batch):
+    """
+    Метод записывает пачку документов и передает результат ожидающим
+
+    :param batch: список пар (документ, Future)
+    """
+    errors = {}
+    try:
+      yield self.collection.insert_many([doc for doc, _ in batch], ordered=False)
+    except BulkWriteError as e:
+      for error in e.details.get("writeErrors", []):
+        errors[error["index"]] = e
+    except Exception as e:
+      logger.exception(e)
+      errors = dict((position, e) for position in range(len(batch)))
+    written = [doc for position, (doc, _) in enumerate(batch) if position not in errors]
+    if self.on_write is not None and written:
+      try:
+        yield self.on_write(written)
+      except Exception as e:
+        logger.exception(e)
+    for position, (doc, future) in enumerate(batch):
+      if position in errors:
+        self.failed += 1
+        future.set_exception(errors[position])
+      else:
+        self.flushed += 1
+        future.set_result(doc["_id"])
+
+  @gen.coroutine
+  def close(self):
+    """
+    Метод прекращает прием документов и записывает все, что осталось в буфере
+    """
+    self._closed = True
+    self._not_full.notify_all()
+    yield self.flush()